@@ -1,23 +1,126 @@
 import bcrypt
 import jwt
 import datetime
-from config import SECRET_KEY
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from config import (SECRET_KEYS, ACTIVE_KEY_ID, TOKEN_TTL, TOKEN_REFRESH_BEFORE, TOKEN_CACHE_SIZE,
+                    BCRYPT_ROUNDS, BCRYPT_POOL_SIZE, AUTH_QUEUE_LIMIT, AUTH_RETRY_AFTER)
 from database import get_user, create_user
 
+BUSY_ERROR = f"Server busy|retry_after={AUTH_RETRY_AFTER}"
+
+_pool = None
+_pool_lock = threading.Lock()
+# One slot per login that is hashing or waiting for a bcrypt process
+_admission = threading.BoundedSemaphore(BCRYPT_POOL_SIZE + AUTH_QUEUE_LIMIT)
+
+def _hashpw(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+def _checkpw(password, hashed):
+    return bcrypt.checkpw(password, hashed)
+
+def start_pool():
+    """Start the bcrypt worker processes, bcrypt never runs on a connection thread"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn, so workers don't inherit the server's threads and sockets
+            _pool = ProcessPoolExecutor(BCRYPT_POOL_SIZE, mp_context=multiprocessing.get_context("spawn"))
+            for _ in range(BCRYPT_POOL_SIZE):
+                _pool.submit(int)
+    return _pool
+
 def hash_password(password):
-    return bcrypt.hashpw(password.encode(), bcrypt.gensalt())
+    return start_pool().submit(_hashpw, password.encode(), BCRYPT_ROUNDS).result()
 
 def verify_password(password, hashed):
-    return bcrypt.checkpw(password.encode(), hashed)
+    return start_pool().submit(_checkpw, password.encode(), hashed).result()
 
 def generate_token(username):
     payload = {
         "username": username,
-        "exp": datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        "exp": datetime.datetime.utcnow() + datetime.timedelta(seconds=TOKEN_TTL)
     }
-    return jwt.encode(payload, SECRET_KEY, algorithm="HS256")
+    return jwt.encode(payload, SECRET_KEYS[ACTIVE_KEY_ID], algorithm="HS256",
+                      headers={"kid": ACTIVE_KEY_ID})
+
+# token -> (username, exp, kid) for tokens whose signature already checked out
+_verified = OrderedDict()
+_verified_lock = threading.Lock()
+
+def verify_token(token):
+    """(username, exp) for a valid token, else None. Repeat tokens skip the HMAC."""
+    now = time.time()
+    with _verified_lock:
+        hit = _verified.get(token)
+        if hit:
+            username, exp, kid = hit
+            # Expired, or signed with a key that has since been retired
+            if exp <= now or kid not in SECRET_KEYS:
+                del _verified[token]
+                return None
+            _verified.move_to_end(token)
+            return username, exp
+
+    try:
+        kid = jwt.get_unverified_header(token).get("kid", ACTIVE_KEY_ID)
+        key = SECRET_KEYS.get(kid)
+        if key is None:
+            return None
+        payload = jwt.decode(token, key, algorithms=["HS256"])
+    except jwt.InvalidTokenError:
+        return None
+
+    username = payload.get("username")
+    if not username:
+        return None
+    exp = payload["exp"]
+    with _verified_lock:
+        _verified[token] = (username, exp, kid)
+        if len(_verified) > TOKEN_CACHE_SIZE:
+            _verified.popitem(last=False)
+    return username, exp
+
+def resume(token):
+    """Log in again from a session token, no password or bcrypt involved.
+
+    Returns (username, token, expires_in, error). A token close to expiry is
+    swapped for a fresh one.
+    """
+    verified = verify_token(token)
+    if not verified:
+        return None, None, None, "Invalid or expired token"
+
+    username, exp = verified
+    expires_in = int(exp - time.time())
+    if expires_in <= TOKEN_REFRESH_BEFORE:
+        return username, generate_token(username), TOKEN_TTL, None
+    return username, token, expires_in, None
+
+def refresh(token):
+    """A fresh token for a still valid one, (token, expires_in) or (None, None)"""
+    verified = verify_token(token)
+    if not verified:
+        return None, None
+    return generate_token(verified[0]), TOKEN_TTL
 
 def authenticate(action, username, password):
+    if action not in ("REGISTER", "LOGIN"):
+        return None, "Invalid action"
+
+    # Turn excess logins away at once instead of letting them pile up
+    if not _admission.acquire(blocking=False):
+        return None, BUSY_ERROR
+    try:
+        return _authenticate(action, username, password)
+    finally:
+        _admission.release()
+
+def _authenticate(action, username, password):
     user = get_user(username)
 
     if action == "REGISTER":
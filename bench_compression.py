@@ -0,0 +1,113 @@
+"""Bytes on the wire and CPU per frame for dm_server message compression.
+
+Compares sending frames as they are, deflating each frame on its own,
+deflating each frame against compression.DICTIONARY (what the servers
+do), and one streaming deflate context per connection. The streaming
+context remembers earlier frames, so it compresses best, but it has to
+run once per recipient. A frame deflated on its own is compressed once
+and the same bytes go to every recipient. "wire" is the size dm_server
+sends, which includes base64 inside a {"type": "z"} line.
+
+    python bench_compression.py --frames 2000
+"""
+import argparse
+import json
+import random
+import time
+import zlib
+
+import compression
+
+WORDS = ("the a to and of is in it you that for on are with be this have was but not what "
+         "meet tomorrow lunch office project deadline thanks sure sounds good see later call "
+         "weekend kathmandu pokhara tea momo bus late sorry okay message photo send share "
+         "chat group friends family home work class exam notes").split()
+
+
+def sentence(rng, size):
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)[:size]
+
+
+def line(message_data):
+    return (json.dumps(message_data) + '\n').encode('utf-8')
+
+
+def samples(rng, count):
+    """Lists of frames of one kind each, in the order a client would get them"""
+    names = [f"{rng.choice(WORDS)}{rng.randrange(10000)}" for _ in range(5000)]
+    kinds = {}
+    for size in (120, 1024, 8192):
+        kinds[f"group {size}B"] = [
+            line({'type': 'group', 'from': rng.choice(names), 'message': sentence(rng, size), 'id': i})
+            for i in range(count)
+        ]
+    for users in (100, 2000):
+        kinds[f"user_list {users}"] = [
+            line({'type': 'user_list', 'users': sorted(rng.sample(names, users)), 'version': i})
+            for i in range(max(1, count // 20))
+        ]
+    kinds["history 50"] = [
+        line({'type': 'history', 'with': None, 'messages': [
+            {'id': i * 50 + j, 'from': rng.choice(names), 'to': None, 'message': sentence(rng, 80),
+             'time': 1.7e9 + j}
+            for j in range(50)
+        ]})
+        for i in range(max(1, count // 20))
+    ]
+    return kinds
+
+
+def per_frame(frames, compress):
+    start = time.process_time()
+    out = [compress(frame) for frame in frames]
+    return sum(map(len, out)) / len(frames), (time.process_time() - start) / len(frames), out
+
+
+def streaming(frames):
+    """One deflate stream per connection, flushed after every frame"""
+    compressor = zlib.compressobj(compression.LEVEL, zlib.DEFLATED, -15)
+    start = time.process_time()
+    total = 0
+    for frame in frames:
+        total += len(compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH))
+    return total / len(frames), (time.process_time() - start) / len(frames)
+
+
+def plain_deflate(data):
+    compressor = zlib.compressobj(compression.LEVEL, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--frames', type=int, default=2000, help="frames per message kind")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'frame':<16} {'raw':>8} {'deflate':>8} {'+dict':>8} {'wire':>8} {'stream':>8}"
+          f" {'dict us':>8} {'inflate us':>10} {'stream us':>9}")
+    for kind, frames in samples(rng, args.frames).items():
+        raw = sum(map(len, frames)) / len(frames)
+        plain, _, _ = per_frame(frames, plain_deflate)
+        shared, shared_cpu, packed = per_frame(frames, compression.deflate)
+        wire = sum(len(compression.pack_line(frame)) for frame in frames[:200]) / min(200, len(frames))
+        stream, stream_cpu = streaming(frames)
+
+        start = time.process_time()
+        for data in packed:
+            compression.inflate(data)
+        inflate_cpu = (time.process_time() - start) / len(packed)
+
+        print(f"{kind:<16} {raw:>8.0f} {plain:>8.0f} {shared:>8.0f} {wire:>8.0f} {stream:>8.0f}"
+              f" {shared_cpu * 1e6:>8.1f} {inflate_cpu * 1e6:>10.1f} {stream_cpu * 1e6:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Bytes on the wire and CPU per message, JSON lines against binproto.
+
+"json" is a line as dm_server sends it. "bin" is the binproto frame for a
+connection that already knows every user in it, the steady state, and
+"bin first" the same frame the first time it names those users. Encode
+times are one message for one recipient; a broadcast encodes once and
+only renders again for connections that know different users. Decode
+times are what a receiver spends turning the bytes back into a dict.
+
+    python bench_encoding.py --messages 20000
+"""
+import argparse
+import base64
+import json
+import random
+import time
+
+import binproto
+from bench_compression import WORDS, sentence
+from jsonlines import LineDecoder
+
+
+def samples(rng, count):
+    """Lists of messages of one kind each"""
+    names = [f"{rng.choice(WORDS)}{rng.randrange(10000)}" for _ in range(5000)]
+    return {
+        "group 40B": [{'type': 'group', 'from': rng.choice(names), 'message': sentence(rng, 40), 'id': i}
+                      for i in range(count)],
+        "group 400B": [{'type': 'group', 'from': rng.choice(names), 'message': sentence(rng, 400), 'id': i}
+                       for i in range(count)],
+        "dm sent": [{'type': 'dm', 'from': rng.choice(names), 'to': rng.choice(names),
+                     'message': sentence(rng, 60), 'id': i, 'sent': True}
+                    for i in range(count)],
+        "presence": [{'type': 'presence', 'base': i, 'version': i + 1, 'user_joined': [rng.choice(names)],
+                      'user_left': []}
+                     for i in range(count)],
+        "user_list 100": [{'type': 'user_list', 'users': sorted(rng.sample(names, 100)), 'version': i}
+                          for i in range(max(1, count // 20))],
+        "file_chunk 8K": [{'type': 'file_chunk', 'from': rng.choice(names), 'to': rng.choice(names),
+                           'id': f"{i:08x}", 'seq': i,
+                           'data': base64.b64encode(rng.randbytes(8192)).decode('ascii')}
+                          for i in range(max(1, count // 20))],
+    }
+
+
+def timed(function, items):
+    start = time.process_time()
+    out = [function(item) for item in items]
+    return (time.process_time() - start) / len(items), out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=20000, help="messages per kind")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'message':<14} {'json':>6} {'bin':>6} {'bin first':>9}"
+          f" {'json enc us':>11} {'bin enc us':>10} {'json dec us':>11} {'bin dec us':>10}")
+    for kind, messages in samples(rng, args.messages).items():
+        json_cpu, lines = timed(lambda message: (json.dumps(message) + '\n').encode('utf-8'), messages)
+        first = sum(len(binproto.Encoded([message]).render(set(), binproto.users.generation)) for message in messages) / len(messages)
+
+        # Every name is known from here on, as on a connection that has been up a while
+        known = set(binproto.users.ids.values())
+        bin_cpu, frames = timed(lambda message: binproto.Encoded([message]).render(known, binproto.users.generation), messages)
+
+        decoder = LineDecoder()
+        json_dec_cpu, _ = timed(lambda data: [json.loads(line) for line in decoder.feed(data)], lines)
+        reader = binproto.Decoder()
+        bin_dec_cpu, decoded = timed(reader.feed, frames)
+        assert [message for batch in decoded for message, _ in batch] == messages
+
+        print(f"{kind:<14} {sum(map(len, lines)) / len(lines):>6.0f} {sum(map(len, frames)) / len(frames):>6.0f}"
+              f" {first:>9.0f} {json_cpu * 1e6:>11.2f} {bin_cpu * 1e6:>10.2f}"
+              f" {json_dec_cpu * 1e6:>11.2f} {bin_dec_cpu * 1e6:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
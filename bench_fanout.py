@@ -0,0 +1,67 @@
+"""CPU cost of fanning one group message out to N connected dm_server users.
+
+Compares the old loop, which serialized the message once per recipient, with
+broadcast(), which encodes it once and queues the same bytes for everyone.
+
+    python bench_fanout.py --users 1000 10000 --messages 200
+"""
+import argparse
+import json
+import time
+
+import dm_server
+from outbound import OutboundQueue
+from registry import ClientRegistry
+
+
+class NullClient(OutboundQueue):
+    """Queue that keeps only the newest frame, so nothing touches a socket"""
+
+    def __init__(self, name):
+        super().__init__(name, max_frames=1)
+
+    def send(self, data):
+        self.push(data)
+        return len(data)
+
+
+def per_recipient_broadcast(message_data, exclude_user=None):
+    """The pre-fan-out broadcast: one json.dumps and encode per recipient"""
+    with dm_server.clients_lock:
+        for username, client in dm_server.clients.items():
+            if username != exclude_user:
+                try:
+                    json_msg = json.dumps(message_data) + '\n'
+                    client.send(json_msg.encode('utf-8'))
+                except:
+                    pass
+
+
+def measure(broadcast, message_data, messages):
+    start = time.process_time()
+    for _ in range(messages):
+        broadcast(message_data)
+    return (time.process_time() - start) / messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--size', type=int, default=120, help="characters per message")
+    args = parser.parse_args()
+
+    message_data = {'type': 'group', 'from': 'user0', 'message': 'x' * args.size}
+
+    print(f"{'users':>8} {'per-recipient':>16} {'encode-once':>16} {'speedup':>8}")
+    for users in args.users:
+        dm_server.clients = ClientRegistry((f'user{i}', NullClient(f'user{i}')) for i in range(users))
+
+        messages = max(1, args.messages * 1000 // users)
+        old = measure(per_recipient_broadcast, message_data, messages)
+        new = measure(dm_server.broadcast, message_data, messages)
+        print(f"{users:>8} {old * 1e3:>13.2f} ms {new * 1e3:>13.2f} ms {old / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
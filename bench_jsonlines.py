@@ -0,0 +1,64 @@
+"""Microbenchmark of JSON-lines splitting on pipelined dm_server traffic.
+
+A client that pipelines messages delivers many lines per recv(). The old
+loop in dm_server.handle() re-split the whole remaining string for every
+line, so its cost grows with the square of the burst size. LineDecoder
+scans each byte once.
+
+    python bench_jsonlines.py --messages 2000 20000 --chunk 4096 65536
+"""
+import argparse
+import json
+import time
+
+from jsonlines import LineDecoder
+
+
+def split_lines(chunks):
+    """The old dm_server.handle() loop"""
+    buffer = ""
+    count = 0
+    for chunk in chunks:
+        buffer += chunk.decode('utf-8')
+        while '\n' in buffer:
+            line, buffer = buffer.split('\n', 1)
+            count += 1
+    return count
+
+
+def decode_lines(chunks):
+    decoder = LineDecoder()
+    count = 0
+    for chunk in chunks:
+        count += len(decoder.feed(chunk))
+    return count
+
+
+def measure(split, chunks):
+    start = time.perf_counter()
+    count = split(chunks)
+    return time.perf_counter() - start, count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, nargs='+', default=[2000, 20000])
+    parser.add_argument('--chunk', type=int, nargs='+', default=[4096, 65536, 1 << 20],
+                        help="recv() sizes to slice the pipelined stream into")
+    args = parser.parse_args()
+
+    line = (json.dumps({'type': 'group', 'message': 'hello from a pipelined client'}) + '\n').encode()
+
+    print(f"{'messages':>9} {'chunk':>9} {'str.split':>12} {'LineDecoder':>12} {'speedup':>8}")
+    for messages in args.messages:
+        stream = line * messages
+        for size in args.chunk:
+            chunks = [stream[i:i + size] for i in range(0, len(stream), size)]
+            old, old_count = measure(split_lines, chunks)
+            new, new_count = measure(decode_lines, chunks)
+            assert old_count == new_count == messages
+            print(f"{messages:>9} {size:>9} {old * 1e3:>9.2f} ms {new * 1e3:>9.2f} ms {old / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Logins per second against users.db, before and after connection pooling.
+
+"Before" opens a fresh sqlite3 connection per call and uses the default
+rollback journal, the way database.py used to. "After" goes through
+database.ConnectionPool in WAL mode. bcrypt is left out: this measures the
+database side of a login only. Runs against throwaway files in a temp dir.
+
+    python bench_logins.py --users 10000 --threads 1 8
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import database
+
+
+def connect_per_call_get_user(path, username):
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT password FROM users WHERE username=?", (username,))
+    row = cursor.fetchone()
+    conn.close()
+    return row
+
+
+def connect_per_call_create_user(path, username, password_hash):
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    cursor.execute(
+        "INSERT INTO users (username, password) VALUES (?, ?)",
+        (username, password_hash)
+    )
+    conn.commit()
+    conn.close()
+
+
+def create_schema(path, users):
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE,
+            password BLOB
+        )
+    """)
+    conn.executemany(
+        "INSERT INTO users (username, password) VALUES (?, ?)",
+        ((f"user{i}", b"x" * 60) for i in range(users))
+    )
+    conn.commit()
+    conn.close()
+
+
+def rate(work, threads, calls):
+    """Calls per second with `threads` threads each making `calls` calls"""
+    def run(worker):
+        for i in range(calls):
+            work(worker, i)
+
+    workers = [threading.Thread(target=run, args=(w,)) for w in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return threads * calls / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--calls', type=int, default=2000, help="calls per thread")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        before = os.path.join(tmp, 'before.db')
+        after = os.path.join(tmp, 'after.db')
+        create_schema(before, args.users)
+        create_schema(after, args.users)
+        database.pool = database.ConnectionPool(after)
+
+        print(f"{'operation':<24} {'threads':>7} {'before/s':>10} {'after/s':>10} {'speedup':>8}")
+        for threads in args.threads:
+            old = rate(lambda w, i: connect_per_call_get_user(before, f"user{i % args.users}"),
+                       threads, args.calls)
+            new = rate(lambda w, i: database.get_user(f"user{i % args.users}"), threads, args.calls)
+            print(f"{'login lookup':<24} {threads:>7} {old:>10.0f} {new:>10.0f} {new / old:>7.1f}x")
+
+        for threads in args.threads:
+            calls = args.calls // 4
+            old = rate(lambda w, i: connect_per_call_create_user(before, f"new{threads}-{w}-{i}", b"x" * 60),
+                       threads, calls)
+            new = rate(lambda w, i: database.create_user(f"new{threads}-{w}-{i}", b"x" * 60),
+                       threads, calls)
+            print(f"{'registration':<24} {threads:>7} {old:>10.0f} {new:>10.0f} {new / old:>7.1f}x")
+
+        names = [f"user{i}" for i in range(0, args.users, max(1, args.users // 1000))]
+        start = time.perf_counter()
+        for name in names:
+            database.get_user(name)
+        single = time.perf_counter() - start
+        start = time.perf_counter()
+        found = database.get_users(names)
+        batched = time.perf_counter() - start
+        assert len(found) == len(names)
+        print(f"{len(names)} lookups one by one {single * 1e3:.1f} ms, batched {batched * 1e3:.1f} ms")
+        database.pool.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+"""Compact binary encoding for the DM protocol, an alternative to JSON lines.
+
+A client asks for it with "encoding": "bin1" in its handshake. The server
+answers with one last JSON line, {"type": "encoding", "encoding": "bin1"},
+and every frame after it is binary, both ways. The client sends nothing
+after its handshake until it has seen that answer. Servers that don't
+know the option never send it, and the client stays on JSON.
+
+    frame    uvarint length, then the body
+    body     uvarint tag, uvarint bitmap of the fields present, then those fields
+    uvarint  LEB128: 7 bits per byte, low bits first
+    str      uvarint byte length, then UTF-8
+    user     uvarint (id << 1 | named), then a str name if named
+
+The server numbers usernames the first time it sends them. Each connection
+gets a user by name once and by id after that. Clients send names as id 0
+with the name. A message with no schema, or with fields its schema can't
+carry, goes as tag 0 with its JSON text as one str.
+"""
+import json
+import threading
+
+from jsonlines import MAX_LINE
+
+ENCODING_ID = "bin1"
+ACCEPTED = (json.dumps({'type': 'encoding', 'encoding': ENCODING_ID}) + '\n').encode('utf-8')
+
+STR, UINT, USER, USERS, FLAG = range(5)
+JSON_TAG = 0
+MAX_VARINT = 5  # bytes, 35 bits
+MAX_UINT = 1 << 7 * MAX_VARINT  # larger numbers go as JSON
+MAX_USERS = 100000  # names numbered before the table starts over
+
+# type -> (tag, ((field, kind), ...)). A FLAG is true when present.
+SCHEMAS = {
+    'group': (1, (('from', USER), ('message', STR), ('id', UINT))),
+    'dm': (2, (('from', USER), ('to', USER), ('message', STR), ('id', UINT), ('sent', FLAG), ('queued', FLAG))),
+    'system': (3, (('message', STR),)),
+    'error': (4, (('message', STR),)),
+    'user_list': (5, (('users', USERS), ('version', UINT))),
+    'presence': (6, (('base', UINT), ('version', UINT), ('user_joined', USERS), ('user_left', USERS))),
+    'ping': (7, ()),
+    'pong': (8, ()),
+    'request_users': (9, ()),
+    'file_chunk': (10, (('from', USER), ('to', USER), ('id', STR), ('seq', UINT), ('data', STR))),
+    'file_ack': (11, (('from', USER), ('to', USER), ('id', STR), ('seq', UINT))),
+}
+TAGS = {tag: (message_type, fields) for message_type, (tag, fields) in SCHEMAS.items()}
+# type -> (tag bytes, ((field, kind, bitmap bit), ...)), what the encoder walks
+ENCODERS = {message_type: (bytes([tag]), tuple((field, kind, 1 << bit) for bit, (field, kind) in enumerate(fields)))
+            for message_type, (tag, fields) in SCHEMAS.items()}
+
+# Single byte uvarints, the common case
+SMALL = [bytes([n]) for n in range(128)]
+
+
+def uvarint(n):
+    if n < 128:
+        return SMALL[n]
+    out = bytearray()
+    while n >= 128:
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def text(value):
+    data = value.encode('utf-8')
+    return uvarint(len(data)) + data
+
+
+class UserIds:
+    """Server-wide username numbering, at most max_users names per generation.
+
+    A full table starts over as a new generation. Renderers then forget
+    what their connection learned, and frames numbered in the old one name
+    their users in full with id 0, which clients don't keep, so an id
+    never stands for two names on one connection.
+    """
+
+    def __init__(self, max_users=MAX_USERS):
+        self.ids = {}    # username -> id
+        self.names = {}  # id -> username
+        self.generation = 0
+        self.max_users = max_users
+        self.lock = threading.Lock()
+
+    def lookup(self, names):
+        """(ids of names, the generation they belong to)"""
+        generation = self.generation
+        try:
+            ids = [self.ids[name] for name in names]
+            if generation == self.generation:
+                return ids, generation
+        except KeyError:
+            pass
+        with self.lock:
+            if self.ids and len(self.ids) + len(names) > self.max_users:
+                # Bumped first, lock-free lookups racing with the clear notice it
+                self.generation += 1
+                self.ids.clear()
+                self.names.clear()
+            ids = []
+            for name in names:
+                number = self.ids.get(name)
+                if number is None:
+                    number = self.ids[name] = len(self.ids) + 1
+                    self.names[number] = name
+                ids.append(number)
+            return ids, self.generation
+
+    def export(self):
+        return {'generation': self.generation, 'ids': self.ids.copy()}
+
+    def restore(self, state):
+        # In place, decoders hold on to names
+        with self.lock:
+            self.generation = state['generation']
+            self.ids.clear()
+            self.names.clear()
+            self.ids.update(state['ids'])
+            self.names.update((number, name) for name, number in self.ids.items())
+
+
+users = UserIds()
+
+
+def encode(message):
+    """message as parts: bytes, and str usernames each connection renders its own way"""
+    encoder = ENCODERS.get(message.get('type'))
+    if encoder is not None:
+        parts = _encode(message, *encoder)
+        if parts is not None:
+            return parts
+    return [SMALL[JSON_TAG] + text(json.dumps(message))]
+
+
+def _encode(message, tag, fields):
+    if len(message) > len(fields) + 1:
+        return None  # fields the schema doesn't know about
+    bitmap = 0
+    parts = [tag, None]  # the bitmap goes second once it is known
+    append = parts.append
+    get = message.get
+    seen = 1
+    for field, kind, bit in fields:
+        value = get(field)
+        if value is None:
+            continue
+        seen += 1
+        bitmap |= bit
+        if kind == STR:
+            if value.__class__ is not str:
+                return None
+            data = value.encode('utf-8')
+            length = len(data)
+            append(SMALL[length] if length < 128 else uvarint(length))
+            append(data)
+        elif kind == USER:
+            if value.__class__ is not str:
+                return None
+            append(value)
+        elif kind == UINT:
+            if value.__class__ is not int or not 0 <= value < MAX_UINT:
+                return None
+            append(SMALL[value] if value < 128 else uvarint(value))
+        elif kind == USERS:
+            if value.__class__ is not list:
+                return None
+            append(uvarint(len(value)))
+            for name in value:
+                if name.__class__ is not str:
+                    return None
+            parts += value
+        elif value is not True:
+            return None
+    if seen != len(message):
+        return None  # a field left out of the schema, or set to null
+    parts[1] = SMALL[bitmap] if bitmap < 128 else uvarint(bitmap)
+    return parts
+
+
+def pack(message):
+    """One frame with every user sent by name as id 0, what clients send"""
+    body = b''.join(SMALL[1] + text(part) if part.__class__ is str else part for part in encode(message))
+    return uvarint(len(body)) + body
+
+
+class Encoded:
+    """One or more messages, ready to be written to any binary connection.
+
+    A broadcast shares one of these between its recipients. Only the user
+    references differ between connections, by whether each one already
+    knows a user, so renderings are cached per combination of those.
+    """
+
+    __slots__ = ('frames', 'names', 'ids', 'generation', 'rendered')
+
+    def __init__(self, messages):
+        self.frames = [encode(message) for message in messages]
+        self.names = [part for parts in self.frames for part in parts if part.__class__ is str]
+        if self.names:
+            self.ids, self.generation = users.lookup(self.names)
+        else:
+            self.ids, self.generation = [], users.generation
+        self.rendered = {}
+
+    @classmethod
+    def of(cls, frame, message=None):
+        """Encoded form of a JSON frame, from its message when the caller still has it"""
+        if message is not None:
+            return cls([message])
+        return cls([json.loads(line) for line in frame.splitlines() if line.strip()])
+
+    def render(self, known, generation):
+        """Bytes for a connection that knows the user ids in known, which learns the rest.
+
+        generation is the one known belongs to. Frames from an older one name
+        everyone as id 0 and teach nothing.
+        """
+        if generation == self.generation:
+            key = tuple(map(known.__contains__, self.ids))
+        else:
+            key = None
+        data = self.rendered.get(key)
+        if data is None:
+            data = self.rendered[key] = self._render(key)
+        if key is not None and not all(key):
+            known.update(self.ids)
+        return data
+
+    def _render(self, key):
+        if key is None:
+            # Named in full as id 0, taught nothing
+            refs = [SMALL[1] + text(name) for name in self.names]
+        else:
+            refs = [(SMALL[number << 1] if number < 64 else uvarint(number << 1)) if seen
+                    else uvarint(number << 1 | 1) + text(name)
+                    for number, name, seen in zip(self.ids, self.names, key)]
+        refs = iter(refs)
+        out = []
+        for parts in self.frames:
+            body = b''.join([part if part.__class__ is not str else next(refs) for part in parts])
+            out.append(uvarint(len(body)))
+            out.append(body)
+        return b''.join(out)
+
+
+class Renderer:
+    """Turns a binary connection's queued frames into bytes as they are written.
+
+    Rendering in the writer, in queue order, is what makes sure a user's
+    name always goes out before the first frame that uses only its id.
+    """
+
+    __slots__ = ('known', 'generation')
+
+    def __init__(self, known=()):
+        self.known = set(known)
+        self.generation = users.generation
+
+    def __call__(self, frame):
+        if frame.__class__ is bytes:
+            return frame
+        generation = users.generation
+        if generation != self.generation:
+            # The ids it learned mean nothing any more
+            self.known.clear()
+            self.generation = generation
+        return frame.render(self.known, generation)
+
+
+class Decoder:
+    """Splits a binary stream into messages, the counterpart of jsonlines.LineDecoder.
+
+    names maps user ids to names. A client's decoder learns them from the
+    named references it receives; the server's uses users.names and learns
+    nothing from clients.
+    """
+
+    def __init__(self, names=None, learn=False, data=b'', max_frame=MAX_LINE):
+        self.buf = bytearray(data)
+        self.names = users.names if names is None else names
+        self.learn = learn
+        self.max_frame = max_frame
+
+    def pending(self):
+        """Bytes received after the last complete frame"""
+        return bytes(self.buf)
+
+    def feed(self, data):
+        """Add data and return the (message, frame size) pairs it completed.
+
+        Raises ValueError for a frame that is too large or malformed.
+        """
+        buf = self.buf
+        buf += data
+        messages = []
+        pos = 0
+        end = len(buf)
+        while pos < end:
+            try:
+                length, start = read_uvarint(buf, pos)
+            except IndexError:
+                break  # length itself is incomplete
+            if length > self.max_frame:
+                raise ValueError(f"Frame of {length} bytes exceeds {self.max_frame}")
+            if start + length > end:
+                break
+            messages.append((self.decode(buf, start, start + length), start + length - pos))
+            pos = start + length
+        del buf[:pos]
+        if len(buf) > self.max_frame + MAX_VARINT:
+            raise ValueError(f"More than a {self.max_frame} byte frame buffered")
+        return messages
+
+    def decode(self, buf, pos, end):
+        try:
+            tag, pos = read_uvarint(buf, pos)
+            if tag == JSON_TAG:
+                data, pos = read_text(buf, pos)
+                message = json.loads(data)
+            else:
+                message, pos = self._decode(buf, pos, tag)
+        except (IndexError, KeyError, UnicodeDecodeError) as e:
+            raise ValueError(f"Malformed binary frame: {e!r}")
+        if pos != end:
+            raise ValueError("Binary frame length does not match its fields")
+        return message
+
+    def _decode(self, buf, pos, tag):
+        message_type, fields = TAGS[tag]
+        bitmap, pos = read_uvarint(buf, pos)
+        message = {'type': message_type}
+        for bit, (field, kind) in enumerate(fields):
+            if not bitmap >> bit & 1:
+                continue
+            if kind == STR:
+                message[field], pos = read_text(buf, pos)
+            elif kind == UINT:
+                message[field], pos = read_uvarint(buf, pos)
+            elif kind == USER:
+                message[field], pos = self.read_user(buf, pos)
+            elif kind == USERS:
+                count, pos = read_uvarint(buf, pos)
+                names = []
+                for _ in range(count):
+                    name, pos = self.read_user(buf, pos)
+                    names.append(name)
+                message[field] = names
+            else:
+                message[field] = True
+        return message, pos
+
+    def read_user(self, buf, pos):
+        ref, pos = read_uvarint(buf, pos)
+        number = ref >> 1
+        if ref & 1:
+            name, pos = read_text(buf, pos)
+            if self.learn and number:
+                self.names[number] = name
+            return name, pos
+        return self.names[number], pos
+
+
+def read_uvarint(buf, pos):
+    """(value, position after it), IndexError if buf ends first, ValueError past MAX_VARINT bytes"""
+    byte = buf[pos]
+    if byte < 128:
+        return byte, pos + 1
+    value = byte & 0x7f
+    shift = 7
+    while True:
+        pos += 1
+        byte = buf[pos]
+        value |= (byte & 0x7f) << shift
+        if byte < 128:
+            return value, pos + 1
+        shift += 7
+        if shift >= 7 * MAX_VARINT:
+            raise ValueError(f"Varint longer than {MAX_VARINT} bytes")
+
+
+def read_text(buf, pos):
+    length, pos = read_uvarint(buf, pos)
+    if pos + length > len(buf):
+        raise IndexError("string runs past the frame")
+    return buf[pos:pos + length].decode('utf-8'), pos + length
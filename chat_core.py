@@ -0,0 +1,352 @@
+"""One event loop serving all three chat protocols.
+
+Every listening port has a protocol adapter. Adapters read their wire
+format, call into dm_server, and render dm_server's JSON frames back into
+their format on the way out. Users of any protocol are clients in
+dm_server.clients and group messages go through dm_server.broadcast(), so
+one registry and one fan-out engine reach everyone:
+
+    dm        JSON lines of dm_server.py, served by dm_async as is
+    framed    server.py's auth line, then HEADER or 4-byte length-prefixed frames
+    chatroom  chatroom_server.py's bare "username:text" messages
+
+Adapters translate a frame once per wire variant, not once per recipient.
+A broadcast hands every recipient the same bytes object, so a cache of
+the last frame each variant saw is enough. Chatroom rooms stay a
+chatroom_server.py feature; here everyone shares the one group chat.
+"""
+import argparse
+import asyncio
+import json
+
+import dm_async
+import dm_server
+import heartbeat
+import metrics
+from chatlog import log, LEVELS
+from config import DISCONNECT_MESSAGE, FORMAT, REFRESH_MESSAGE, TOKEN_TTL
+from dm_async import AsyncClient
+from dm_server import HandshakeTimeout
+from framing import (decode_header, decode_body, encode_frame, header_size, parse_auth, token_reply,
+                     FrameError, PROTOCOL_V1)
+from message_store import MessageStore
+
+# Default port of each protocol, 0 leaves it off. server.py's 5050 is the
+# DM port here, so the framed protocol moves up one.
+PORTS = {'dm': dm_server.Port, 'framed': 5051, 'chatroom': 5052}
+BufferSize = 1024
+
+CHATROOM_HELP = 'Commands: /who, /dm <user> <text>, /ping. Everything else goes to the group chat.'
+
+
+class Session(AsyncClient):
+    """A client of a non-JSON protocol. dm_server sees an ordinary client whose
+    frames the adapter rewrites on the way to the socket."""
+
+    def __init__(self, adapter, writer, name=None, **queue_options):
+        super().__init__(writer, name, **queue_options)
+        self.adapter = adapter
+
+    def send(self, frame):
+        data = self.adapter.translate(self, frame)
+        if data:
+            self.send_raw(data)
+
+    send_bulk = send  # file chunks have no rendering, they are dropped like any other
+
+    def send_raw(self, data):
+        """Queue bytes already in the session's wire format"""
+        return super().send(data)
+
+
+class Adapter:
+    """Wire format of one protocol.
+
+    Subclasses read a connection in handshake() and run(), and write text
+    with encode(). `heartbeat` says whether its clients speak up on their
+    own while idle; the reaper leaves the others to TCP keepalive.
+    `authenticates` says whether handshake() checked a password or token.
+    """
+
+    name = None
+    heartbeat = True
+    authenticates = False
+
+    def __init__(self):
+        self.cache = {}  # variant -> (last frame, its rendering, group sender)
+
+    def variant(self, session):
+        """Sessions with the same variant get the same bytes for a frame"""
+        return None
+
+    def translate(self, session, frame):
+        """dm_server frame, one or more JSON lines, as bytes for session or None"""
+        key = self.variant(session)
+        cached = self.cache.get(key)
+        if cached is None or cached[0] is not frame:
+            data = []
+            sender = None
+            for line in frame.splitlines():
+                message = json.loads(line)
+                text = self.render(message)
+                if text is not None:
+                    data.append(self.encode(session, text))
+                if message.get('type') == 'group':
+                    sender = message.get('from')
+            cached = self.cache[key] = (frame, b''.join(data), sender)
+        _, data, sender = cached
+        # Our protocols never echoed a sender's own group message back
+        return None if sender == session.name else data
+
+    def render(self, message):
+        """Text for a dm_server message, None for those this protocol has no use for"""
+        kind = message.get('type')
+        if kind == 'group':
+            return f"{message.get('from')}: {message.get('message')}"
+        if kind == 'dm':
+            if 'to' not in message:
+                return f"[DM from {message.get('from')}] {message.get('message')}"
+            if message.get('sent') or message.get('queued'):
+                return f"[DM to {message['to']}] {message.get('message')}"
+            return None
+        if kind in ('system', 'error'):
+            return message.get('message')
+        return None
+
+    def encode(self, session, text):
+        raise NotImplementedError
+
+    async def handshake(self, session, reader):
+        """Username the client logs in with, None to hang up"""
+        raise NotImplementedError
+
+    async def run(self, session, username, reader):
+        """Message loop of a logged-in client, returns when it goes away"""
+        raise NotImplementedError
+
+    def chat(self, session, username, text):
+        """Dispatch one message typed by a user, returns seconds to stop reading"""
+        if not text.startswith('/'):
+            delay = session.throttle.charge('group', len(text))
+            dm_server.process_message(session, username, {'type': 'group', 'message': text})
+            return delay
+
+        name, _, arg = text.partition(' ')
+        if name == '/dm':
+            recipient, _, body = arg.strip().partition(' ')
+            delay = session.throttle.charge('dm', len(text))
+            dm_server.process_message(session, username, {'type': 'dm', 'to': recipient, 'message': body})
+            return delay
+
+        delay = session.throttle.charge('other', len(text))
+        if name == '/who':
+            users = dm_server.presence.snapshot()['users']
+            session.send_raw(self.encode(session, f"Online: {', '.join(users)}"))
+        elif name != '/ping':  # heartbeat, receiving it was enough
+            session.send_raw(self.encode(session, CHATROOM_HELP))
+        return delay
+
+    async def handle(self, reader, writer):
+        """Handshake, login and message loop for one connection"""
+        address = writer.get_extra_info('peername')
+        log.info('CONNECTION', "New %s connection from %s:%s", self.name, address[0], address[1])
+        session = Session(self, writer, f"{address[0]}:{address[1]}", **dm_server.queue_options)
+        session.address = address[0]
+        heartbeat.set_keepalive(writer.get_extra_info('socket'), dm_server.keepalive_idle)
+        username = None
+
+        try:
+            username = await asyncio.wait_for(self.handshake(session, reader), HandshakeTimeout)
+            if not username:
+                dm_server.handshake_failures.inc(1, ('invalid',))
+                return
+            # Names registered on the framed port stay with their owners
+            if not await dm_async.start_session(session, username, authenticated=self.authenticates):
+                username = None
+                return
+            if not self.heartbeat:
+                dm_server.reaper.unwatch(session)
+            await self.run(session, username, reader)
+
+        except asyncio.TimeoutError:
+            log.warning('ERROR', "Timeout waiting for %s handshake", self.name)
+            dm_server.handshake_failures.inc(1, ('timeout',))
+        except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+            log.warning('ERROR', "Error handling %s: %s", username or address[0], e)
+        finally:
+            if username:
+                dm_server.logout(session, username)
+            session.close()
+
+
+class ChatroomAdapter(Adapter):
+    """chatroom_server.py: a Username prompt, then "username:text" in each recv"""
+
+    name = 'chatroom'
+
+    def encode(self, session, text):
+        # One message per line, writes coalesce several of them
+        return (text + '\n').encode()
+
+    async def handshake(self, session, reader):
+        session.send_raw(b'Username')
+        username = (await reader.read(BufferSize)).decode(errors='replace').strip()
+        if username:
+            session.send_raw(self.encode(session, f'Connected to the server. {CHATROOM_HELP}'))
+        return username
+
+    async def run(self, session, username, reader):
+        while True:
+            data = await reader.read(BufferSize)
+            if not data:
+                break
+            dm_server.bytes_in.inc(len(data))
+            dm_server.reaper.touch(session)
+            for line in data.decode(errors='replace').splitlines():
+                # The name before the colon is the client's own idea, we know who it is
+                _, _, text = line.partition(':')
+                text = text.strip()
+                if text:
+                    delay = self.chat(session, username, text)
+                    if delay:
+                        await asyncio.sleep(delay)
+
+
+class FramedAdapter(Adapter):
+    """server.py: an auth line answered with TOKEN or ERROR, then length-prefixed frames"""
+
+    name = 'framed'
+    heartbeat = False  # client.py never pings
+    authenticates = True
+
+    def __init__(self):
+        super().__init__()
+        # bcrypt is only needed by this protocol
+        import auth
+        from database import init_db
+        self.auth = auth
+        init_db()
+        auth.start_pool()
+
+    def variant(self, session):
+        return session.framing
+
+    def render(self, message):
+        text = super().render(message)
+        if text is not None and message.get('type') in ('system', 'error'):
+            return f"[SERVER] {text}"
+        return text
+
+    def encode(self, session, text):
+        return encode_frame(text.encode(FORMAT), *session.framing)
+
+    async def handshake(self, session, reader):
+        loop = asyncio.get_running_loop()
+        session.framing = (PROTOCOL_V1, False)
+        try:
+            credentials, version, compress = parse_auth((await reader.read(BufferSize)).decode(FORMAT))
+        except FrameError as e:
+            session.send_raw(f'ERROR|{e}\n'.encode(FORMAT))
+            return None
+
+        if credentials[0] == 'RESUME':
+            username, token, expires_in, error = self.auth.resume(credentials[1])
+        else:
+            action, username, password = credentials
+            # bcrypt takes a while, the loop serves everyone else meanwhile
+            token, error = await loop.run_in_executor(None, self.auth.authenticate, action, username, password)
+            expires_in = TOKEN_TTL
+        if error:
+            session.send_raw(f'ERROR|{error}\n'.encode(FORMAT))
+            return None
+
+        session.send_raw(token_reply(token, expires_in, version, compress).encode(FORMAT))
+        session.framing = (version, compress)
+        session.token = token
+        return username
+
+    async def run(self, session, username, reader):
+        version, compress = session.framing
+        size = header_size(version)
+        while True:
+            try:
+                header = await reader.readexactly(size)
+                length, flagged = decode_header(header, version, compress)
+                body = decode_body(await reader.readexactly(length), flagged)
+            except asyncio.IncompleteReadError:
+                break
+            dm_server.bytes_in.inc(size + length)
+            dm_server.reaper.touch(session)
+            msg = str(body, FORMAT)
+
+            if msg == DISCONNECT_MESSAGE:
+                break
+            if msg == REFRESH_MESSAGE:
+                delay = session.throttle.charge('other', len(body))
+                session.token, expires_in = self.auth.refresh(session.token)
+                if session.token:
+                    session.send_raw(self.encode(session, f"TOKEN|{session.token}|expires_in={expires_in}"))
+                else:
+                    session.send_raw(self.encode(session, "ERROR|Token expired, log in again"))
+            else:
+                delay = self.chat(session, username, msg)
+            if delay:
+                await asyncio.sleep(delay)
+
+
+ADAPTERS = {'chatroom': ChatroomAdapter, 'framed': FramedAdapter}
+
+
+async def serve(host, ports, dm_socket):
+    """Accept every protocol on the one event loop dm_async runs"""
+    servers = []
+    for name, port in ports.items():
+        if name != 'dm' and port:
+            adapter = ADAPTERS[name]()
+            servers.append(await asyncio.start_server(adapter.handle, host, port))
+            log.info('CORE', "%s protocol on port %d", name, port)
+    try:
+        await dm_async.serve(dm_socket)
+    finally:
+        for server in servers:
+            server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sajilo Chat server for all three protocols")
+    parser.add_argument('--host', default=dm_server.IP_address)
+    for name, port in PORTS.items():
+        parser.add_argument(f'--{name}-port', type=int, default=port, help=f"0 turns the {name} protocol off")
+    parser.add_argument('--no-store', action='store_true',
+                        help="keep no message history and no offline mailboxes")
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help="serve Prometheus metrics on this port, 0 for off")
+    parser.add_argument('--log-level', choices=LEVELS, default='info')
+    args = parser.parse_args()
+    if not args.dm_port:
+        parser.error("the DM port carries the shared event loop, it can't be turned off")
+
+    log.configure(level=LEVELS[args.log_level])
+    if args.metrics_port:
+        metrics.serve('127.0.0.1', args.metrics_port)
+    if not args.no_store:
+        dm_server.store = MessageStore()
+
+    ports = {name: getattr(args, f'{name}_port') for name in PORTS}
+    dm_socket = dm_server.create_server_socket(args.host, args.dm_port)
+    dm_server.print_banner(args.host, args.dm_port, 'multi-protocol')
+    try:
+        dm_async.raise_file_limit()
+        asyncio.run(serve(args.host, ports, dm_socket))
+        print("\n[SHUTDOWN] Server stopped")
+    except KeyboardInterrupt:
+        print("\n[SHUTDOWN] Server stopped")
+    finally:
+        dm_socket.close()
+        if dm_server.store is not None:
+            dm_server.store.close()
+        log.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import json
+import queue
+import sys
+import threading
+import time
+
+import metrics
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LEVEL_NAMES = {value: name for name, value in LEVELS.items()}
+
+dropped_records = metrics.registry.counter('sajilo_log_dropped_total',
+                                           "Log records lost because the log queue was full")
+sampled_records = metrics.registry.counter('sajilo_log_sampled_out_total',
+                                           "Log records skipped by per-category sampling", ('category',))
+
+
+class Logger:
+    """Log records go through a bounded queue to one writer thread.
+
+    Callers never touch the output stream. Formatting happens on the writer,
+    so a disabled level costs one comparison and an enabled one a tuple and
+    a put_nowait(). When the stream is slower than the server the queue
+    fills and further records are dropped and counted, chat is never made
+    to wait. `sample` maps a category to N, keeping one record in N.
+    """
+
+    def __init__(self, level=INFO, structured=False, max_records=10000, sample=None, stream=None):
+        self.level = level
+        self.structured = structured
+        self.sample = dict(sample or {})
+        self.seen = {}  # category -> records offered, for sampling
+        self.stream = stream or sys.stdout
+        self.records = queue.Queue(max_records)
+        self.dropped = 0
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def configure(self, level=None, structured=None, max_records=None, sample=None):
+        if level is not None:
+            self.level = level
+        if structured is not None:
+            self.structured = structured
+        if max_records is not None:
+            self.records.maxsize = max_records
+        if sample is not None:
+            self.sample.update(sample)
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def debug(self, category, message, *args):
+        if DEBUG >= self.level:
+            self.log(DEBUG, category, message, args)
+
+    def info(self, category, message, *args):
+        if INFO >= self.level:
+            self.log(INFO, category, message, args)
+
+    def warning(self, category, message, *args):
+        if WARNING >= self.level:
+            self.log(WARNING, category, message, args)
+
+    def error(self, category, message, *args):
+        if ERROR >= self.level:
+            self.log(ERROR, category, message, args)
+
+    def log(self, level, category, message, args=()):
+        every = self.sample.get(category)
+        if every:
+            # Counting races between threads only shift which record is kept
+            seen = self.seen.get(category, 0)
+            self.seen[category] = seen + 1
+            if seen % every:
+                sampled_records.inc(1, (category,))
+                return
+
+        try:
+            self.records.put_nowait((time.time(), level, category, message, args))
+        except queue.Full:
+            self.dropped += 1
+            dropped_records.inc()
+
+    def _format(self, record):
+        created, level, category, message, args = record
+        if args:
+            try:
+                message = message % args
+            except (TypeError, ValueError):
+                message = f"{message} {args!r}"
+        if self.structured:
+            return json.dumps({
+                'time': round(created, 6),
+                'level': LEVEL_NAMES.get(level, str(level)),
+                'category': category,
+                'message': message,
+            })
+        return f"[{category}] {message}"
+
+    def _write_loop(self):
+        reported = 0
+        stop = False
+        while not stop:
+            record = self.records.get()
+            if record is None:
+                break
+            lines = [self._format(record)]
+            # Take whatever else is queued so one write serves many records
+            while len(lines) < 1000:
+                try:
+                    record = self.records.get_nowait()
+                except queue.Empty:
+                    break
+                if record is None:
+                    stop = True
+                    break
+                lines.append(self._format(record))
+
+            if self.dropped != reported:
+                lines.append(self._format((time.time(), WARNING, 'LOG',
+                                           "%d records dropped, log output is too slow", (self.dropped - reported,))))
+                reported = self.dropped
+            try:
+                self.stream.write('\n'.join(lines) + '\n')
+                self.stream.flush()
+            except (OSError, ValueError):
+                pass
+
+    def close(self, timeout=1.0):
+        """Write out what is queued, waiting at most timeout seconds"""
+        try:
+            self.records.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.writer.join(timeout)
+
+
+log = Logger()
+
+
+def parse_sample(values):
+    """['GROUP=100', ...] from the command line into {'GROUP': 100}"""
+    sample = {}
+    for value in values:
+        category, _, every = value.partition('=')
+        category = category.strip().upper()
+        try:
+            every = int(every)
+        except ValueError:
+            every = None
+        # Keeping one record in 0 or fewer means nothing
+        if not category or every is None or every < 1:
+            raise ValueError(f"Bad log sample {value!r}, expected CATEGORY=N with N a whole number above 0")
+        sample[category] = every
+    return sample
@@ -1,10 +1,13 @@
 
 import socket
 import threading
+import time
 
 HOST_IP= socket.gethostbyname(socket.gethostname())# ip of the laptop in the local router
 Port= 5052
 BufferSize=1024
+HeartbeatInterval=30 # the server drops clients that say nothing for 90 seconds
+last_sent=time.monotonic()
 
 # server side socket
 client_socket= socket.socket(socket.AF_INET,socket.SOCK_STREAM)# ipv4 with tcp socket
@@ -22,7 +25,7 @@ def receive():
             if message.decode()=='Username':
                 client_socket.send(Username.encode())
             else:
-                print(message.decode())
+                print(message.decode().rstrip('\n'))
             
         except:
             print("An error occured!!")
@@ -30,9 +33,21 @@ def receive():
             break
 
 def write():
+    global last_sent
     while True:
         message = f'{Username}:{input("")}'
         client_socket.send(message.encode())
+        last_sent=time.monotonic()
+
+def heartbeat():
+    # keeps a quiet user connected, the server answers nothing
+    while True:
+        time.sleep(HeartbeatInterval)
+        if time.monotonic()-last_sent>=HeartbeatInterval:
+            try:
+                client_socket.send(f'{Username}:/ping'.encode())
+            except OSError:
+                break
 
 
 receive_thread= threading.Thread(target=receive)
@@ -42,6 +57,8 @@ receive_thread.start()
 write_thread = threading.Thread(target=write)
 write_thread.start()
 
+threading.Thread(target=heartbeat,daemon=True).start()
+
 
 
 
@@ -1,5 +1,10 @@
 import socket
 import threading
+import time
+
+from heartbeat import Reaper, set_keepalive
+from ratelimit import FloodControl
+from recent import RecentMessages
 
 
 # defining constants
@@ -18,54 +23,236 @@ server_socket.bind((IP_address,Port))
 server_socket.listen()
 
 
-clients=[]
-usernames=[]
-
-def broadcast(message):
-    for client in clients:
-        client.send(message)
-
-
-def handle(client):
+DEFAULT_ROOM='lobby' # everyone starts here
+MAX_ROOM_NAME=32
+
+# Membership is indexed both ways so a message costs O(room size) and a
+# disconnect O(rooms joined), however many rooms exist
+rooms={}       # room name -> set of client sockets
+memberships={} # client socket -> set of room names
+usernames={}   # client socket -> username
+current={}     # client socket -> room its plain messages go to
+rooms_lock=threading.Lock()
+
+# the last messages of each room, replayed to whoever joins it. Kept in memory
+# only; a named room forgets its backlog when its last member leaves
+RECENT_MESSAGES=50
+RECENT_BYTES=64*1024
+backlogs={DEFAULT_ROOM:RecentMessages(RECENT_MESSAGES,RECENT_BYTES)} # room name -> RecentMessages
+
+# message and byte rates per user and address, see ratelimit.py
+flood=FloodControl()
+
+# clients send /ping while idle, anyone silent for this long is disconnected
+IDLE_TIMEOUT=90
+def shut(client):
+    try:
+        client.shutdown(socket.SHUT_RDWR) # wakes its handler's recv
+    except OSError:
+        pass
+reaper=Reaper(close=shut,timeout=IDLE_TIMEOUT)
+
+HELP=('Commands: /join <room>, /leave [room], /rooms, /who [room], /ping. '
+      f'Messages go to the room you joined last, {DEFAULT_ROOM} to begin with.')
+
+
+def broadcast(message, room=DEFAULT_ROOM, keep=False):
+    """Send message to everyone in room, and keep it for the room's backlog if keep"""
+    if room!=DEFAULT_ROOM:
+        message=f'[{room}] '.encode()+message
+    with rooms_lock:
+        # kept together with who gets it live, so a join sees it one way or the other
+        members=list(rooms.get(room,()))
+        if keep:
+            remember(room,message)
+    deliver(message,members)
+
+
+def remember(room, message):
+    """Add message to room's backlog, caller holds rooms_lock"""
+    if room not in rooms and room!=DEFAULT_ROOM:
+        return # nobody left in it
+    backlog=backlogs.get(room)
+    if backlog is None:
+        backlog=backlogs[room]=RecentMessages(RECENT_MESSAGES,RECENT_BYTES)
+    # one per line, the backlog goes out as a single write
+    backlog.append(message if message.endswith(b'\n') else message+b'\n')
+
+
+def forget(room):
+    """Drop an emptied room, caller holds rooms_lock"""
+    del rooms[room]
+    if room!=DEFAULT_ROOM:
+        backlogs.pop(room,None)
+
+
+def deliver(message, members):
+    for client in members:
+        try:
+            client.send(message)
+        except OSError:
+            # its own handler notices the dead socket and cleans up
+            pass
+
+
+def join(client, room):
+    # backlog and membership change under one lock, so every message is in
+    # the backlog or goes to client live, never both and never neither
+    frames=b''
+    with rooms_lock:
+        backlog=backlogs.get(room)
+        if backlog is not None and room not in memberships.get(client,()):
+            frames,_=backlog.backlog()
+        rooms.setdefault(room,set()).add(client)
+        memberships.setdefault(client,set()).add(room)
+        current[client]=room
+    if frames:
+        # not under the lock, a slow client must not stall every room; a
+        # message sent meanwhile can arrive just ahead of the backlog
+        try:
+            client.sendall(frames)
+        except OSError:
+            pass
+
+
+def leave(client, room):
+    """Drop client from room, False if it was not a member"""
+    with rooms_lock:
+        joined=memberships.get(client,set())
+        if room not in joined:
+            return False
+        joined.discard(room)
+        members=rooms[room]
+        members.discard(client)
+        if not members:
+            forget(room)
+        if current.get(client)==room:
+            # fall back to the lobby, or any room still joined
+            current[client]=DEFAULT_ROOM if DEFAULT_ROOM in joined else next(iter(joined),None)
+    return True
+
+
+def disconnect(client):
+    """Forget client everywhere, returns its username and the rooms it was in"""
+    with rooms_lock:
+        username=usernames.pop(client,None)
+        joined=memberships.pop(client,set())
+        current.pop(client,None)
+        for room in joined:
+            members=rooms[room]
+            members.discard(client)
+            if not members:
+                forget(room)
+    return username,joined
+
+
+def command(client, username, text):
+    """Handle a /command typed by a client"""
+    name,_,arg=text.partition(' ')
+    arg=arg.strip()
+
+    if name=='/join':
+        if not arg or len(arg)>MAX_ROOM_NAME or any(c.isspace() for c in arg):
+            client.send(f'Room names are 1-{MAX_ROOM_NAME} characters without spaces'.encode())
+            return
+        join(client,arg)
+        broadcast(f'{username} joined {arg}'.encode(),arg)
+
+    elif name=='/leave':
+        room=arg or current.get(client)
+        if room is None or not leave(client,room):
+            client.send(f'You are not in {room}'.encode())
+            return
+        client.send(f'Left {room}'.encode())
+        broadcast(f'{username} left {room}'.encode(),room)
+
+    elif name=='/rooms':
+        with rooms_lock:
+            listing=sorted((room,len(members)) for room,members in rooms.items())
+            joined=memberships.get(client,set())
+        lines=[f"{'*' if room in joined else ' '} {room} ({count})" for room,count in listing]
+        client.send(('Rooms:\n'+'\n'.join(lines)).encode())
+
+    elif name=='/ping':
+        pass # heartbeat, receiving it was enough
+
+    elif name=='/who':
+        room=arg or current.get(client)
+        with rooms_lock:
+            names=sorted(usernames[c] for c in rooms.get(room,()))
+        client.send(f'In {room}: {", ".join(names)}'.encode())
+
+    else:
+        client.send(HELP.encode())
+
+
+def handle(client, address):
+    username=usernames[client]
+    throttle=flood.attach(username,address)
+    reaper.watch(client)
     while True:
         try:
             message= client.recv(BufferSize)
-            broadcast(message)
+            if not message:
+                break
+            reaper.touch(client)
+            # clients send "username:text"
+            _,_,text=message.decode(errors='replace').partition(':')
+            text=text.strip()
+            if text.startswith('/'):
+                delay=throttle.charge('other',len(message))
+                command(client,username,text)
+            elif current.get(client) is None:
+                delay=throttle.charge('other',len(message))
+                client.send(f'Join a room first, /join {DEFAULT_ROOM}'.encode())
+            else:
+                # one recv can hold several newline terminated messages
+                delay=throttle.charge('group',len(message),message.count(b'\n') or 1)
+                broadcast(message,current.get(client),keep=True)
+            if delay:
+                # over the flood limit, stop reading so TCP slows the sender down
+                time.sleep(delay)
 # if it throws some exception, we cut the connection from the client terminate the loop.
 
         except:
-            index= clients.index(client)
-            clients.remove(client)
-            client.close()
-            username = usernames[index]
-            broadcast(f'{username} Disconnected'.encode())
-            usernames.remove(username)
             break
 
+    throttle.release()
+    reaper.unwatch(client)
+    client.close()
+    username,joined=disconnect(client)
+    # one notice per neighbour, however many rooms they shared
+    with rooms_lock:
+        neighbours=set().union(*(rooms.get(room,()) for room in joined))
+    deliver(f'{username} Disconnected'.encode(),neighbours)
+
 
 # for receiving the connection for the clients
 def receive():
     # Never ending loop so that the server is always 
     while True:
         client,address = server_socket.accept()
+        set_keepalive(client)
         print(f'Connected with {str(address)}')
 
         client.send('Username'.encode()) # asking user for the n
         username = client.recv(BufferSize).decode()
-        usernames.append(username)
-        clients.append(client)
+        with rooms_lock:
+            usernames[client]=username
+        join(client,DEFAULT_ROOM)
 
         print(f'Username of the client is{username}!')
         # this is shown in client server 
         broadcast(f'{username} joined the chat'.encode())
-        client.send(f'Connected to the server'.encode())
+        client.send(f'Connected to the server. {HELP}'.encode())
 
-        thread= threading.Thread(target=handle,args=(client,))
+        thread= threading.Thread(target=handle,args=(client,address[0]))
         thread.start()
 
 
 
 
+reaper.start()
 print("Server is listening")
 
 receive()
@@ -1,51 +1,109 @@
+import os
 import socket
 import threading
 from config import *
+from framing import FrameReader, send_frame, parse_options, PROTOCOL_V1, DICTIONARY_ID
 
 SERVER = socket.gethostbyname(socket.gethostname())
 ADDR = (SERVER, PORT)
 
-client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-client.connect(ADDR)
+TOKEN_FILE = ".sajilo_token"  # last session token, lets the next start skip the password
+MAX_REPLY = 4096  # an auth reply is one short line
+
+def connect():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect(ADDR)
+    return sock
+
+client = connect()
+version = PROTOCOL_V1
+compress = False
 
 def send(msg):
-    message = msg.encode(FORMAT)
-    length = len(message)
-    header = str(length).encode(FORMAT)
-    header += b' ' * (HEADER - len(header))
-    client.send(header)
-    client.send(message)
+    send_frame(client, msg.encode(FORMAT), version, compress)
 
 def receive():
+    reader = FrameReader(client, version, compressed=compress, data=pending)
     while True:
         try:
-            header = client.recv(HEADER).decode(FORMAT)
-            if not header:
+            frame = reader.read_frame()
+            if frame is None:
                 break
-            msg_length = int(header)
-            msg = client.recv(msg_length).decode(FORMAT)
+            msg = str(frame, FORMAT)
+            if msg.startswith("TOKEN|"):
+                save_token(msg)
+                continue
             print(msg)
         except:
             break
 
+def save_token(response):
+    """Keep the token from a TOKEN| line and refresh it before it expires"""
+    fields = response.split("|")
+    # The token logs in as us, so only we may read it
+    fd = os.open(TOKEN_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.chmod(TOKEN_FILE, 0o600)  # in case an older client created it readable
+    with os.fdopen(fd, "w") as f:
+        f.write(fields[1])
+    expires_in = int(parse_options(fields[2:]).get('expires_in', TOKEN_TTL))
+    timer = threading.Timer(max(1, expires_in - TOKEN_REFRESH_BEFORE), send, args=(REFRESH_MESSAGE,))
+    timer.daemon = True
+    timer.start()
+
+def load_token():
+    try:
+        with open(TOKEN_FILE) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def authenticate(auth_msg):
+    """Send an auth line, return the server's one-line answer and the frames read after it"""
+    client.send(auth_msg.encode(FORMAT))
+    data = b""
+    while b"\n" not in data and len(data) < MAX_REPLY:
+        chunk = client.recv(2048)
+        if not chunk:
+            break
+        data += chunk
+    line, _, rest = data.partition(b"\n")
+    return line.decode(FORMAT), rest
+
 # ---------- AUTH ----------
-choice = input("Login or Register (L/R): ").upper()
-username = input("Username: ")
-password = input("Password: ")
+response = None
+pending = b""  # frames that arrived with the auth reply
+token = load_token()
+if token:
+    response, pending = authenticate(f"RESUME|{token}|proto={PROTOCOL_VERSION}|compress={DICTIONARY_ID}")
+    if response.startswith("ERROR"):
+        # The server hangs up on a bad token, start over with a password
+        client.close()
+        client = connect()
+        response = None
 
-if choice == "R":
-    auth_msg = f"REGISTER|{username}|{password}"
-else:
-    auth_msg = f"LOGIN|{username}|{password}"
+if response is None:
+    choice = input("Login or Register (L/R): ").upper()
+    username = input("Username: ")
+    password = input("Password: ")
 
-client.send(auth_msg.encode(FORMAT))
-response = client.recv(2048).decode(FORMAT)
+    if choice == "R":
+        auth_msg = f"REGISTER|{username}|{password}|proto={PROTOCOL_VERSION}|compress={DICTIONARY_ID}"
+    else:
+        auth_msg = f"LOGIN|{username}|{password}|proto={PROTOCOL_VERSION}|compress={DICTIONARY_ID}"
+
+    response, pending = authenticate(auth_msg)
 
 if response.startswith("ERROR"):
     print(response)
     client.close()
     exit()
 
+# The server confirms the framing it agreed to, older servers say nothing
+options = parse_options(response.split("|")[2:])
+version = int(options.get('proto', PROTOCOL_V1))
+compress = options.get('compress') == DICTIONARY_ID
+save_token(response)
+
 print("Authenticated!")
 
 # ---------- CHAT ----------
@@ -0,0 +1,61 @@
+import base64
+import zlib
+
+# Name of the dictionary below. Peers ask for it in the handshake, so any
+# change to the dictionary needs a new name.
+DICTIONARY_ID = "zd1"
+THRESHOLD = 512  # frames shorter than this go out as they are
+LEVEL = 6
+MEM_LEVEL = 5  # smaller than zlib's 8, each frame's compressor is set up from scratch
+MAX_INFLATED = 16 * 1024 * 1024
+
+# Strings that recur in almost every frame. Deflate finds them here even in
+# a frame compressed on its own, and the most common ones come last because
+# nearer matches take fewer bits.
+DICTIONARY = b''.join((
+    b'[SERVER] ',
+    b' left the chat',
+    b' joined the chat',
+    b'{"type": "history", "with": ',
+    b'"messages": [{"id": ',
+    b', "time": 1',
+    b'{"type": "system", "message": "',
+    b'{"type": "presence", "base": ',
+    b'"user_joined": [',
+    b'"user_left": [',
+    b'{"type": "user_list", "users": ["',
+    b'], "version": ',
+    b'"sent": true',
+    b'"queued": true',
+    b'", "to": "',
+    b'{"type": "dm", "from": "',
+    b'"}\n',
+    b', "id": ',
+    b'{"type": "group", "from": "',
+    b'", "message": "',
+))
+
+
+def deflate(data):
+    """Raw deflate of data against the shared dictionary, no header or checksum"""
+    compressor = zlib.compressobj(LEVEL, zlib.DEFLATED, -15, MEM_LEVEL, zdict=DICTIONARY)
+    return compressor.compress(data) + compressor.flush()
+
+
+def inflate(data, max_size=MAX_INFLATED):
+    decompressor = zlib.decompressobj(-15, zdict=DICTIONARY)
+    result = decompressor.decompress(data, max_size)
+    if decompressor.unconsumed_tail:
+        raise ValueError(f"Compressed frame inflates to over {max_size} bytes")
+    return result
+
+
+def pack_line(frame):
+    """A JSON-lines frame as one {"type": "z"} line carrying it deflated"""
+    data = base64.b64encode(deflate(frame)).decode('ascii')
+    return b'{"type": "z", "data": "' + data.encode('ascii') + b'"}\n'
+
+
+def unpack_line(message_data):
+    """The JSON lines inside a decoded {"type": "z"} message, without newlines"""
+    return inflate(base64.b64decode(message_data['data'])).decode('utf-8').splitlines()
@@ -1,7 +1,24 @@
 HEADER = 64
+PROTOCOL_VERSION = 2  # newest framing clients may ask for, see framing.py
 PORT = 5050
 FORMAT = "utf-8"
 DISCONNECT_MESSAGE = "DISCONNECT!"
 
 SECRET_KEY = "super_secret_key"   # move to env later
-DB_NAME = "users.db"
\ No newline at end of file
+# Token signing keys by id, tokens name theirs in the "kid" header. To rotate,
+# add a key, point ACTIVE_KEY_ID at it and drop the old one after TOKEN_TTL.
+SECRET_KEYS = {"k1": SECRET_KEY}
+ACTIVE_KEY_ID = "k1"
+TOKEN_TTL = 3600           # seconds a session token is valid
+TOKEN_REFRESH_BEFORE = 300 # refresh tokens this many seconds before they expire
+TOKEN_CACHE_SIZE = 10000   # verified tokens remembered so RESUME skips the HMAC
+REFRESH_MESSAGE = "REFRESH!"
+BCRYPT_ROUNDS = 12         # cost factor for new password hashes
+BCRYPT_POOL_SIZE = 4       # processes doing bcrypt work
+AUTH_QUEUE_LIMIT = 32      # logins allowed to wait for a free bcrypt process
+AUTH_RETRY_AFTER = 2       # seconds a rejected client is told to back off
+DB_NAME = "users.db"
+MESSAGE_DB_NAME = "messages.db"
+# Flood limits on top of ratelimit.DEFAULT_LIMITS, e.g. {("ip", "group"): (100, 262144)}
+# for 100 messages and 256 KiB per second from one address, 0 for no limit
+FLOOD_LIMITS = {}
\ No newline at end of file
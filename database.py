@@ -1,33 +1,135 @@
+import queue
 import sqlite3
-from config import DB_NAME
+from contextlib import contextmanager
+from config import DB_NAME, MESSAGE_DB_NAME
+
+BUSY_TIMEOUT = 5.0  # seconds a writer waits for the lock before failing
+BATCH_LOOKUP = 500  # stays under SQLite's limit on bound parameters
+
+class ConnectionPool:
+    """Long-lived SQLite connections shared by all client threads.
+
+    Connections are opened in WAL mode so readers don't block the writer,
+    and each one keeps its own cache of prepared statements. Idle
+    connections are reused most-recently-first, at most `size` are kept.
+    """
+
+    def __init__(self, path=DB_NAME, size=8):
+        self.path = path
+        self.size = size
+        self.idle = queue.LifoQueue()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT,
+                               check_same_thread=False, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(BUSY_TIMEOUT * 1000)}")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            if self.idle.qsize() < self.size:
+                self.idle.put(conn)
+            else:
+                conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+pool = ConnectionPool(DB_NAME)
 
 def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE,
-            password BLOB
-        )
-    """)
-    conn.commit()
-    conn.close()
+    with pool.connection() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE,
+                password BLOB
+            )
+        """)
+        conn.commit()
 
 def get_user(username):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT password FROM users WHERE username=?", (username,))
-    row = cursor.fetchone()
-    conn.close()
-    return row
+    with pool.connection() as conn:
+        return conn.execute("SELECT password FROM users WHERE username=?", (username,)).fetchone()
+
+def get_users(usernames):
+    """Password hashes for many users in a few queries, {username: hash}"""
+    usernames = list(usernames)
+    found = {}
+    with pool.connection() as conn:
+        for i in range(0, len(usernames), BATCH_LOOKUP):
+            batch = usernames[i:i + BATCH_LOOKUP]
+            placeholders = ",".join("?" * len(batch))
+            rows = conn.execute(
+                f"SELECT username, password FROM users WHERE username IN ({placeholders})",
+                batch
+            )
+            found.update(rows)
+    return found
 
 def create_user(username, password_hash):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO users (username, password) VALUES (?, ?)",
-        (username, password_hash)
-    )
+    with pool.connection() as conn:
+        with conn:
+            conn.execute(
+                "INSERT INTO users (username, password) VALUES (?, ?)",
+                (username, password_hash)
+            )
+
+def init_message_db(path=MESSAGE_DB_NAME):
+    """Create the chat history schema, return a connection in WAL mode"""
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    # WAL lets history reads run while the writer commits, NORMAL syncs
+    # at checkpoints instead of on every commit
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            conversation TEXT NOT NULL,
+            sender TEXT NOT NULL,
+            recipient TEXT,
+            body TEXT NOT NULL,
+            created REAL NOT NULL
+        )
+    """)
+    # Keyset pages are range scans on this index, whatever the table size
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS messages_by_conversation
+        ON messages (conversation, id)
+    """)
+    # DMs waiting for an offline recipient, frame is the encoded dm line
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS mailbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            recipient TEXT NOT NULL,
+            frame BLOB NOT NULL,
+            created REAL NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS mailbox_by_recipient
+        ON mailbox (recipient, id)
+    """)
+    # First message id nobody has reserved yet, one row shared by every process
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS message_ids (
+            next INTEGER NOT NULL
+        )
+    """)
     conn.commit()
-    conn.close()
\ No newline at end of file
+    return conn
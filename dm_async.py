@@ -0,0 +1,469 @@
+import asyncio
+import base64
+import json
+import os
+import signal
+import socket
+import time
+
+import binproto
+import dm_server
+import handoff
+import heartbeat
+from chatlog import log
+from dm_server import BufferSize, HandshakeTimeout, REQUEST_USERNAME, process_line, process_decoded, parse_handshake, login, logout
+from dm_server import bytes_in, handshake_failures, handshake_seconds
+from outbound import OutboundQueue
+from jsonlines import LineDecoder
+
+DrainTimeout = 1.0  # seconds to flush a closing client's queue
+HandoffTimeout = 5.0  # seconds for clients to go quiet and for the new process to answer
+
+server = None  # asyncio server accepting connections
+handing_off = False  # logins that finish during a handoff are turned away
+
+
+class AsyncClient(OutboundQueue):
+    """Socket-like stream wrapper whose writes go through a queue drained by its own task.
+
+    The event loop must never block, so the 'block' policy disconnects a full
+    queue straight away instead of waiting.
+    """
+
+    def __init__(self, writer, name=None, **queue_options):
+        super().__init__(name, **queue_options)
+        self.writer = writer
+        self.wakeup = asyncio.Event()
+        self.aborted = False
+        self.drain_timeout = DrainTimeout
+        self.reading = False  # waiting in read_lines() for more from the socket
+        self.reads = 0
+        self.reader = None  # StreamReader of the message loop
+        self.handed_off = False
+        self.task = asyncio.get_running_loop().create_task(self._drain())
+
+    def send(self, data):
+        self.push(data)
+        self.wakeup.set()
+
+    def send_bulk(self, data):
+        self.push_bulk(data)
+        self.wakeup.set()
+
+    def abort(self):
+        super().abort()
+        self.aborted = True
+        self.wakeup.set()
+        self.writer.transport.abort()
+
+    def close(self, drain_timeout=DrainTimeout):
+        """Stop accepting frames, the writer task flushes the rest and closes"""
+        self.closed = True
+        self.drain_timeout = drain_timeout
+        self.wakeup.set()
+
+    def settled(self):
+        """Waiting for the client with nothing left to write, so its socket can change hands"""
+        return (self.reading and not self.frames and not self.bulk
+                and not self.writer.transport.get_write_buffer_size())
+
+    def handoff_state(self):
+        return {
+            'username': self.name,
+            'address': self.address,
+            'authenticated': self.authenticated,
+            'presence_deltas': self.presence_deltas,
+            'compress': self.compress,
+            'known': None if self.render is None else sorted(self.render.known),
+            'partial': base64.b64encode(self.decoder.pending()).decode('ascii'),
+        }
+
+    async def _drain(self):
+        try:
+            while not self.aborted:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                if self.frames or self.bulk:
+                    # Coalesce everything queued so far into one write
+                    self.writer.write(self.take_batch())
+                    if self.bulk:
+                        # Come back for the next chunk after this one drains
+                        self.wakeup.set()
+                if self.closed:
+                    break
+                await self.writer.drain()
+
+            if not self.aborted:
+                await asyncio.wait_for(self.writer.drain(), self.drain_timeout)
+        except (OSError, asyncio.TimeoutError):
+            self.writer.transport.abort()
+        self.writer.close()
+
+
+async def read_lines(reader, decoder, client):
+    """Read until the decoder has at least one complete line, [] on EOF"""
+    while True:
+        client.reading = True
+        chunk = await reader.read(BufferSize)
+        client.reading = False
+        client.reads += 1
+        if not chunk:
+            return []
+        bytes_in.inc(len(chunk))
+        lines = decoder.feed(chunk)
+        if lines:
+            return lines
+
+
+async def handle_connection(reader, writer):
+    """Run the handshake and then the message loop for one connection"""
+    address = writer.get_extra_info('peername')
+    log.info('CONNECTION', "New connection from %s:%s", address[0], address[1])
+
+    accepted = time.perf_counter()
+    client = AsyncClient(writer, f"{address[0]}:{address[1]}", **dm_server.queue_options)
+    client.address = address[0]
+    heartbeat.set_keepalive(writer.get_extra_info('socket'), dm_server.keepalive_idle)
+    username = None
+
+    try:
+        # Send username request
+        client.send(REQUEST_USERNAME)
+        log.debug('DEBUG', "Sent username request")
+
+        # Receive username with timeout, other handshakes keep running meanwhile
+        decoder = client.decoder = LineDecoder()
+        lines = await asyncio.wait_for(read_lines(reader, decoder, client), HandshakeTimeout)
+        if not lines:
+            log.warning('ERROR', "Client disconnected during handshake")
+            handshake_failures.inc(1, ('closed',))
+            return
+
+        username, options = parse_handshake(lines[0])
+        if not username or handing_off:
+            # Mid handoff it would miss the new process, it can log in there
+            handshake_failures.inc(1, ('invalid' if not username else 'closed',))
+            username = None
+            return
+
+        if not await start_session(client, username, options):
+            username = None
+            return
+        handshake_seconds.observe(time.perf_counter() - accepted)
+
+    except asyncio.TimeoutError:
+        log.warning('ERROR', "Timeout waiting for username")
+        handshake_failures.inc(1, ('timeout',))
+    except json.JSONDecodeError as e:
+        log.warning('ERROR', "JSON error: %s", e)
+        handshake_failures.inc(1, ('invalid',))
+    except Exception as e:
+        if username:
+            log.warning('ERROR', "Error handling %s: %s", username, e)
+            logout(client, username)
+            username = None
+        else:
+            log.warning('ERROR', "Handshake error: %s", e)
+            handshake_failures.inc(1, ('error',))
+    finally:
+        if not username:
+            client.close()
+
+    if username:
+        await run_client(client, username, reader, lines[1:])
+
+
+async def start_session(client, username, options=None, authenticated=False):
+    """Log in a client that gave its username and hand it its mailbox, False if it was turned away.
+
+    authenticated is for adapters that checked a password themselves,
+    anyone else goes through authorize().
+    """
+    if not authenticated:
+        allowed, authenticated = await asyncio.get_running_loop().run_in_executor(
+            None, dm_server.authorize, username, options or {})
+        if not allowed:
+            dm_server.reject_registered(client, username)
+            handshake_failures.inc(1, ('taken',))
+            return False
+
+    cluster = dm_server.cluster
+    if cluster is not None and not await cluster.claim(username):
+        # Logged in on another worker
+        dm_server.reject_taken(client, username)
+        handshake_failures.inc(1, ('taken',))
+        return False
+
+    logged_in = False
+    try:
+        logged_in = login(client, username, options, authenticated)
+    finally:
+        if not logged_in and cluster is not None and dm_server.clients.get(username) is not client:
+            # Never registered, so no logout() will give the claim back
+            cluster.release(username)
+    if not logged_in:
+        handshake_failures.inc(1, ('taken',))
+        return False
+
+    if dm_server.store is not None and client.authenticated:
+        frames = await asyncio.wrap_future(dm_server.store.take_mail(username))
+        dm_server.send_mail(client, username, frames)
+    return True
+
+
+async def run_client(client, username, reader, lines=()):
+    """Message loop of a logged-in client, starting with lines already read"""
+    client.reader = reader
+    process = process_decoded if isinstance(client.decoder, binproto.Decoder) else process_line
+    try:
+        while True:
+            for line in lines:
+                delay = process(client, username, line)
+                if delay:
+                    # Over its limit: nothing more is read meanwhile, the
+                    # socket buffer fills and TCP pushes back on the sender
+                    await asyncio.sleep(delay)
+            if client.render is not None and process is process_line:
+                # Binary from here on, the client waited for our answer to switch
+                client.decoder = binproto.Decoder(data=client.decoder.pending())
+                process = process_decoded
+            lines = await read_lines(reader, client.decoder, client)
+            if client.handed_off:
+                break
+            if not lines:
+                log.info('INFO', "%s connection closed", username)
+                break
+            dm_server.reaper.touch(client)
+    except Exception as e:
+        log.warning('ERROR', "Error handling %s: %s", username, e)
+    finally:
+        # After a handoff the connection lives on in the new process
+        if not client.handed_off:
+            logout(client, username)
+            client.close()
+
+
+def raise_file_limit():
+    """Lift the soft open-file limit to the hard limit so idle sockets don't run out"""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        print(f"[INFO] Open file limit raised from {soft} to {hard}")
+
+
+async def hand_over(conn, server_socket):
+    """Give the listening socket and every logged-in client to the process on conn.
+
+    Clients stop being read, their handlers finish what was already read
+    and their queues flush, then the sockets go over with each client's
+    state. A client that doesn't settle within HandoffTimeout is dropped
+    and the new process tells the others it left. Returns False if the new
+    process never confirmed, in which case we keep serving.
+    """
+    global server, handing_off
+    loop = asyncio.get_running_loop()
+    handing_off = True
+    # Connections that arrive meanwhile wait in the backlog for the new process
+    listen_fd = os.dup(server_socket.fileno())
+    server.close()
+    dm_server.presence.flush()
+
+    connections = list(dm_server.clients.values())
+    log.info('HANDOFF', "Handing over %d connections", len(connections))
+    for client in connections:
+        client.writer.transport.pause_reading()
+
+    # Settled twice in a row with no read in between, nothing is in flight
+    deadline = loop.time() + HandoffTimeout
+    while loop.time() < deadline:
+        reads = [client.reads for client in connections]
+        await asyncio.sleep(0.01)
+        if reads == [client.reads for client in connections] and all(c.settled() for c in connections):
+            break
+    moving = [client for client in connections if client.settled()]
+    staying = [client for client in connections if not client.settled()]
+
+    try:
+        conn.setblocking(True)
+        conn.settimeout(HandoffTimeout)
+        handoff.send_batch(conn, {
+            'online': sorted(dm_server.presence.online),
+            'version': dm_server.presence.version,
+            'users': binproto.users.export(),
+            'recent': dm_server.recent.export(),
+        }, [listen_fd])
+        for i in range(0, len(moving), handoff.MAX_FDS):
+            batch = moving[i:i + handoff.MAX_FDS]
+            handoff.send_batch(conn, {'clients': [client.handoff_state() for client in batch]},
+                               [client.writer.get_extra_info('socket').fileno() for client in batch])
+        handoff.send_batch(conn, {'done': True})
+        if not handoff.wait_ready(conn):
+            raise ConnectionError("New process did not confirm")
+    except (OSError, ValueError) as e:
+        log.error('HANDOFF', "Handoff failed, serving on: %s", e)
+        for client in connections:
+            client.writer.transport.resume_reading()
+        server = await asyncio.start_server(handle_connection, sock=socket.socket(fileno=listen_fd))
+        handing_off = False
+        return False
+    finally:
+        conn.close()
+
+    # Stop touching the moved sockets, closing our descriptors leaves them open in the new process
+    for client in moving:
+        client.handed_off = True
+        client.reader.feed_eof()  # its handler returns without logging out
+        client.task.cancel()
+        dm_server.reaper.unwatch(client)
+    for client in staying:
+        client.abort()
+    os.close(listen_fd)
+    log.info('HANDOFF', "Handed over %d connections, dropped %d", len(moving), len(staying))
+    return True
+
+
+async def wait_for_successor(path, server_socket):
+    """Listen on path until a new process has taken over"""
+    loop = asyncio.get_running_loop()
+    listener = handoff.listen(path)
+    listener.setblocking(False)
+    try:
+        while True:
+            conn, _ = await loop.sock_accept(listener)
+            try:
+                request = await asyncio.wait_for(loop.sock_recv(conn, len(handoff.TAKEOVER)), HandoffTimeout)
+            except (OSError, asyncio.TimeoutError):
+                request = None
+            if request != handoff.TAKEOVER:
+                conn.close()
+                continue
+            if await hand_over(conn, server_socket):
+                return
+    finally:
+        listener.close()
+
+
+def take_over(path):
+    """Receive the listening socket and clients of the server with the handoff socket at path.
+
+    Runs before our event loop starts. Returns the listening socket and
+    what serve() needs to adopt the clients.
+    """
+    state, fds, conn = handoff.request(path)
+    server_socket = socket.socket(fileno=fds[0])
+    connections = []
+    for batch, batch_fds in handoff.receive_rest(conn):
+        connections.extend(zip(batch['clients'], batch_fds))
+    log.info('HANDOFF', "Took over %d connections from %s", len(connections), path)
+    return server_socket, (state, connections)
+
+
+async def adopt(state, connections):
+    """Pick up where the old process left off, without announcing anyone again"""
+    dm_server.presence.restore(state['online'], state['version'])
+    binproto.users.restore(state['users'])
+    dm_server.recent.restore(state['recent'])
+    streams = [await asyncio.open_connection(sock=socket.socket(fileno=fd)) for _, fd in connections]
+
+    # Everyone is registered before any handler runs, so none of them looks offline
+    handlers = []
+    for (client_state, _), (reader, writer) in zip(connections, streams):
+        username = client_state['username']
+        address = writer.get_extra_info('peername')
+        client = AsyncClient(writer, f"{address[0]}:{address[1]}", **dm_server.queue_options)
+        client.address = client_state['address']
+        known = client_state['known']
+        client.decoder = LineDecoder() if known is None else binproto.Decoder()
+        # Normally no complete line, the old process read up to its last one
+        lines = client.decoder.feed(base64.b64decode(client_state['partial']))
+        dm_server.adopt(client, username, client_state['presence_deltas'], client_state['compress'], known,
+                        client_state.get('authenticated', False))
+        handlers.append(run_client(client, username, reader, lines))
+    for handler in handlers:
+        asyncio.ensure_future(handler)
+
+    # Whoever the old process had to drop has gone
+    for username in set(state['online']) - {client_state['username'] for client_state, _ in connections}:
+        dm_server.presence.left(username)
+
+
+async def shut_down(timeout):
+    """Flush what every client is owed, all within timeout seconds, and close them"""
+    connections = list(dm_server.clients.values())
+    # Only our own clients, in a cluster every worker tells its own
+    notice = {'type': 'system', 'message': 'Server is shutting down'}
+    dm_server.deliver_frame(dm_server.encode(notice), kind='system')
+    for client in connections:
+        client.close(timeout)
+    if connections:
+        done, pending = await asyncio.wait([client.task for client in connections], timeout=timeout)
+        for client in connections:
+            if client.task in pending:
+                client.abort()
+        log.info('SHUTDOWN', "Flushed %d of %d connections", len(done), len(connections))
+
+
+async def serve(server_socket, handoff_path=None, takeover=None):
+    """Serve until SIGINT or SIGTERM, or until a new process took over. True in the last case."""
+    global server
+    loop = asyncio.get_running_loop()
+    # Presence flushes write to clients, so they must run on the loop too
+    dm_server.presence.schedule = loop.call_later
+    asyncio.ensure_future(dm_server.reaper.run_async())
+    if takeover is not None:
+        await adopt(*takeover)
+    server_socket.setblocking(False)
+    server = await asyncio.start_server(handle_connection, sock=server_socket)
+
+    stopping = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, stopping.set)
+        except NotImplementedError:
+            pass  # Windows, Ctrl-C still raises KeyboardInterrupt
+    waiting = [asyncio.ensure_future(stopping.wait())]
+    successor = None
+    if handoff_path:
+        successor = asyncio.ensure_future(wait_for_successor(handoff_path, server_socket))
+        waiting.append(successor)
+
+    try:
+        done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in waiting:
+            task.cancel()
+    if successor in done:
+        return True
+
+    server.close()
+    await shut_down(dm_server.ShutdownTimeout)
+    if handoff_path:
+        try:
+            os.unlink(handoff_path)
+        except OSError:
+            pass
+    return False
+
+
+def run(server_socket, handoff_path=None, takeover=None):
+    """Serve the DM protocol from server_socket on a single asyncio event loop.
+
+    Returns True if the server stopped because a new process took over.
+    """
+    raise_file_limit()
+    return asyncio.run(serve(server_socket, handoff_path, takeover))
+
+
+if __name__ == "__main__":
+    server_socket = dm_server.create_server_socket()
+    dm_server.print_banner(dm_server.IP_address, dm_server.Port, 'async')
+    try:
+        run(server_socket)
+    except KeyboardInterrupt:
+        print("\n[SHUTDOWN] Server stopped")
+    finally:
+        server_socket.close()
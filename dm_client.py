@@ -1,13 +1,33 @@
 import socket
 import threading
 import json
+import os
 import sys
 import time
 
+import binproto
+import compression
+import filetransfer
+from jsonlines import LineDecoder
+
 HOST_IP = socket.gethostbyname(socket.gethostname())
 Port = 5050
 BufferSize = 1024
 
+# binproto frames are smaller but take longer to encode than JSON, so they are opt-in
+RequestBinary = '--binary' in sys.argv[1:]
+
+TOKEN_FILE = ".sajilo_token"  # saved by client.py, proves the username so offline DMs are handed over
+
+
+def load_token():
+    try:
+        with open(TOKEN_FILE) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
 client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 address = (HOST_IP, Port)
 
@@ -27,8 +47,22 @@ except Exception as e:
 # Global variables
 running = True
 online_users = []
+users_version = None  # presence version online_users is at
 current_chat = None  # None = group chat, username = DM
 handshake_complete = threading.Event()
+send_lock = threading.Lock()  # file transfers send from their own threads
+outgoing = {}  # transfer id -> filetransfer.Outgoing
+incoming = {}  # (sender, transfer id) -> filetransfer.Incoming
+binary = False  # the server accepted binproto, frames go both ways in it
+
+
+def send_json(message_data):
+    if binary:
+        data = binproto.pack(message_data)
+    else:
+        data = (json.dumps(message_data) + '\n').encode()
+    with send_lock:
+        client_socket.sendall(data)
 
 
 def display_help():
@@ -36,6 +70,7 @@ def display_help():
     print("COMMANDS:")
     print("  /users          - Show online users")
     print("  /dm <username>  - Start DM with user")
+    print("  /send <file>    - Send a file in the current DM")
     print("  /group          - Return to group chat")
     print("  /menu           - Return to main menu")
     print("  /help           - Show this help")
@@ -107,60 +142,178 @@ def choose_dm_user():
             print("[Please enter a number.]")
 
 
-def receive():
-    global running, online_users, current_chat
+def handle_message(data):
+    global online_users, users_version
+
+    msg_type = data.get('type')
     
+    if msg_type == 'request_username':
+        handshake = {'username': Username, 'presence': 'delta', 'compress': compression.DICTIONARY_ID}
+        if RequestBinary:
+            handshake['encoding'] = binproto.ENCODING_ID
+        token = load_token()
+        if token:
+            handshake['token'] = token
+        send_json(handshake)
+        
+    elif msg_type == 'system':
+        system_msg = data.get('message')
+        print(f"\n[SYSTEM] {system_msg}")
+        if 'Welcome' in system_msg or 'server' in system_msg.lower():
+            handshake_complete.set()
+        
+    elif msg_type == 'user_list':
+        online_users = data.get('users', [])
+        users_version = data.get('version')
+        print(f"\n[{len(online_users)} users online]")
+
+    elif msg_type == 'presence':
+        if users_version is None or data.get('base', 0) > users_version:
+            # Missed a delta, ask for a fresh snapshot
+            send_json({'type': 'request_users'})
+        elif data.get('version', 0) > users_version:
+            left = set(data.get('user_left', []))
+            online_users = [u for u in online_users if u not in left]
+            online_users += [u for u in data.get('user_joined', []) if u not in online_users]
+            users_version = data['version']
+        
+    elif msg_type == 'group':
+        if current_chat is None:
+            sender = data.get('from')
+            message = data.get('message')
+            print(f"\n{sender}: {message}")
+            
+    elif msg_type == 'dm':
+        sender = data.get('from')
+        message = data.get('message')
+        
+        if sender == Username:
+            recipient = data.get('to')
+            if current_chat == recipient:
+                print(f"\nYou: {message}")
+            if data.get('queued'):
+                print(f"[{recipient} is offline, they will get it when they log in]")
+        else:
+            if current_chat == sender:
+                print(f"\n{sender}: {message}")
+            else:
+                print(f"\n[DM from {sender}]: {message}")
+                print(f"[Type '/dm {sender}' to reply or go to Main Menu]")
+                
+    elif msg_type == 'z':
+        # Large messages arrive deflated, each holds one or more ordinary lines
+        for line in compression.unpack_line(data):
+            handle_message(json.loads(line))
+
+    elif msg_type == 'ping':
+        # The server checks we are still there after a quiet spell
+        send_json({'type': 'pong'})
+
+    elif msg_type in filetransfer.FILE_TYPES:
+        handle_file_message(msg_type, data)
+
+    elif msg_type == 'error':
+        print(f"\n[ERROR] {data.get('message')}")
+
+
+def handle_file_message(msg_type, data):
+    sender = data.get('from')
+    key = (sender, data.get('id'))
+
+    if msg_type == 'file_offer':
+        transfer = incoming[key] = filetransfer.Incoming(data)
+        resumed = f", resuming at chunk {transfer.next_seq}" if transfer.next_seq else ""
+        print(f"\n[Receiving {transfer.name} ({transfer.size} bytes) from {sender}{resumed}]")
+        send_json(transfer.accept())
+
+    elif msg_type == 'file_chunk' and key in incoming:
+        transfer = incoming[key]
+        answer = transfer.write(data['seq'], data['data'])
+        if answer:
+            send_json(answer)
+
+    elif msg_type == 'file_cancel' and key in incoming:
+        del incoming[key]
+        print(f"\n[{sender} stopped sending a file: {data.get('reason')}]")
+
+    else:
+        transfer = outgoing.get(data.get('id'))
+        if transfer is None or transfer.to != sender:
+            return
+        if msg_type == 'file_accept':
+            transfer.accepted(data['from_chunk'], data['window'])
+        elif msg_type == 'file_ack':
+            transfer.acknowledged(data['seq'])
+        elif msg_type == 'file_cancel':
+            transfer.cancel(data.get('reason'))
+        return
+
+    transfer = incoming.get(key)
+    if transfer is not None and transfer.done:
+        del incoming[key]
+        print(f"\n[Saved {transfer.finish()} from {sender}]")
+
+
+def send_file(path, recipient):
+    try:
+        transfer = filetransfer.Outgoing(path, recipient)
+    except OSError as e:
+        print(f"\n[Cannot send {path}: {e}]")
+        return
+    outgoing[transfer.id] = transfer
+    print(f"[Sending {os.path.basename(path)} ({transfer.size} bytes) to {recipient}]")
+    try:
+        reason = transfer.run(send_json)
+    except OSError as e:
+        reason = str(e)
+    finally:
+        del outgoing[transfer.id]
+    if reason is None:
+        print(f"\n[{recipient} received {os.path.basename(path)}]")
+    else:
+        print(f"\n[Sending {os.path.basename(path)} stopped: {reason}. /send it again to resume]")
+
+
+def receive():
+    global running, binary
+
+    # Bytes, not str: after the server accepts binproto the same chunk may go on in binary
+    decoder = LineDecoder(encoding=None)
     while running:
         try:
-            message = client_socket.recv(BufferSize)
-            if not message:
+            chunk = client_socket.recv(BufferSize)
+            if not chunk:
                 print("\n[Server closed the connection]")
                 running = False
                 break
-            
-            data = json.loads(message.decode())
-            msg_type = data.get('type')
-            
-            if msg_type == 'request_username':
-                response = json.dumps({'username': Username})
-                client_socket.send(response.encode())
-                
-            elif msg_type == 'system':
-                system_msg = data.get('message')
-                print(f"\n[SYSTEM] {system_msg}")
-                if 'Welcome' in system_msg or 'server' in system_msg.lower():
-                    handshake_complete.set()
-                
-            elif msg_type == 'user_list':
-                online_users = data.get('users', [])
-                print(f"\n[{len(online_users)} users online]")
-                
-            elif msg_type == 'group':
-                if current_chat is None:
-                    sender = data.get('from')
-                    message = data.get('message')
-                    print(f"\n{sender}: {message}")
-                    
-            elif msg_type == 'dm':
-                sender = data.get('from')
-                message = data.get('message')
-                
-                if sender == Username:
-                    recipient = data.get('to')
-                    if current_chat == recipient:
-                        print(f"\nYou: {message}")
-                else:
-                    if current_chat == sender:
-                        print(f"\n{sender}: {message}")
-                    else:
-                        print(f"\n[DM from {sender}]: {message}")
-                        print(f"[Type '/dm {sender}' to reply or go to Main Menu]")
-                        
-            elif msg_type == 'error':
-                print(f"\n[ERROR] {data.get('message')}")
-                
-        except json.JSONDecodeError:
-            print("\n[Error decoding message]")
+
+            if binary:
+                for message, _ in decoder.feed(chunk):
+                    handle_message(message)
+                continue
+
+            # A recv may hold several messages or only part of one
+            lines = decoder.feed(chunk)
+            for i, line in enumerate(lines):
+                if not line.strip():
+                    continue
+                try:
+                    message = json.loads(line)
+                except json.JSONDecodeError:
+                    print("\n[Error decoding message]")
+                    continue
+                if message.get('type') == 'encoding' and message.get('encoding') == binproto.ENCODING_ID:
+                    # Everything after this line is binary, put it back together
+                    rest = lines[i + 1:]
+                    data = (b'\n'.join(rest) + b'\n' if rest else b'') + decoder.pending()
+                    with send_lock:
+                        binary = True
+                    decoder = binproto.Decoder(names={}, learn=True)
+                    for message, _ in decoder.feed(data):
+                        handle_message(message)
+                    break
+                handle_message(message)
+
         except Exception as e:
             if running:
                 print(f"\n[Connection error: {e}]")
@@ -267,6 +420,15 @@ def chat_loop():
                         else:
                             print(f"[User '{target_user}' not found or offline]")
                             
+                elif cmd == '/send':
+                    if current_chat is None:
+                        print("[Files go to one user, start a DM first]")
+                    elif len(command) < 2:
+                        print("[Usage: /send <file>]")
+                    else:
+                        path = user_input.split(None, 1)[1].strip()
+                        threading.Thread(target=send_file, args=(path, current_chat), daemon=True).start()
+
                 else:
                     print(f"[Unknown command: {cmd}]")
                     print("[Type /help for available commands]")
@@ -285,7 +447,7 @@ def chat_loop():
                     'message': user_input
                 }
             
-            client_socket.send(json.dumps(message_data).encode())
+            send_json(message_data)
             
         except KeyboardInterrupt:
             print("\nReturning to menu...")
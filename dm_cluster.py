@@ -0,0 +1,366 @@
+"""Multi-process dm_server: SO_REUSEPORT workers joined by a local hub.
+
+The kernel spreads new connections over N worker processes that all listen
+on the same port, each running the async engine from dm_async. A hub in the
+parent process owns the global state the workers must agree on: who is
+logged in where, and the presence version. Workers talk to it over a Unix
+domain socket.
+
+Every bus line is a JSON header, a tab and, for messages that reach
+clients, the client frame exactly as dm_server encoded it. The hub routes
+on the header alone and forwards the frame bytes untouched, so a group
+message is serialized once in the worker that received it and never again.
+
+    worker -> hub   claim {user, req}            register user, reply claimed {req, ok}
+                    release {user}               user logged out
+                    group {exclude, kind} frame  deliver to every other worker
+                    dm {to, kind[, req]} frame   deliver to the worker that owns `to`, with req
+                                                 reply routed {req, ok}, ok False means mail it
+                    mailed {user}                offline DMs for user were just written
+    hub -> worker   snapshot frame               user_list when the worker connects
+                    presence frame               coalesced presence delta
+                    group / dm frame             forwarded as is
+                    mail {user}                  user is logged in here and has new mail
+
+A DM for a user who isn't on the sender's worker always goes through the
+hub, never by the worker's lagging copy of who is online: the hub either
+forwards it or answers that nobody has the user, and only then is it
+mailed. A user can log in elsewhere between that answer and the mail
+being written, after their login already emptied the mailbox, so the
+sender reports mailed once the store committed and the hub tells the
+user's worker to look again.
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+import dm_async
+import dm_server
+import metrics
+from chatlog import log
+from jsonlines import LineDecoder, MAX_LINE
+from presence import Presence
+
+BUS_NAME = "bus.sock"
+MAX_BUS_LINE = 8 * MAX_LINE  # escaping can make a frame several times its client line
+
+
+def bus_line(header, frame=b''):
+    """One bus line, frame is a client frame ending in a newline or empty"""
+    line = json.dumps(header).encode('utf-8') + b'\t' + frame
+    return line if frame else line + b'\n'
+
+
+def parse_bus_line(line):
+    """Split a bus line from LineDecoder into (header, frame with its newline)"""
+    header, _, frame = line.partition(b'\t')
+    return json.loads(header), frame + b'\n' if frame else b''
+
+
+async def read_bus(reader, decoder):
+    """Next batch of bus lines, [] when the other side went away"""
+    while True:
+        chunk = await reader.read(65536)
+        if not chunk:
+            return []
+        lines = decoder.feed(chunk)
+        if lines:
+            return lines
+
+
+# Hub, runs in the parent process
+
+class Hub:
+    """Username ownership and presence for all workers"""
+
+    def __init__(self, window):
+        self.workers = set()
+        self.owners = {}  # username -> StreamWriter of the worker it is logged in on
+        self.presence = Presence(self.publish_presence, window=window,
+                                 schedule=asyncio.get_running_loop().call_later)
+
+    def publish_presence(self, delta, snapshot):
+        line = bus_line({'op': 'presence'}, dm_server.encode(delta))
+        for worker in self.workers:
+            worker.write(line)
+
+    async def handle_worker(self, reader, writer):
+        self.workers.add(writer)
+        writer.write(bus_line({'op': 'snapshot'}, dm_server.encode(self.presence.snapshot())))
+        decoder = LineDecoder(max_line=MAX_BUS_LINE, encoding=None)
+        try:
+            while True:
+                lines = await read_bus(reader, decoder)
+                if not lines:
+                    break
+                for line in lines:
+                    self.route(writer, line)
+        except (OSError, ValueError) as e:
+            log.error('CLUSTER', "Worker bus error: %s", e)
+        finally:
+            self.workers.discard(writer)
+            # Everyone on a worker that went away is offline
+            for username in [u for u, owner in self.owners.items() if owner is writer]:
+                del self.owners[username]
+                self.presence.left(username)
+            writer.close()
+            log.info('CLUSTER', "Worker disconnected, %d left", len(self.workers))
+
+    def route(self, worker, line):
+        header, _ = parse_bus_line(line)
+        op = header.get('op')
+        line += b'\n'
+
+        if op == 'group':
+            for other in self.workers:
+                if other is not worker:
+                    other.write(line)
+
+        elif op == 'dm':
+            owner = self.owners.get(header.get('to'))
+            if owner is not None:
+                owner.write(line)
+            if 'req' in header:
+                worker.write(bus_line({'op': 'routed', 'req': header['req'], 'ok': owner is not None}))
+
+        elif op == 'mailed':
+            owner = self.owners.get(header.get('user'))
+            if owner is not None:
+                owner.write(bus_line({'op': 'mail', 'user': header.get('user')}))
+
+        elif op == 'claim':
+            username = header.get('user')
+            ok = username not in self.owners
+            if ok:
+                self.owners[username] = worker
+                self.presence.joined(username)
+            worker.write(bus_line({'op': 'claimed', 'req': header.get('req'), 'ok': ok}))
+
+        elif op == 'release':
+            username = header.get('user')
+            if self.owners.get(username) is worker:
+                del self.owners[username]
+                self.presence.left(username)
+
+
+# Worker side
+
+class ClusterPresence:
+    """Stands in for dm_server.presence in a worker.
+
+    Joins are registered by the hub when the username is claimed, leaves are
+    sent to it as releases. The online set here is a replica that follows
+    the hub's deltas, so versions match on every worker.
+    """
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.online = set()
+        self.version = 0
+        self.window = 0
+        self.schedule = None
+
+    def joined(self, username):
+        pass
+
+    def left(self, username):
+        self.bus.release(username)
+
+    def snapshot(self):
+        return {'type': 'user_list', 'users': sorted(self.online), 'version': self.version}
+
+    def load(self, snapshot):
+        self.online = set(snapshot['users'])
+        self.version = snapshot['version']
+
+    def apply(self, delta):
+        self.online.difference_update(delta['user_left'])
+        self.online.update(delta['user_joined'])
+        self.version = delta['version']
+        dm_server.publish_presence(delta, self.snapshot())
+
+
+class BusClient:
+    """A worker's connection to the hub, used from the worker's event loop"""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.presence = ClusterPresence(self)
+        self.claims = {}  # req -> future waiting for the hub's answer
+        self.routes = {}  # req -> callback waiting to hear whether a DM was delivered
+        self.next_req = 0
+
+    def send(self, header, frame=b''):
+        # The hub is local and reads as fast as it can, so writes are left to
+        # the transport buffer instead of awaiting drain() on every message
+        self.writer.write(bus_line(header, frame))
+
+    async def claim(self, username):
+        """True if the hub gave us username, False if it is taken on any worker"""
+        self.next_req += 1
+        future = asyncio.get_running_loop().create_future()
+        self.claims[self.next_req] = future
+        self.send({'op': 'claim', 'user': username, 'req': self.next_req})
+        return await future
+
+    def release(self, username):
+        self.send({'op': 'release', 'user': username})
+
+    def is_online(self, username):
+        return username in self.presence.online
+
+    def broadcast(self, frame, exclude_user=None, kind='group'):
+        self.send({'op': 'group', 'exclude': exclude_user, 'kind': kind}, frame)
+
+    def send_to(self, username, frame, kind='dm'):
+        self.send({'op': 'dm', 'to': username, 'kind': kind}, frame)
+
+    def route_dm(self, username, frame, done):
+        """Have the hub deliver a DM, done(delivered) runs with its answer"""
+        self.next_req += 1
+        self.routes[self.next_req] = done
+        self.send({'op': 'dm', 'to': username, 'kind': 'dm', 'req': self.next_req}, frame)
+
+    def mailed(self, username, written):
+        """Tell the hub about new mail for username once the store's `written` future resolves"""
+        loop = asyncio.get_running_loop()
+        written.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(self.send, {'op': 'mailed', 'user': username}))
+
+    async def collect_mail(self, username):
+        """Deliver mail written after username logged in here and emptied its mailbox"""
+        client = dm_server.clients.get(username)
+        if client is None or not client.authenticated or dm_server.store is None:
+            return
+        frames = await asyncio.wrap_future(dm_server.store.take_mail(username))
+        if dm_server.clients.get(username) is client:
+            dm_server.send_mail(client, username, frames)
+        else:
+            # Gone meanwhile, it waits for the next login
+            for frame in frames:
+                dm_server.store.queue_mail(username, frame)
+
+    async def run(self):
+        decoder = LineDecoder(max_line=MAX_BUS_LINE, encoding=None)
+        while True:
+            lines = await read_bus(self.reader, decoder)
+            if not lines:
+                break
+            for line in lines:
+                header, frame = parse_bus_line(line)
+                self.dispatch(header, frame)
+
+    def dispatch(self, header, frame):
+        op = header.get('op')
+        if op == 'group':
+            dm_server.deliver_frame(frame, header.get('exclude'), header.get('kind', 'group'))
+        elif op == 'dm':
+            delivered = dm_server.deliver_to_user(header.get('to'), frame, header.get('kind', 'dm'))
+            if not delivered and 'req' in header:
+                # Logged out while the DM was on its way, the sender was already told it was sent
+                dm_server.mail(header.get('to'), frame)
+        elif op == 'routed':
+            done = self.routes.pop(header.get('req'), None)
+            if done is not None:
+                done(header.get('ok'))
+        elif op == 'mail':
+            asyncio.ensure_future(self.collect_mail(header.get('user')))
+        elif op == 'presence':
+            self.presence.apply(json.loads(frame))
+        elif op == 'snapshot':
+            self.presence.load(json.loads(frame))
+        elif op == 'claimed':
+            future = self.claims.pop(header.get('req'), None)
+            if future is not None and not future.done():
+                future.set_result(header.get('ok'))
+
+
+async def serve_worker(server_socket, bus_path):
+    reader, writer = await asyncio.open_unix_connection(bus_path)
+    bus = BusClient(reader, writer)
+    dm_server.cluster = bus
+    dm_server.presence = bus.presence
+
+    serving = asyncio.ensure_future(dm_async.serve(server_socket))
+    hub = asyncio.ensure_future(bus.run())
+    # serve() returns once a signal told it to stop and the clients are flushed
+    await asyncio.wait([serving, hub], return_when=asyncio.FIRST_COMPLETED)
+    if hub.done():
+        # Without the hub we can't check usernames or route anything
+        log.error('CLUSTER', "Lost the hub, worker %d exiting", os.getpid())
+        serving.cancel()
+
+
+def worker_main(worker_id, host, port, settings, bus_path):
+    """Entry point of one worker process"""
+    dm_server.queue_options.update(settings['queue_options'])
+    dm_server.admins.update(settings['admins'])
+    log.configure(**settings['log'])
+    dm_server.CompressThreshold = settings['compress_threshold']
+    dm_server.flood.configure(settings['flood_limits'])
+    ping_interval, idle_timeout, dm_server.keepalive_idle = settings['heartbeat']
+    dm_server.reaper.configure(ping_interval, idle_timeout)
+    dm_server.ShutdownTimeout = settings['shutdown_timeout']
+    dm_server.recent.configure(*settings['recent'])
+    if settings['metrics_port']:
+        # One endpoint per worker, scrape them all
+        metrics.serve('127.0.0.1', settings['metrics_port'] + worker_id)
+    if settings['queue_report'] > 0:
+        threading.Thread(target=dm_server.report_queues, args=(settings['queue_report'],), daemon=True).start()
+    if not settings['no_store']:
+        # Ids are reserved in the shared database, so workers never hand out the same one
+        dm_server.store = dm_server.MessageStore(mailbox_limit=settings['mailbox_limit'],
+                                                  mailbox_ttl=settings['mailbox_ttl'])
+
+    server_socket = dm_server.create_server_socket(host, port, reuse_port=True)
+    log.info('CLUSTER', "Worker %d (pid %d) listening", worker_id, os.getpid())
+    try:
+        dm_async.raise_file_limit()
+        asyncio.run(serve_worker(server_socket, bus_path))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    finally:
+        server_socket.close()
+        if dm_server.store is not None:
+            dm_server.store.close()
+        log.close()
+
+
+async def serve_hub(workers, host, port, settings):
+    bus_dir = tempfile.mkdtemp(prefix="sajilo-")
+    bus_path = os.path.join(bus_dir, BUS_NAME)
+    hub = Hub(settings['presence_window'])
+    server = await asyncio.start_unix_server(hub.handle_worker, path=bus_path)
+
+    context = multiprocessing.get_context('spawn')
+    processes = [
+        context.Process(target=worker_main, args=(i, host, port, settings, bus_path), daemon=True)
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    try:
+        async with server:
+            while any(process.is_alive() for process in processes):
+                await asyncio.sleep(1)
+        log.info('CLUSTER', "All workers exited")
+    finally:
+        for process in processes:
+            process.terminate()
+        shutil.rmtree(bus_dir, ignore_errors=True)
+
+
+def run(workers, host, port, settings):
+    """Serve the DM protocol from `workers` processes sharing host:port"""
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        print("[ERROR] --workers needs SO_REUSEPORT, which this platform does not have")
+        return
+    asyncio.run(serve_hub(workers, host, port, settings))
+
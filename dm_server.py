@@ -1,273 +1,1122 @@
+import asyncio
 import socket
+import sqlite3
 import threading
 import json
+import argparse
+import signal
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import binproto
+import compression
+import database
+import filetransfer
+import heartbeat
+import metrics
+import ratelimit
+from chatlog import log, LEVELS, parse_sample
+from outbound import Connection, POLICIES, DROP_OLDEST
+from presence import Presence
+from recent import RecentMessages
+from registry import ClientRegistry
+from jsonlines import LineDecoder, MAX_LINE
+from message_store import MessageStore, GROUP, MAILBOX_LIMIT, MAILBOX_TTL, dm_conversation
 
 IP_address = socket.gethostbyname(socket.gethostname())
 Port = 5050
 BufferSize = 4096  # Increased buffer size
+HandshakeTimeout = 10.0
+ShutdownTimeout = 5.0  # seconds to flush queued frames to clients when stopping
+PresenceWindow = 0.05  # seconds of join/leave activity folded into one presence message
+CompressThreshold = compression.THRESHOLD  # smallest frame deflated for clients that asked
+PackLimit = MAX_LINE // 2  # most bytes of lines in one z line, base64 of their deflate stays under MAX_LINE
+
+# Per-connection outbound queues, see outbound.py
+queue_options = {
+    'max_frames': 1024,
+    'policy': DROP_OLDEST,
+    'block_timeout': 5.0,
+}
+
+REQUEST_USERNAME = b'{"type": "request_username"}\n'
+PING = b'{"type": "ping"}\n'
+PONG = b'{"type": "pong"}\n'
+
+# Per-user and per-IP token buckets, a client over its limit stops being read
+flood = ratelimit.FloodControl()
+
+
+def reap(client):
+    """Disconnect a client that stopped answering pings, its reader then logs it out"""
+    log.info('REAPER', "%s silent too long, disconnecting", client.name)
+    client.abort()
+
+
+# Pings quiet clients and closes dead ones
+reaper = heartbeat.Reaper(close=reap, ping=lambda client: client.send(frame_for(client, PING)))
+keepalive_idle = heartbeat.KEEPALIVE_IDLE
+
+# Metrics, scraped from --metrics-port or read by admins with a stats message
+MESSAGE_TYPES = ('group', 'dm', 'request_users', 'history', 'stats', 'ping', 'pong') + tuple(filetransfer.FILE_TYPES)
+# Flood-control bucket each message type is charged to, the rest go to 'other'
+FLOOD_KINDS = dict({'group': 'group', 'dm': 'dm'}, **{kind: 'file' for kind in filetransfer.FILE_TYPES})
+messages_in = metrics.registry.counter('sajilo_messages_in_total', "Messages received from clients", ('type',))
+messages_out = metrics.registry.counter('sajilo_messages_out_total', "Messages queued for clients", ('type',))
+bytes_in = metrics.registry.counter('sajilo_bytes_in_total', "Bytes read from client sockets")
+bytes_out = metrics.registry.counter('sajilo_bytes_out_total', "Bytes queued for client sockets")
+handshake_failures = metrics.registry.counter('sajilo_handshake_failures_total',
+                                              "Connections that never logged in", ('reason',))
+rejected_usernames = metrics.registry.counter('sajilo_rejected_usernames_total', "Logins refused for a taken name")
+handshake_seconds = metrics.registry.histogram('sajilo_handshake_seconds', "Accept to logged in")
+fanout_seconds = metrics.registry.histogram('sajilo_broadcast_fanout_seconds',
+                                            "Time to queue one broadcast for every local client")
+lock_hold_seconds = metrics.registry.histogram('sajilo_clients_lock_hold_seconds', "Time clients_lock is held")
+lock_wait_seconds = metrics.registry.histogram('sajilo_clients_lock_wait_seconds', "Time spent waiting for clients_lock")
+bytes_saved = metrics.registry.counter('sajilo_compression_saved_bytes_total', "Bytes saved by compressing frames")
+
+clients = ClientRegistry()
+clients_lock = metrics.TimedLock(lock_hold_seconds, lock_wait_seconds)  # joins and leaves only, readers go without
+admins = set()  # usernames allowed to ask for stats, from --admin
+
+cluster = None  # dm_cluster.BusClient when running as one of several worker processes
+
+
+def create_server_socket(host=IP_address, port=Port, backlog=socket.SOMAXCONN, reuse_port=False):
+    """Bind and listen on the chat port, exit if it is already in use"""
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # Let every worker process bind the same port, the kernel balances accepts
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    try:
+        server_socket.bind((host, port))
+        server_socket.listen(backlog)
+    except OSError as e:
+        print(f"Error binding to port: {e}")
+        print("Try closing other instances or wait a minute")
+        exit()
 
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    return server_socket
 
-try:
-    server_socket.bind((IP_address, Port))
-    server_socket.listen()
+
+def print_banner(host, port, mode):
     print("=" * 60)
     print("         SAJILO CHAT SERVER")
     print("=" * 60)
-    print(f"Server is listening on {IP_address}:{Port}")
-    print(f"Use 'localhost' or '{IP_address}' to connect")
+    print(f"Server is listening on {host}:{port} ({mode} mode)")
+    print(f"Use 'localhost' or '{host}' to connect")
     print("Waiting for connections...")
     print("=" * 60)
-except OSError as e:
-    print(f"Error binding to port: {e}")
-    print("Try closing other instances or wait a minute")
-    exit()
 
-clients = {}
-clients_lock = threading.Lock()
+
+def encode(message_data):
+    """Serialize a message into the bytes of one JSON line"""
+    return (json.dumps(message_data) + '\n').encode('utf-8')
+
+
+def count_out(kind, frame, copies=1):
+    messages_out.inc(copies, (kind,))
+    bytes_out.inc(len(frame) * copies)
+
+
+def pack(frame):
+    """frame deflated into {"type": "z"} lines of at most PackLimit bytes of it each.
+
+    A batch such as a mailbox is cut between its lines, one z line for all
+    of it could be longer than the client's LineDecoder accepts.
+    """
+    if len(frame) <= PackLimit:
+        return pack_chunk(frame)
+    lines = []
+    start = 0
+    while start < len(frame):
+        end = start + PackLimit
+        if end < len(frame):
+            cut = frame.rfind(b'\n', start, end)
+            # A single line over the limit goes on its own
+            end = cut + 1 if cut >= start else (frame.find(b'\n', end) + 1 or len(frame))
+        lines.append(pack_chunk(frame[start:end]))
+        start = end
+    return b''.join(lines)
+
+
+def pack_chunk(frame):
+    """frame deflated into one {"type": "z"} line, or frame itself if that is no smaller"""
+    packed = compression.pack_line(frame)
+    if len(packed) >= len(frame):
+        return frame
+    bytes_saved.inc(len(frame) - len(packed))
+    return packed
+
+
+def frame_for(client, frame, packed=None, message=None):
+    """frame as client gets it: binary for clients that chose binproto, compressed when
+    client negotiated compression and frame is big enough, otherwise frame itself.
+
+    packed caches converted frames so a broadcast deflates or encodes each one once.
+    message is the message frame holds, when the caller has it the binary encoder
+    doesn't have to parse frame again.
+    """
+    if client.render is not None:
+        if packed is None:
+            return binproto.Encoded.of(frame, message)
+        key = (binproto.ENCODING_ID, frame)
+        if key not in packed:
+            packed[key] = binproto.Encoded.of(frame, message)
+        return packed[key]
+    if len(frame) < CompressThreshold or not getattr(client, 'compress', False):
+        return frame
+    if packed is None:
+        return pack(frame)
+    if frame not in packed:
+        packed[frame] = pack(frame)
+    return packed[frame]
+
+
+def reply(client, message_data):
+    """Send one message to one client"""
+    frame = encode(message_data)
+    client.send(frame_for(client, frame, message=message_data))
+    count_out(message_data['type'], frame)
 
 
 def broadcast(message_data, exclude_user=None):
     """Send message to all connected clients except exclude_user"""
-    with clients_lock:
-        for username, client in clients.items():
-            if username != exclude_user:
-                try:
-                    json_msg = json.dumps(message_data) + '\n'
-                    client.send(json_msg.encode('utf-8'))
-                except:
-                    pass
+    broadcast_frame(encode(message_data), exclude_user, message_data['type'], message_data)
+
+
+def broadcast_frame(frame, exclude_user=None, kind='group', message=None):
+    """Queue one already encoded frame for every client, the bytes are shared"""
+    if cluster is not None:
+        cluster.broadcast(frame, exclude_user, kind)
+    deliver_frame(frame, exclude_user, kind, message)
+
+
+def deliver_frame(frame, exclude_user=None, kind='group', message=None):
+    """Queue frame for the clients connected to this process only"""
+    with fanout_seconds.time():
+        if kind == 'group':
+            # Kept for whoever logs in next. login() replays the backlog and registers
+            # under the same lock, so it gets this frame from one or the other, once.
+            with recent.lock:
+                current = clients.snapshot()
+                recent.append(frame, kind)
+        else:
+            current = clients.snapshot()
+        # The snapshot stays as it is while we send
+        recipients = [client for username, client in current.items() if username != exclude_user]
+
+        packed = {}
+        for client in recipients:
+            try:
+                client.send(frame_for(client, frame, packed, message))
+            except:
+                pass
+    count_out(kind, frame, len(recipients))
 
 
 def send_to_user(username, message_data):
     """Send message to a specific user"""
+    kind = message_data['type']
+    frame = encode(message_data)
+    if deliver_to_user(username, frame, kind, message_data):
+        return True
+    if cluster is not None and cluster.is_online(username):
+        # Logged in on another worker, the hub routes it there
+        cluster.send_to(username, frame, kind)
+        return True
+    return False
+
+
+def deliver_to_user(username, frame, kind='dm', message=None):
+    """Queue frame for username if it is connected to this process"""
+    client = clients.get(username)
+    if client is None:
+        return False
+    try:
+        if kind == 'file_chunk':
+            # Lower priority lane, chat queued after it still goes first.
+            # Base64 chunks don't deflate, only binary clients get them converted.
+            client.send_bulk(frame if client.render is None else frame_for(client, frame, message=message))
+        else:
+            client.send(frame_for(client, frame, message=message))
+    except:
+        return False
+    count_out(kind, frame)
+    return True
+
+
+def is_online(username):
+    """Whether username is logged in here or, in cluster mode, on any worker"""
+    return username in clients or (cluster is not None and cluster.is_online(username))
+
+
+def queue_stats():
+    """Outbound queue counters for every connected user"""
+    return {username: client.stats() for username, client in clients.items()}
+
+
+def queue_depths():
+    """Total and deepest outbound queue, for the depth gauge"""
+    depths = [s['depth'] for s in queue_stats().values()]
+    return {'total': sum(depths), 'max': max(depths, default=0)}
+
+
+metrics.registry.gauge('sajilo_connected_clients', "Users logged in to this process", lambda: len(clients))
+metrics.registry.gauge('sajilo_threads', "Live threads in this process", threading.active_count)
+metrics.registry.gauge('sajilo_outbound_queue_depth', "Frames waiting in outbound queues", queue_depths, 'stat')
+
+
+def report_queues(interval, top=5):
+    """Print the deepest outbound queues every interval seconds"""
+    while True:
+        time.sleep(interval)
+        stats = queue_stats()
+        deepest = sorted(stats.items(), key=lambda item: item[1]['depth'], reverse=True)[:top]
+        dropped = sum(s['dropped'] for s in stats.values())
+        log.info('QUEUES', "%d clients, %d frames dropped", len(stats), dropped)
+        for username, s in deepest:
+            if s['depth'] or s['dropped']:
+                log.info('QUEUES', "  %s: depth=%d high=%d dropped=%d", username, s['depth'], s['high_water'], s['dropped'])
+
+
+def send_user_list(client):
+    """Send the current versioned user list to one client"""
+    snapshot = presence.snapshot()
+    client.users_version = snapshot['version']
+    reply(client, snapshot)
+
+
+def publish_presence(delta, snapshot):
+    """Fan a coalesced presence change out, as a delta or a full list per client"""
+    recipients = clients.snapshot()
+    log.info('PRESENCE', "v%d joined=%s left=%s", delta['version'], delta['user_joined'], delta['user_left'])
+    delta_frame = encode(delta)
+    snapshot_frame = None
+    snapshots = 0
+    current = 0
+    packed = {}
+    for client in recipients.values():
+        if client.presence_deltas:
+            frame, message = delta_frame, delta
+        elif client.users_version >= snapshot['version']:
+            # Just logged in, its own user_list already shows this
+            current += 1
+            continue
+        else:
+            # Older clients only understand user_list
+            client.users_version = snapshot['version']
+            if snapshot_frame is None:
+                snapshot_frame = encode(snapshot)
+            frame, message = snapshot_frame, snapshot
+            snapshots += 1
+        try:
+            client.send(frame_for(client, frame, packed, message))
+        except:
+            pass
+    count_out('presence', delta_frame, len(recipients) - snapshots - current)
+    if snapshot_frame is not None:
+        count_out('user_list', snapshot_frame, snapshots)
+
+
+presence = Presence(publish_presence, window=PresenceWindow)
+
+recent = RecentMessages()  # group chat backlog sent to users as they log in
+metrics.registry.gauge('sajilo_recent_messages', "Group messages kept to replay on login", lambda: len(recent))
+
+store = None  # MessageStore opened by main(), history is off without one
+
+
+def record(conversation, sender, message, recipient=None):
+    """Store a message in the background, returns its id or None"""
+    if store is None or not isinstance(message, str):
+        return None
+    return store.append(conversation, sender, message, recipient)
+
+
+UnregisteredTTL = 30.0  # seconds a name without an account is taken at its word for DMs
+MAX_UNREGISTERED = 10000
+
+registered = set()  # usernames found in users.db, accounts are never deleted
+unregistered = {}  # username -> time.monotonic() its missing account must be looked up again
+lookups = ThreadPoolExecutor(max_workers=1, thread_name_prefix='users-db')  # one at a time, answered in order
+
+
+def fetch_registered(username):
+    """Whether users.db has an account for username, blocks"""
+    try:
+        return database.get_user(username) is not None
+    except sqlite3.Error:
+        return False  # no users table, nobody registered yet
+
+
+def remember_registered(username, found):
+    if found:
+        registered.add(username)
+        unregistered.pop(username, None)
+        return
+    if len(unregistered) >= MAX_UNREGISTERED:
+        # Made-up names, mostly, the real ones come back soon enough
+        unregistered.clear()
+    unregistered[username] = time.monotonic() + UnregisteredTTL
+
+
+def is_registered(username):
+    """Whether username has an account on the framed protocol, blocks on users.db.
+
+    Never trusts a cached no, a name registered a moment ago must not be
+    up for grabs.
+    """
+    if username in registered:
+        return True
+    found = fetch_registered(username)
+    remember_registered(username, found)
+    return found
+
+
+def when_registered(username, callback):
+    """callback(registered) for username, from the caches or from users.db off the event loop"""
+    if username in registered:
+        callback(True)
+        return
+    if unregistered.get(username, 0) > time.monotonic():
+        callback(False)
+        return
+
+    def done(future):
+        # Remembered here and not on the lookup thread, so DMs behind it see it in order
+        found = future.result()
+        remember_registered(username, found)
+        callback(found)
+    when_done(lookups.submit(fetch_registered, username), done)
+
+
+def token_user(token):
+    """Username a session token from the framed protocol was issued to, or None"""
+    if not isinstance(token, str) or not token:
+        return None
+    try:
+        import auth  # jwt and bcrypt, only loaded once someone sends a token
+    except ImportError as e:
+        log.warning('AUTH', "Can't check session tokens: %s", e)
+        return None
+    verified = auth.verify_token(token)
+    return verified[0] if verified else None
+
+
+def authorize(username, options):
+    """(allowed, authenticated) for a login without a password, blocks on users.db"""
+    if token_user(options.get('token')) == username:
+        return True, True
+    # A registered name belongs to whoever has its password, not to the first to type it
+    return not is_registered(username), False
+
+
+def can_queue(recipient):
+    """Whether a DM for an offline recipient could wait in a mailbox, mail() checks the account"""
+    # Logins strip the username, so a padded or empty name could never collect it
+    return store is not None and isinstance(recipient, str) and recipient != '' and recipient == recipient.strip()
+
+
+def mail(recipient, frame, done=None):
+    """Queue frame in recipient's mailbox if it can have one, then done(queued)"""
+    if not can_queue(recipient):
+        if done is not None:
+            done(False)
+        return
+
+    def queue(found):
+        if found:
+            store.queue_mail(recipient, frame)
+            if cluster is not None:
+                # recipient may have logged in on another worker meanwhile, the hub tells it to look again
+                cluster.mailed(recipient, store.synced())
+        if done is not None:
+            done(found)
+    # Only a session that proves the name collects its mail, so it needs an account
+    when_registered(recipient, queue)
+
+
+def send_mail(client, username, frames):
+    """Send every DM that waited in the mailbox as one write"""
+    if frames:
+        batch = b''.join(frames)
+        client.send(frame_for(client, batch))
+        messages_out.inc(len(frames), ('dm',))
+        bytes_out.inc(len(batch))
+        log.info('MAILBOX', "Delivered %d offline messages to %s", len(frames), username)
+
+
+def replay_recent(client):
+    """Send the group chat backlog as one write"""
+    batch, records = recent.backlog()
+    if records:
+        client.send(frame_for(client, batch))
+        for record in records:
+            messages_out.inc(1, (record.kind,))
+        bytes_out.inc(len(batch))
+
+
+def deliver_mail(client, username):
+    """Flush username's mailbox after login, blocks until the store answers"""
+    if store is not None and client.authenticated:
+        send_mail(client, username, store.take_mail(username).result())
+
+
+def when_done(future, callback):
+    """callback(future) once a store future resolves, on the event loop when called from one"""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # A client's own thread, it can wait
+        future.result()
+        callback(future)
+        return
+    future.add_done_callback(lambda done: loop.call_soon_threadsafe(callback, done))
+
+
+def send_history(client, username, message_data):
+    """Reply with one page of the group chat or of a DM conversation"""
+    peer = message_data.get('with')
+    if peer and not client.authenticated:
+        # Anyone can claim a free name, only a session token shows it is theirs
+        reply(client, {'type': 'error', 'message': 'DM history needs a session token'})
+        return
+    if store is None:
+        reply_history(client, peer, [])
+        return
+
+    try:
+        conversation = dm_conversation(username, peer) if peer else GROUP
+        page = store.history(conversation, message_data.get('before'), message_data.get('limit', 50))
+    except (TypeError, ValueError):
+        reply(client, {'type': 'error', 'message': 'Invalid history request'})
+        return
+    when_done(page, lambda done: reply_history(client, peer, done.result()))
+
+
+def reply_history(client, peer, rows):
+    if client.closed:
+        return
+    messages = [
+        {'id': message_id, 'from': sender, 'to': recipient, 'message': body, 'time': created}
+        for message_id, sender, recipient, body, created in rows
+    ]
+    # The page has to fit in one line of the client's LineDecoder, the oldest messages give way
+    size = len(encode({'type': 'history', 'with': peer, 'messages': []}))
+    sizes = [len(json.dumps(message)) + 2 for message in messages]
+    total = size + sum(sizes)
+    dropped = 0
+    while total > MAX_LINE and dropped < len(messages):
+        total -= sizes[dropped]
+        dropped += 1
+    reply(client, {'type': 'history', 'with': peer, 'messages': messages[dropped:]})
+
+
+def send_stats(client, username):
+    """Reply with every metric, for admins connected from this machine"""
+    if username not in admins or client.address not in ('127.0.0.1', '::1'):
+        reply(client, {'type': 'error', 'message': 'Not allowed'})
+        log.warning('ERROR', "%s asked for stats without admin rights", username)
+        return
+    stats = metrics.registry.snapshot()
+    stats['queues'] = queue_stats()
+    reply(client, {'type': 'stats', 'metrics': stats})
+
+
+def relay_file(client, username, message_type, message_data):
+    """Pass a file transfer message on to the other side, one chunk at a time"""
+    recipient = message_data.get('to')
+    try:
+        fields = filetransfer.relay_fields(message_type, message_data)
+    except ValueError as e:
+        reply(client, {'type': 'error', 'message': str(e)})
+        return
+
+    if message_type == 'file_offer':
+        log.info('FILE', "%s -> %s: %s (%d bytes)", username, recipient, fields['name'], fields['size'])
+    if not send_to_user(recipient, {'type': message_type, 'from': username, **fields}):
+        # The sender pauses and can offer again to resume once they are back
+        reply(client, {'type': 'file_cancel', 'from': recipient, 'id': fields['id'], 'reason': 'offline'})
+
+
+def send_dm(client, username, recipient, message, registered):
+    """Deliver, route or mail one DM, registered says whether recipient has an account"""
+    dm_data = {
+        'type': 'dm',
+        'from': username,
+        'message': message
+    }
+    if is_online(recipient) or registered:
+        message_id = record(dm_conversation(username, recipient), username, message, recipient)
+        if message_id is not None:
+            dm_data['id'] = message_id
+
+    frame = encode(dm_data)
+    if deliver_to_user(recipient, frame, 'dm', dm_data):
+        confirm_dm(client, username, recipient, dm_data, frame, True)
+    elif cluster is not None:
+        # Only the hub knows whether recipient is logged in on another worker right now
+        cluster.route_dm(recipient, frame,
+                         lambda delivered: confirm_dm(client, username, recipient, dm_data, frame, delivered))
+    else:
+        confirm_dm(client, username, recipient, dm_data, frame, False)
+
+
+def confirm_dm(client, username, recipient, dm_data, frame, delivered):
+    """Mail a DM nobody took and tell its sender whether it was sent, queued or refused"""
+    if delivered:
+        reply_dm(client, username, recipient, dm_data, 'sent')
+    else:
+        mail(recipient, frame, lambda queued: reply_dm(client, username, recipient, dm_data, queued and 'queued'))
+
+
+def reply_dm(client, username, recipient, dm_data, outcome):
+    """Tell the sender its DM was 'sent' or 'queued', or refused when outcome is false"""
+    confirmation = {
+        'type': 'dm',
+        'from': username,
+        'to': recipient,
+        'message': dm_data['message']
+    }
+    if 'id' in dm_data:
+        confirmation['id'] = dm_data['id']
+    if outcome == 'sent':
+        confirmation['sent'] = True
+        log.info('DM', "%s -> %s: %s", username, recipient, dm_data['message'])
+    elif outcome == 'queued':
+        # Offline, it goes out with the rest of the mailbox at next login
+        confirmation['queued'] = True
+        log.info('QUEUED', "%s -> %s (offline): %s", username, recipient, dm_data['message'])
+    else:
+        confirmation = {
+            'type': 'error',
+            'message': f'User {recipient} not found or offline'
+        }
+        log.info('ERROR', "%s tried to DM offline user: %s", username, recipient)
+    if not client.closed:
+        # In cluster mode the hub's answer can come after the sender left
+        reply(client, confirmation)
+
+
+def process_message(client, username, message_data):
+    """Dispatch one decoded message from username"""
+    message_type = message_data.get('type')
+    messages_in.inc(1, (message_type if message_type in MESSAGE_TYPES else 'other',))
+
+    if message_type == 'group':
+        broadcast_data = {
+            'type': 'group',
+            'from': username,
+            'message': message_data.get('message')
+        }
+        message_id = record(GROUP, username, message_data.get('message'))
+        if message_id is not None:
+            broadcast_data['id'] = message_id
+        broadcast(broadcast_data)
+        log.info('GROUP', "%s: %s", username, message_data.get('message'))
+
+    elif message_type == 'dm':
+        recipient = message_data.get('to')
+        message = message_data.get('message')
+        if can_queue(recipient) and not is_online(recipient):
+            # Whether it can be kept depends on an account, the answer is cached
+            # so mailing it further on doesn't ask users.db a second time
+            when_registered(recipient, lambda found: send_dm(client, username, recipient, message, found))
+        else:
+            send_dm(client, username, recipient, message, False)
+
+    elif message_type == 'request_users':
+        send_user_list(client)
+
+    elif message_type == 'ping':
+        client.send(frame_for(client, PONG))
+
+    elif message_type == 'pong':
+        pass  # reading it already counted as activity
+
+    elif message_type == 'history':
+        send_history(client, username, message_data)
+
+    elif message_type == 'stats':
+        send_stats(client, username)
+
+    elif message_type in filetransfer.FILE_TYPES:
+        relay_file(client, username, message_type, message_data)
+
+
+def process_line(client, username, line):
+    """Decode one JSON line from username and dispatch it.
+
+    Returns how many seconds to stop reading from the client to keep it
+    within its flood limits, 0 when it is not over them.
+    """
+    if not line.strip():
+        return 0
+
+    try:
+        message_data = json.loads(line)
+    except json.JSONDecodeError as e:
+        log.warning('ERROR', "JSON decode error from %s: %s", username, e)
+        log.debug('ERROR', "Problematic data: %s", line)
+        return client.throttle.charge('other', len(line))
+
+    return dispatch(client, username, message_data, len(line))
+
+
+def process_decoded(client, username, decoded):
+    """process_line() for a (message, frame size) pair from binproto.Decoder"""
+    message_data, size = decoded
+    return dispatch(client, username, message_data, size)
+
+
+def dispatch(client, username, message_data, size):
+    """Charge a decoded message of size bytes to the flood limits and process it"""
+    if not isinstance(message_data, dict):
+        return client.throttle.charge('other', size)
+
+    message_type = message_data.get('type')
+    delay = client.throttle.charge(FLOOD_KINDS.get(message_type, 'other'), size)
+    process_message(client, username, message_data)
+    if delay:
+        log.debug('THROTTLE', "%s over its %s limit, pausing reads for %.3fs", username, message_type, delay)
+    return delay
+
+
+def parse_handshake(line):
+    """Return (username, handshake data) from a handshake line, or (None, None)"""
+    message = line.strip()
+    log.debug('DEBUG', "Received: %s", message)
+
+    username_data = json.loads(message)
+    log.debug('DEBUG', "Parsed: %s", username_data)
+
+    if not isinstance(username_data, dict):
+        log.warning('ERROR', "Unexpected type: %s", type(username_data))
+        return None, None
+
+    username = str(username_data.get('username', '')).strip()
+    if not username:
+        log.warning('ERROR', "Empty username")
+        return None, None
+
+    log.debug('DEBUG', "Username: '%s'", username)
+    return username, username_data
+
+
+def reject_taken(client, username):
+    """Tell client its username is in use"""
+    reply(client, {
+        'type': 'error',
+        'message': 'Username already taken'
+    })
+    rejected_usernames.inc()
+    log.info('REJECTED', "Username '%s' already taken", username)
+
+
+def reject_registered(client, username):
+    """Tell client its username belongs to an account it didn't log in to"""
+    reply(client, {
+        'type': 'error',
+        'message': 'Username is registered, log in with its password or a session token'
+    })
+    rejected_usernames.inc()
+    log.info('REJECTED', "Username '%s' is registered and no valid token came with it", username)
+
+
+def login(client, username, options=None, authenticated=False):
+    """Register client under username and announce it, False if the name is taken.
+
+    authenticated says a password or token for username was checked, see
+    authorize(). Only those sessions are given the offline mailbox.
+    """
+    options = options or {}
+    client.authenticated = authenticated
+    # Clients opt in to presence deltas, anything else keeps getting user_list
+    client.presence_deltas = options.get('presence') == 'delta'
+    # Compression is opt-in too, by naming the shared dictionary
+    client.compress = options.get('compress') == compression.DICTIONARY_ID
+    if options.get('encoding') == binproto.ENCODING_ID:
+        # The last JSON it gets, before anyone can find it in clients and send it binary
+        client.send(binproto.ACCEPTED)
+        client.render = binproto.Renderer()
+
     with clients_lock:
         if username in clients:
-            try:
-                json_msg = json.dumps(message_data) + '\n'
-                clients[username].send(json_msg.encode('utf-8'))
-                return True
-            except:
-                return False
-        return False
+            reject_taken(client, username)
+            return False
+
+        with recent.lock:
+            # Before it is registered, so the backlog goes out ahead of anything live
+            replay_recent(client)
+            register(client, username)
+        presence.joined(username)
+
+    log.info('LOGIN', "✓ %s logged in", username)
+
+    # Send welcome
+    reply(client, {
+        'type': 'system',
+        'message': f'Welcome to the server, {username}!'
+    })
+
+    # Notify others
+    broadcast({
+        'type': 'system',
+        'message': f'{username} joined the chat'
+    }, exclude_user=username)
 
+    # Send user list, later changes arrive as presence deltas
+    send_user_list(client)
+    return True
 
-def send_user_list():
-    """Send updated user list to all clients"""
+
+def register(client, username):
+    """Add client to the registry under username. Caller holds clients_lock."""
+    client.name = username
+    client.users_version = 0  # of the last user_list it was sent
+    client.throttle = flood.attach(username, client.address)
+    reaper.watch(client)
+    # Last, readers see it as soon as it is in
+    clients.add(username, client)
+
+
+def adopt(client, username, presence_deltas, compress, known_users=None, authenticated=False):
+    """Register a client taken over from the previous server process, which already announced it.
+
+    known_users are the binproto user ids a binary client has learned, None for JSON clients.
+    """
+    client.authenticated = authenticated
+    client.presence_deltas = presence_deltas
+    client.compress = compress
+    if known_users is not None:
+        client.render = binproto.Renderer(known_users)
     with clients_lock:
-        user_list = list(clients.keys())
-    
-    message_data = {
-        'type': 'user_list',
-        'users': user_list
+        register(client, username)
+
+
+def start_session(client, username, options=None, authenticated=False):
+    """authorize() and login() a client that gave its username, False if it was turned away.
+
+    Blocks on users.db, dm_async.start_session() is the event loop's version.
+    """
+    if not authenticated:
+        allowed, authenticated = authorize(username, options or {})
+        if not allowed:
+            reject_registered(client, username)
+            return False
+    return login(client, username, options, authenticated)
+
+
+def logout(client, username):
+    """Remove username from the registry and tell everyone it left, once"""
+    with clients_lock:
+        if not clients.remove(username, client):
+            # Never logged in, or already gone
+            return
+        presence.left(username)
+        log.info('DISCONNECT', "%s disconnected", username)
+    client.throttle.release()
+    reaper.unwatch(client)
+
+    disconnect_data = {
+        'type': 'system',
+        'message': f'{username} left the chat'
     }
-    print(f"[USER_LIST] Broadcasting: {user_list}")
-    broadcast(message_data)
+    broadcast(disconnect_data)
+
+
+def handle(client, username, decoder, lines=()):
+    """Handle messages from a client, starting with lines left over from the handshake"""
+    deliver_mail(client, username)
+
+    delay = 0
+    for line in lines:
+        if delay:
+            time.sleep(delay)
+        delay = process_line(client, username, line)
 
+    process = process_line
+    if client.render is not None:
+        # Binary from here on, the client waited for our answer to switch
+        decoder = binproto.Decoder(data=decoder.pending())
+        process = process_decoded
 
-def handle(client, username):
-    """Handle messages from a client"""
-    buffer = ""
-    
     while True:
         try:
+            if delay:
+                # Over its limit: leave the rest in the socket, TCP pushes back on the sender
+                time.sleep(delay)
             chunk = client.recv(BufferSize)
             if not chunk:
-                print(f"[INFO] {username} connection closed")
+                log.info('INFO', "%s connection closed", username)
                 break
-            
-            buffer += chunk.decode('utf-8')
-            
+            bytes_in.inc(len(chunk))
+            reaper.touch(client)
+
             # Process complete messages (separated by newlines)
-            while '\n' in buffer:
-                line, buffer = buffer.split('\n', 1)
-                if not line.strip():
-                    continue
-                
-                try:
-                    message_data = json.loads(line)
-                    message_type = message_data.get('type')
-                    
-                    if message_type == 'group':
-                        broadcast_data = {
-                            'type': 'group',
-                            'from': username,
-                            'message': message_data.get('message')
-                        }
-                        broadcast(broadcast_data)
-                        print(f"[GROUP] {username}: {message_data.get('message')}")
-                        
-                    elif message_type == 'dm':
-                        recipient = message_data.get('to')
-                        dm_data = {
-                            'type': 'dm',
-                            'from': username,
-                            'message': message_data.get('message')
-                        }
-                        
-                        if send_to_user(recipient, dm_data):
-                            # Send confirmation back to sender
-                            confirmation = {
-                                'type': 'dm',
-                                'from': username,
-                                'to': recipient,
-                                'message': message_data.get('message'),
-                                'sent': True
-                            }
-                            json_msg = json.dumps(confirmation) + '\n'
-                            client.send(json_msg.encode('utf-8'))
-                            print(f"[DM] {username} -> {recipient}: {message_data.get('message')}")
-                        else:
-                            error_data = {
-                                'type': 'error',
-                                'message': f'User {recipient} not found or offline'
-                            }
-                            json_msg = json.dumps(error_data) + '\n'
-                            client.send(json_msg.encode('utf-8'))
-                            print(f"[ERROR] {username} tried to DM offline user: {recipient}")
-                            
-                    elif message_type == 'request_users':
-                        send_user_list()
-                        
-                except json.JSONDecodeError as e:
-                    print(f"[ERROR] JSON decode error from {username}: {e}")
-                    print(f"[ERROR] Problematic data: {line}")
-                    
+            delay = 0
+            for line in decoder.feed(chunk):
+                if delay:
+                    time.sleep(delay)
+                delay = process(client, username, line)
+
         except Exception as e:
-            print(f"[ERROR] Error handling {username}: {e}")
+            log.warning('ERROR', "Error handling %s: %s", username, e)
             break
-    
+
     # Cleanup
-    with clients_lock:
-        if username in clients:
-            del clients[username]
-            print(f"[DISCONNECT] {username} disconnected")
-    
-    disconnect_data = {
-        'type': 'system',
-        'message': f'{username} left the chat'
-    }
-    broadcast(disconnect_data)
-    send_user_list()
-    
+    logout(client, username)
+
     try:
         client.close()
     except:
         pass
 
 
-def receive():
+def close_all(timeout):
+    """Flush what is queued for every client, all within timeout seconds, and close them"""
+    deadline = time.monotonic() + timeout
+    connections = clients.values()
+    # Every writer thread keeps flushing while we wait on the first ones
+    for client in connections:
+        client.close(drain_timeout=max(0.0, deadline - time.monotonic()))
+
+
+def stop(signum, frame):
+    """SIGTERM handler, stops the threaded server the way Ctrl-C does"""
+    raise KeyboardInterrupt
+
+
+def receive(server_socket):
     """Accept new client connections"""
     while True:
         try:
-            client, address = server_socket.accept()
-            print(f"\n[CONNECTION] New connection from {address[0]}:{address[1]}")
-            
+            sock, address = server_socket.accept()
+            accepted = time.perf_counter()
+            heartbeat.set_keepalive(sock, keepalive_idle)
+            client = Connection(sock, f"{address[0]}:{address[1]}", **queue_options)
+            client.address = address[0]
+            log.info('CONNECTION', "New connection from %s:%s", address[0], address[1])
+
             # Send username request
-            json_msg = json.dumps({'type': 'request_username'}) + '\n'
-            client.send(json_msg.encode('utf-8'))
-            print(f"[DEBUG] Sent username request")
-            
+            client.send(REQUEST_USERNAME)
+            log.debug('DEBUG', "Sent username request")
+
             # Receive username with timeout
-            client.settimeout(10.0)
-            
+            client.settimeout(HandshakeTimeout)
+
             try:
-                data = b''
-                while b'\n' not in data:
+                decoder = LineDecoder()
+                lines = []
+                while not lines:
                     chunk = client.recv(1024)
                     if not chunk:
-                        print(f"[ERROR] Client disconnected during handshake")
+                        log.warning('ERROR', "Client disconnected during handshake")
+                        handshake_failures.inc(1, ('closed',))
                         client.close()
                         break
-                    data += chunk
-                
-                if b'\n' not in data:
-                    continue
-                
-                message = data.decode('utf-8').strip()
-                print(f"[DEBUG] Received: {message}")
-                
-                username_data = json.loads(message)
-                print(f"[DEBUG] Parsed: {username_data}")
-                
-                if isinstance(username_data, dict):
-                    username = username_data.get('username', '').strip()
-                else:
-                    print(f"[ERROR] Unexpected type: {type(username_data)}")
-                    client.close()
+                    bytes_in.inc(len(chunk))
+                    lines = decoder.feed(chunk)
+
+                if not lines:
                     continue
-                
-                if not username:
-                    print(f"[ERROR] Empty username")
+
+                username, options = parse_handshake(lines[0])
+                if not username or not start_session(client, username, options):
+                    handshake_failures.inc(1, ('taken' if username else 'invalid',))
                     client.close()
                     continue
-                
-                print(f"[DEBUG] Username: '{username}'")
-                
-                # Check if username taken
-                with clients_lock:
-                    if username in clients:
-                        error = json.dumps({
-                            'type': 'error',
-                            'message': 'Username already taken'
-                        }) + '\n'
-                        client.send(error.encode('utf-8'))
-                        client.close()
-                        print(f"[REJECTED] Username '{username}' already taken")
-                        continue
-                    
-                    clients[username] = client
-                
+
                 client.settimeout(None)
-                
-                print(f"[LOGIN] ✓ {username} logged in")
-                
-                # Send welcome
-                welcome = json.dumps({
-                    'type': 'system',
-                    'message': f'Welcome to the server, {username}!'
-                }) + '\n'
-                client.send(welcome.encode('utf-8'))
-                
-                # Notify others
-                broadcast({
-                    'type': 'system',
-                    'message': f'{username} joined the chat'
-                }, exclude_user=username)
-                
-                # Send user list
-                send_user_list()
-                
+                handshake_seconds.observe(time.perf_counter() - accepted)
+
                 # Start handler
-                thread = threading.Thread(target=handle, args=(client, username), daemon=True)
+                thread = threading.Thread(target=handle, args=(client, username, decoder, lines[1:]), daemon=True)
                 thread.start()
-                
+
             except socket.timeout:
-                print(f"[ERROR] Timeout waiting for username")
+                log.warning('ERROR', "Timeout waiting for username")
+                handshake_failures.inc(1, ('timeout',))
                 client.close()
             except json.JSONDecodeError as e:
-                print(f"[ERROR] JSON error: {e}")
+                log.warning('ERROR', "JSON error: %s", e)
+                handshake_failures.inc(1, ('invalid',))
                 client.close()
             except Exception as e:
-                print(f"[ERROR] Handshake error: {e}")
-                import traceback
-                traceback.print_exc()
+                log.error('ERROR', "Handshake error: %s\n%s", e, traceback.format_exc())
+                handshake_failures.inc(1, ('error',))
                 client.close()
-                
+
         except KeyboardInterrupt:
             print("\n[SHUTDOWN] Server shutting down...")
             break
         except Exception as e:
-            print(f"[ERROR] Accept error: {e}")
-            import traceback
-            traceback.print_exc()
+            log.error('ERROR', "Accept error: %s\n%s", e, traceback.format_exc())
 
 
-if __name__ == "__main__":
+def main():
+    global store, CompressThreshold, keepalive_idle, ShutdownTimeout
+
+    parser = argparse.ArgumentParser(description="Sajilo Chat DM server")
+    parser.add_argument('--mode', choices=['threaded', 'async'], default='threaded',
+                        help="threaded: one thread per client, async: one asyncio event loop")
+    parser.add_argument('--host', default=IP_address)
+    parser.add_argument('--port', type=int, default=Port)
+    parser.add_argument('--queue-size', type=int, default=queue_options['max_frames'],
+                        help="frames buffered per client before the slow-consumer policy applies")
+    parser.add_argument('--slow-consumer', choices=POLICIES, default=queue_options['policy'])
+    parser.add_argument('--block-timeout', type=float, default=queue_options['block_timeout'],
+                        help="seconds a sender waits on a full queue with --slow-consumer block")
+    parser.add_argument('--presence-window', type=float, default=PresenceWindow,
+                        help="seconds of joins/leaves coalesced into one presence message")
+    parser.add_argument('--no-store', action='store_true',
+                        help="don't keep message history in the SQLite store")
+    parser.add_argument('--mailbox-limit', type=int, default=MAILBOX_LIMIT,
+                        help="DMs kept for an offline user, the oldest are dropped first")
+    parser.add_argument('--mailbox-ttl', type=float, default=MAILBOX_TTL,
+                        help="seconds a DM waits for an offline user")
+    parser.add_argument('--recent-messages', type=int, default=recent.max_messages,
+                        help="group messages kept in memory and replayed on login, 0 for none")
+    parser.add_argument('--recent-bytes', type=int, default=recent.max_bytes,
+                        help="most bytes of group messages kept for replay")
+    parser.add_argument('--compress-threshold', type=int, default=CompressThreshold,
+                        help="bytes from which frames are deflated for clients that negotiated it")
+    parser.add_argument('--queue-report', type=float, default=0,
+                        help="print the deepest outbound queues every N seconds")
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help="serve Prometheus metrics on 127.0.0.1:PORT/metrics, 0 to disable")
+    parser.add_argument('--admin', action='append', default=[],
+                        help="username that may send a stats message from this machine, repeatable")
+    parser.add_argument('--log-level', choices=LEVELS, default='info',
+                        help="debug adds the per-handshake lines")
+    parser.add_argument('--log-format', choices=['text', 'json'], default='text',
+                        help="json writes one structured record per line")
+    parser.add_argument('--log-queue', type=int, default=10000,
+                        help="log records buffered before new ones are dropped")
+    parser.add_argument('--log-sample', action='append', default=[], metavar='CATEGORY=N',
+                        help="keep one in N records of a category, e.g. GROUP=100, repeatable")
+    parser.add_argument('--flood-limit', action='append', default=[], metavar='SCOPE.KIND=MSGS/BYTES',
+                        help="per-second limit, SCOPE user or ip, KIND group, dm, file or other, "
+                             "e.g. ip.group=100/262144, none for no limit, repeatable")
+    parser.add_argument('--ping-interval', type=float, default=heartbeat.PING_INTERVAL,
+                        help="seconds of silence before a client is pinged")
+    parser.add_argument('--idle-timeout', type=float, default=heartbeat.IDLE_TIMEOUT,
+                        help="seconds of silence before a client is disconnected, 0 to never")
+    parser.add_argument('--keepalive-idle', type=int, default=heartbeat.KEEPALIVE_IDLE,
+                        help="seconds before TCP keepalive probes start, 0 to leave keepalive off")
+    parser.add_argument('--shutdown-timeout', type=float, default=ShutdownTimeout,
+                        help="seconds to flush queued messages to clients when stopping")
+    parser.add_argument('--handoff-socket', metavar='PATH',
+                        help="Unix socket where a new server process can take over the port and every connection")
+    parser.add_argument('--takeover', metavar='PATH',
+                        help="take over from the server on this handoff socket instead of binding the port")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="async worker processes sharing the port through SO_REUSEPORT")
+    args = parser.parse_args()
+    try:
+        flood_limits = ratelimit.parse_limits(args.flood_limit)
+        log_sample = parse_sample(args.log_sample)
+    except ValueError as e:
+        parser.error(str(e))
+    if (args.handoff_socket or args.takeover) and (args.mode != 'async' or args.workers > 1):
+        # Threaded readers sit in recv() with no way to park them, so only the event loop can let go
+        parser.error("--handoff-socket and --takeover need --mode async and a single worker")
+
+    queue_options.update(
+        max_frames=args.queue_size,
+        policy=args.slow_consumer,
+        block_timeout=args.block_timeout,
+    )
+    presence.window = args.presence_window
+    recent.configure(args.recent_messages, args.recent_bytes)
+    admins.update(args.admin)
+    CompressThreshold = args.compress_threshold
+    flood.configure(flood_limits)
+    reaper.configure(args.ping_interval, args.idle_timeout)
+    keepalive_idle = args.keepalive_idle
+    ShutdownTimeout = args.shutdown_timeout
+    log_options = {
+        'level': LEVELS[args.log_level],
+        'structured': args.log_format == 'json',
+        'max_records': args.log_queue,
+        'sample': log_sample,
+    }
+    log.configure(**log_options)
+
+    if args.workers > 1:
+        import dm_cluster
+        print_banner(args.host, args.port, f'{args.workers} async workers')
+        try:
+            dm_cluster.run(args.workers, args.host, args.port, {
+                'queue_options': dict(queue_options),
+                'presence_window': args.presence_window,
+                'queue_report': args.queue_report,
+                'no_store': args.no_store,
+                'mailbox_limit': args.mailbox_limit,
+                'mailbox_ttl': args.mailbox_ttl,
+                'metrics_port': args.metrics_port,
+                'admins': args.admin,
+                'log': log_options,
+                'compress_threshold': args.compress_threshold,
+                'flood_limits': flood_limits,
+                'heartbeat': (args.ping_interval, args.idle_timeout, args.keepalive_idle),
+                'shutdown_timeout': args.shutdown_timeout,
+                'recent': (args.recent_messages, args.recent_bytes),
+            })
+        except KeyboardInterrupt:
+            print("\n[SHUTDOWN] Server stopped")
+        finally:
+            log.close()
+        return
+
+    if args.queue_report > 0:
+        threading.Thread(target=report_queues, args=(args.queue_report,), daemon=True).start()
+
+    if args.mode != 'async':
+        reaper.start()
+
+    if args.metrics_port:
+        metrics.serve('127.0.0.1', args.metrics_port)
+        print(f"[INFO] Metrics on http://127.0.0.1:{args.metrics_port}/metrics")
+
+    takeover = None
+    if args.takeover:
+        import dm_async
+        server_socket, takeover = dm_async.take_over(args.takeover)
+    else:
+        server_socket = create_server_socket(args.host, args.port)
+
+    if not args.no_store:
+        # After a takeover, so the old process has stopped taking messages by now
+        store = MessageStore(mailbox_limit=args.mailbox_limit, mailbox_ttl=args.mailbox_ttl)
+    print_banner(args.host, args.port, args.mode)
+
     try:
-        receive()
+        if args.mode == 'async':
+            import dm_async
+            if dm_async.run(server_socket, args.handoff_socket, takeover):
+                print("[SHUTDOWN] Handed over to the new server process")
+            else:
+                print("\n[SHUTDOWN] Server stopped")
+        else:
+            signal.signal(signal.SIGTERM, stop)
+            receive(server_socket)
     except KeyboardInterrupt:
         print("\n[SHUTDOWN] Server stopped")
     finally:
-        server_socket.close()
\ No newline at end of file
+        server_socket.close()
+        if args.mode != 'async':
+            close_all(ShutdownTimeout)
+        if store is not None:
+            store.close()
+        log.close()
+
+
+if __name__ == "__main__":
+    # Go through the importable module so dm_async shares the same registry
+    import dm_server
+    dm_server.main()
@@ -0,0 +1,192 @@
+"""Chunked file transfer over the DM protocol.
+
+The server only relays these messages between two users, stamping `from`
+on the way, so no file is ever held whole in its memory and a transfer
+survives either side reconnecting:
+
+    sender -> recipient   file_offer  {to, id, name, size, chunk_size}
+                          file_chunk  {to, id, seq, data}     data is base64
+    recipient -> sender   file_accept {to, id, from_chunk, window}
+                          file_ack    {to, id, seq}           chunks up to seq are written
+    either way            file_cancel {to, id, reason}
+
+The sender keeps at most `window` chunks beyond the last ack in flight.
+To resume, it offers the same id again and the recipient accepts from the
+first chunk missing from its .part file. Chunks travel in a lower priority
+lane of the recipient's outbound queue, so chat frames never wait behind
+more than one of them.
+"""
+import base64
+import hashlib
+import os
+import threading
+
+CHUNK_SIZE = 16 * 1024
+MAX_CHUNK = 32 * 1024  # largest chunk_size the server relays
+WINDOW = 8  # chunks a recipient lets the sender have unacknowledged
+MAX_WINDOW = 64
+ID_LENGTH = 40  # transfer ids are sha1 hex digests
+ACK_TIMEOUT = 30  # seconds a sender waits for the recipient before giving up
+DOWNLOAD_DIR = "downloads"
+
+# Fields each message must carry besides `to` and `id`, with their types
+FILE_TYPES = {
+    'file_offer': {'name': str, 'size': int, 'chunk_size': int},
+    'file_accept': {'from_chunk': int, 'window': int},
+    'file_chunk': {'seq': int, 'data': str},
+    'file_ack': {'seq': int},
+    'file_cancel': {'reason': str},
+}
+MAX_CHUNK_TEXT = (MAX_CHUNK + 2) // 3 * 4
+
+
+def relay_fields(message_type, message_data):
+    """The fields of a file_* message to pass on, ValueError if it is malformed"""
+    transfer_id = message_data.get('id')
+    if (not isinstance(transfer_id, str) or len(transfer_id) != ID_LENGTH
+            or transfer_id.strip('0123456789abcdef')):
+        raise ValueError("Bad transfer id")
+    fields = {'id': transfer_id}
+    for name, kind in FILE_TYPES[message_type].items():
+        value = message_data.get(name)
+        if not isinstance(value, kind) or isinstance(value, bool):
+            raise ValueError(f"{message_type} needs {name}")
+        fields[name] = value
+    if message_type == 'file_chunk' and len(fields['data']) > MAX_CHUNK_TEXT:
+        raise ValueError(f"Chunks are at most {MAX_CHUNK} bytes")
+    if message_type == 'file_offer' and not 0 < fields['chunk_size'] <= MAX_CHUNK:
+        raise ValueError(f"chunk_size must be 1 to {MAX_CHUNK}")
+    return fields
+
+
+def chunk_count(size, chunk_size):
+    return (size + chunk_size - 1) // chunk_size
+
+
+def transfer_id(path, to):
+    """Same file to the same user, same id, so sending it again resumes"""
+    stat = os.stat(path)
+    key = f"{to}|{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class Outgoing:
+    """A file we are sending, paced by the recipient's acks"""
+
+    def __init__(self, path, to, chunk_size=CHUNK_SIZE):
+        self.path = path
+        self.to = to
+        self.id = transfer_id(path, to)
+        self.size = os.path.getsize(path)
+        self.chunk_size = chunk_size
+        self.chunks = chunk_count(self.size, chunk_size)
+        self.cond = threading.Condition()
+        self.next_seq = None  # None until the recipient accepts
+        self.acked = -1
+        self.window = WINDOW
+        self.cancelled = None
+
+    def offer(self):
+        return {'type': 'file_offer', 'to': self.to, 'id': self.id, 'name': os.path.basename(self.path),
+                'size': self.size, 'chunk_size': self.chunk_size}
+
+    def accepted(self, from_chunk, window):
+        """Recipient wants chunks from from_chunk on, also after a gap or a reconnect"""
+        with self.cond:
+            self.next_seq = max(0, min(from_chunk, self.chunks))
+            self.acked = self.next_seq - 1
+            self.window = max(1, min(window, MAX_WINDOW))
+            self.cond.notify_all()
+
+    def acknowledged(self, seq):
+        with self.cond:
+            self.acked = max(self.acked, seq)
+            self.cond.notify_all()
+
+    def cancel(self, reason):
+        with self.cond:
+            self.cancelled = reason
+            self.cond.notify_all()
+
+    def _ready(self):
+        if self.cancelled or self.next_seq is None:
+            return self.cancelled
+        return self.acked >= self.chunks - 1 or self.next_seq < min(self.chunks, self.acked + 1 + self.window)
+
+    def run(self, send):
+        """Offer the file and send its chunks through send(message).
+
+        Returns None once every chunk is acknowledged, otherwise why it stopped.
+        """
+        send(self.offer())
+        with open(self.path, 'rb') as f:
+            while True:
+                with self.cond:
+                    if not self.cond.wait_for(self._ready, ACK_TIMEOUT):
+                        return "timed out"
+                    if self.cancelled:
+                        return self.cancelled
+                    if self.acked >= self.chunks - 1:
+                        return None
+                    seq = self.next_seq
+                    self.next_seq += 1
+
+                f.seek(seq * self.chunk_size)
+                data = base64.b64encode(f.read(self.chunk_size)).decode('ascii')
+                send({'type': 'file_chunk', 'to': self.to, 'id': self.id, 'seq': seq, 'data': data})
+
+
+class Incoming:
+    """A file we are receiving, written to a .part file so it can resume"""
+
+    def __init__(self, offer, directory=DOWNLOAD_DIR):
+        self.sender = offer['from']
+        self.id = offer['id']
+        self.name = os.path.basename(offer['name'].replace('\\', '/')) or 'file'
+        self.size = offer['size']
+        self.chunk_size = offer['chunk_size']
+        self.chunks = chunk_count(self.size, self.chunk_size)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        # Both come from the peer, only a digest of them is safe as a file name
+        key = hashlib.sha1(f"{self.sender}|{self.id}".encode('utf-8')).hexdigest()
+        self.part = os.path.join(directory, f"{key}.part")
+
+        # Keep whole chunks from an earlier attempt, drop a torn last one
+        have = os.path.getsize(self.part) if os.path.exists(self.part) else 0
+        self.next_seq = min(have // self.chunk_size, self.chunks)
+        with open(self.part, 'ab') as f:
+            f.truncate(self.next_seq * self.chunk_size)
+        self.requested = None
+
+    def accept(self):
+        self.requested = self.next_seq
+        return {'type': 'file_accept', 'to': self.sender, 'id': self.id,
+                'from_chunk': self.next_seq, 'window': WINDOW}
+
+    @property
+    def done(self):
+        return self.next_seq >= self.chunks
+
+    def write(self, seq, data):
+        """Store chunk seq, returns the message to answer with or None"""
+        if seq < self.next_seq:
+            return None  # sent again after a resume, we have it
+        if seq > self.next_seq:
+            # A chunk went missing, ask once to start again from it
+            return None if self.requested == self.next_seq else self.accept()
+        with open(self.part, 'ab') as f:
+            f.write(base64.b64decode(data))
+        self.next_seq += 1
+        return {'type': 'file_ack', 'to': self.sender, 'id': self.id, 'seq': seq}
+
+    def finish(self):
+        """Move the completed file into place, returns its path"""
+        root, ext = os.path.splitext(self.name)
+        path = os.path.join(self.directory, self.name)
+        n = 1
+        while os.path.exists(path):
+            path = os.path.join(self.directory, f"{root} ({n}){ext}")
+            n += 1
+        os.replace(self.part, path)
+        return path
@@ -0,0 +1,205 @@
+import struct
+import zlib
+
+from compression import deflate, inflate, DICTIONARY_ID, THRESHOLD
+from config import HEADER, PROTOCOL_VERSION
+
+# Framing versions for the server.py protocol, agreed on in the auth line
+PROTOCOL_V1 = 1  # HEADER bytes of space padded ASCII length, then the body
+PROTOCOL_V2 = 2  # 4-byte big-endian length, then the body
+LENGTH = struct.Struct('!I')
+# Top bit of a v2 length: the body is deflated against the shared dictionary.
+# Only used once compress=<DICTIONARY_ID> was agreed on in the auth line.
+COMPRESSED = 0x80000000
+
+MAX_FRAME = 16 * 1024 * 1024
+
+
+class FrameError(ValueError):
+    """The peer sent a header we cannot parse or a frame that is too large"""
+
+
+def header_size(version):
+    return LENGTH.size if version >= PROTOCOL_V2 else HEADER
+
+
+def encode_header(length, version=PROTOCOL_V1, compressed=False):
+    if version >= PROTOCOL_V2:
+        return LENGTH.pack(length | COMPRESSED if compressed else length)
+    return str(length).encode('ascii').ljust(HEADER)
+
+
+def decode_header(header, version=PROTOCOL_V1, compressed=False, max_frame=MAX_FRAME):
+    """(body length, whether the body is deflated) from a frame header"""
+    flagged = False
+    if version >= PROTOCOL_V2:
+        length = LENGTH.unpack(header)[0]
+        if compressed and length & COMPRESSED:
+            flagged = True
+            length &= ~COMPRESSED
+    else:
+        try:
+            length = int(bytes(header))
+        except ValueError:
+            raise FrameError(f"Bad header: {bytes(header)!r}")
+        if length < 0:
+            raise FrameError(f"Negative length in header: {bytes(header)!r}")
+    if length > max_frame:
+        raise FrameError(f"Frame of {length} bytes exceeds {max_frame}")
+    return length, flagged
+
+
+def decode_body(body, flagged, max_frame=MAX_FRAME):
+    """body itself, or inflated as a view of its own bytes when its header was flagged"""
+    if not flagged:
+        return body
+    try:
+        return memoryview(inflate(body, max_frame))
+    except (ValueError, zlib.error) as e:
+        raise FrameError(f"Bad compressed frame: {e}")
+
+
+def compress_payload(payload, version, compress):
+    """(body, compressed) to put on the wire, deflating only v2 payloads of THRESHOLD bytes or more"""
+    if compress and version >= PROTOCOL_V2 and len(payload) >= THRESHOLD:
+        body = deflate(payload)
+        if len(body) < len(payload):
+            return body, True
+    return payload, False
+
+
+def encode_frame(payload, version=PROTOCOL_V1, compress=False):
+    """Header and body as one bytes object, ready to share between recipients"""
+    payload, compressed = compress_payload(payload, version, compress)
+    return encode_header(len(payload), version, compressed) + payload
+
+
+def send_frame(sock, payload, version=PROTOCOL_V1, compress=False):
+    """Write header and body with a single system call when the platform allows it"""
+    payload, compressed = compress_payload(payload, version, compress)
+    header = encode_header(len(payload), version, compressed)
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(header + payload)
+        return
+
+    total = len(header) + len(payload)
+    sent = sock.sendmsg([header, payload])
+    if sent < total:
+        # Short write, push the rest without rebuilding the frame
+        rest = memoryview(header + payload) if sent < len(header) else memoryview(payload)
+        offset = sent if sent < len(header) else sent - len(header)
+        sock.sendall(rest[offset:])
+
+
+class FrameReader:
+    """Reads length-prefixed frames from a socket into one reusable buffer.
+
+    recv_into() fills a preallocated bytearray, so short reads simply wait for
+    more data and nothing is copied until a full frame is available.
+    read_frame() returns a memoryview into the buffer which stays valid only
+    until the next call. With `compressed` set, frames flagged COMPRESSED are
+    inflated and returned as a view of their own bytes. `data` is what was
+    already read from the socket past the auth reply.
+    """
+
+    def __init__(self, sock, version=PROTOCOL_V1, size=64 * 1024, max_frame=MAX_FRAME, compressed=False, data=b''):
+        self.sock = sock
+        self.version = version
+        self.compressed = compressed
+        self.max_frame = max_frame
+        self.buf = bytearray(max(size, len(data)))
+        self.buf[:len(data)] = data
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = len(data)
+
+    def _fill(self, needed):
+        """Read until `needed` bytes are buffered, False on EOF"""
+        if self.start + needed > len(self.buf):
+            self._make_room(needed)
+
+        while self.end - self.start < needed:
+            n = self.sock.recv_into(self.view[self.end:])
+            if n == 0:
+                return False
+            self.end += n
+        return True
+
+    def _make_room(self, needed):
+        pending = self.end - self.start
+        if needed > len(self.buf):
+            buf = bytearray(max(needed, len(self.buf) * 2))
+            buf[:pending] = self.view[self.start:self.end]
+            self.buf = buf
+            self.view = memoryview(self.buf)
+        else:
+            # Only the unread tail of the previous frame moves
+            self.buf[:pending] = self.buf[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    def read_frame(self):
+        """Return the next frame body as a memoryview, or None when the peer closed"""
+        if self.start == self.end:
+            self.start = self.end = 0
+
+        size = header_size(self.version)
+        if not self._fill(size):
+            return None
+
+        header = self.view[self.start:self.start + size]
+        length, flagged = decode_header(header, self.version, self.compressed, self.max_frame)
+
+        if not self._fill(size + length):
+            return None
+
+        body = self.view[self.start + size:self.start + size + length]
+        self.start += size + length
+        return decode_body(body, flagged, self.max_frame)
+
+
+def parse_options(fields):
+    """Turn ['proto=2', ...] from the end of an auth or token line into a dict"""
+    options = {}
+    for field in fields:
+        key, _, value = field.partition('=')
+        options[key.strip()] = value.strip()
+    return options
+
+
+def parse_auth(line):
+    """(credentials, version, compress) from a client's auth line.
+
+    credentials are [RESUME, token] or [action, username, password], the
+    key=value options after them pick the framing. Raises FrameError with
+    the text for the ERROR reply when the line is neither.
+    """
+    parts = line.split('|')
+    if parts[0] == 'RESUME' and len(parts) >= 2:
+        credentials, fields = parts[:2], parts[2:]
+    elif len(parts) >= 3:
+        credentials, fields = parts[:3], parts[3:]
+    else:
+        raise FrameError("Invalid auth format")
+    return (credentials,) + negotiate(parse_options(fields))
+
+
+def negotiate(options):
+    """(version, compress) agreed on for the options of an auth line"""
+    try:
+        version = max(PROTOCOL_V1, min(int(options.get('proto', PROTOCOL_V1)), PROTOCOL_VERSION))
+    except ValueError:
+        raise FrameError("Invalid proto option")
+    # Compressed frames are flagged in the binary length, v1 has no room for that
+    compress = version >= PROTOCOL_V2 and options.get('compress') == DICTIONARY_ID
+    return version, compress
+
+
+def token_reply(token, expires_in, version=PROTOCOL_V1, compress=False):
+    """The TOKEN line answering an auth line, unframed so the newline tells the client where frames start"""
+    reply = f"TOKEN|{token}"
+    if version > PROTOCOL_V1:
+        reply += f"|proto={version}"
+    if compress:
+        reply += f"|compress={DICTIONARY_ID}"
+    return f"{reply}|expires_in={expires_in}\n"
@@ -0,0 +1,85 @@
+"""Pass sockets and their state to a new server process over a Unix socket.
+
+The old process listens on a path. The new one connects, says TAKEOVER
+and receives batches, each a length-prefixed JSON state with up to MAX_FDS
+file descriptors attached as SCM_RIGHTS ancillary data. A batch of
+{"done": true} ends the stream and the new process answers READY once it
+owns everything, after which the old one may exit. The kernel keeps each
+socket open while either process holds it, so the clients never notice.
+"""
+import json
+import os
+import socket
+import struct
+
+LENGTH = struct.Struct('!I')
+MAX_FDS = 200  # per message, under the kernel's SCM_MAX_FD of 253
+TAKEOVER = b'TAKEOVER\n'
+READY = b'READY\n'
+
+
+def listen(path):
+    """Unix socket a successor can connect to, replacing whatever was at path"""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(1)
+    return sock
+
+
+def send_batch(sock, state, fds=()):
+    payload = json.dumps(state).encode('utf-8')
+    # The descriptors ride on the length prefix, the body follows as plain data
+    socket.send_fds(sock, [LENGTH.pack(len(payload))], list(fds))
+    sock.sendall(payload)
+
+
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Handoff stream ended early")
+        data += chunk
+    return bytes(data)
+
+
+def recv_batch(sock):
+    """Next (state, fds) from send_batch()"""
+    header, fds, flags, _ = socket.recv_fds(sock, LENGTH.size, MAX_FDS)
+    if flags & socket.MSG_CTRUNC:
+        raise ConnectionError("File descriptors were truncated")
+    if len(header) < LENGTH.size:
+        header += recv_exactly(sock, LENGTH.size - len(header))
+    state = json.loads(recv_exactly(sock, LENGTH.unpack(header)[0]))
+    return state, fds
+
+
+def request(path):
+    """Ask the process listening at path to hand over, returns (first state, fds, connection)"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    sock.sendall(TAKEOVER)
+    state, fds = recv_batch(sock)
+    return state, fds, sock
+
+
+def receive_rest(sock):
+    """Every remaining (state, fds) batch up to "done", then tell the old process it may go"""
+    batches = []
+    while True:
+        state, fds = recv_batch(sock)
+        if state.get('done'):
+            break
+        batches.append((state, fds))
+    sock.sendall(READY)
+    sock.close()
+    return batches
+
+
+def wait_ready(sock):
+    """True once the new process confirmed it owns everything"""
+    return recv_exactly(sock, len(READY)) == READY
@@ -0,0 +1,176 @@
+import asyncio
+import socket
+import threading
+import time
+
+import metrics
+from chatlog import log
+
+PING_INTERVAL = 30  # seconds of silence before the server pings a client
+IDLE_TIMEOUT = 90   # seconds of silence, pings unanswered, before it is closed
+KEEPALIVE_IDLE = 60  # seconds before the kernel starts TCP keepalive probes
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+
+reaped_connections = metrics.registry.counter('sajilo_reaped_total', "Connections closed for being silent too long")
+pings_sent = metrics.registry.counter('sajilo_pings_sent_total', "Heartbeat pings sent to idle clients")
+
+
+def set_keepalive(sock, idle=KEEPALIVE_IDLE, interval=KEEPALIVE_INTERVAL, count=KEEPALIVE_COUNT):
+    """Turn on TCP keepalive with our timings where the platform lets us set them, idle 0 leaves it off"""
+    if not idle:
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval), ('TCP_KEEPCNT', count)):
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+    except OSError:
+        pass
+
+
+class TimerWheel:
+    """Hashed timing wheel: `slots` buckets of `tick` seconds each, in a ring.
+
+    An item lives in the bucket of the tick its deadline falls in, so
+    scheduling and cancelling are O(1) and advance() only looks at the
+    buckets that came due. Deadlines further than one turn of the wheel
+    away stay put until the turn they belong to.
+    """
+
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.due = {}  # item -> tick number it expires at
+        self.current = int(time.monotonic() / tick)
+
+    def __len__(self):
+        return len(self.due)
+
+    def schedule(self, item, deadline):
+        """(Re)schedule item for the monotonic time deadline"""
+        self.cancel(item)
+        at = max(int(deadline / self.tick), self.current + 1)
+        self.due[item] = at
+        self.slots[at % len(self.slots)].add(item)
+
+    def cancel(self, item):
+        at = self.due.pop(item, None)
+        if at is not None:
+            self.slots[at % len(self.slots)].discard(item)
+
+    def advance(self, now):
+        """Remove and return every item whose deadline is now past"""
+        target = int(now / self.tick)
+        expired = []
+        # After a stall longer than a full turn every bucket is due once
+        for at in range(self.current + 1, min(target, self.current + len(self.slots)) + 1):
+            slot = self.slots[at % len(self.slots)]
+            for item in [item for item in slot if self.due[item] <= target]:
+                slot.discard(item)
+                del self.due[item]
+                expired.append(item)
+        self.current = max(self.current, target)
+        return expired
+
+
+class Reaper:
+    """Pings connections that went quiet and closes the ones that stay quiet.
+
+    Readers call touch() whenever data arrives, which only stamps the
+    connection. Each connection sits in the timer wheel once, at the time it
+    next needs looking at; when that comes it is pinged, closed, or moved to
+    its new deadline if it spoke meanwhile. A check therefore costs
+    O(connections due), not a scan of everyone. `ping` is None for
+    protocols where the client sends its own heartbeats.
+    """
+
+    def __init__(self, close, ping=None, ping_interval=PING_INTERVAL, timeout=IDLE_TIMEOUT, tick=1.0):
+        self.close = close
+        self.ping = ping
+        self.ping_interval = ping_interval
+        self.timeout = timeout
+        self.wheel = TimerWheel(tick)
+        self.last_seen = {}  # watched connection -> monotonic time data last arrived
+        self.lock = threading.Lock()
+
+    def configure(self, ping_interval=None, timeout=None):
+        if ping_interval is not None:
+            self.ping_interval = ping_interval
+        if timeout is not None:
+            self.timeout = timeout
+
+    def watch(self, conn):
+        if not self.timeout:
+            return
+        with self.lock:
+            last_seen = self.last_seen[conn] = time.monotonic()
+            self.wheel.schedule(conn, self.next_check(last_seen))
+
+    def unwatch(self, conn):
+        with self.lock:
+            self.last_seen.pop(conn, None)
+            self.wheel.cancel(conn)
+
+    def touch(self, conn):
+        if conn in self.last_seen:
+            self.last_seen[conn] = time.monotonic()
+
+    def next_check(self, last_seen):
+        if self.ping and self.ping_interval < self.timeout:
+            return last_seen + self.ping_interval
+        return last_seen + self.timeout
+
+    def check(self):
+        """Handle every connection that came due, returns how many were closed"""
+        now = time.monotonic()
+        with self.lock:
+            expired = self.wheel.advance(now)
+
+        reaped = 0
+        for conn in expired:
+            last_seen = self.last_seen.get(conn)
+            if last_seen is None:
+                continue  # logged out while we were looking
+            idle = now - last_seen
+            if idle >= self.timeout:
+                reaped += 1
+                try:
+                    self.close(conn)
+                except OSError:
+                    pass
+                continue
+
+            if self.ping and idle >= self.ping_interval:
+                pings_sent.inc()
+                try:
+                    self.ping(conn)
+                except OSError:
+                    pass  # already closing, its reader unwatches it
+                deadline = last_seen + self.timeout
+            else:
+                deadline = self.next_check(last_seen)
+            with self.lock:
+                # Unless it logged out while we were looking
+                if conn in self.last_seen:
+                    self.wheel.schedule(conn, deadline)
+
+        if reaped:
+            reaped_connections.inc(reaped)
+            log.info('REAPER', "Closed %d idle connections, %d still watched", reaped, len(self.wheel))
+        return reaped
+
+    def start(self):
+        """Check once a tick from a daemon thread, for threaded servers"""
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.wheel.tick)
+            self.check()
+
+    async def run_async(self):
+        """Check once a tick on the running event loop"""
+        while True:
+            await asyncio.sleep(self.wheel.tick)
+            self.check()
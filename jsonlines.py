@@ -0,0 +1,55 @@
+MAX_LINE = 64 * 1024  # longest line a peer may send
+
+
+class LineTooLong(ValueError):
+    """The peer sent more than max_line bytes without a newline"""
+
+
+class LineDecoder:
+    """Splits a byte stream into newline-terminated lines in linear time.
+
+    Chunks are appended to one bytearray and only the bytes that arrived
+    since the last call are scanned for a newline. Only complete lines are
+    decoded, so a multi-byte UTF-8 character split across two recv() calls
+    is handled correctly. Consumed bytes are trimmed once per feed(), not
+    once per line.
+    """
+
+    def __init__(self, max_line=MAX_LINE, encoding='utf-8'):
+        self.buf = bytearray()
+        self.scanned = 0  # bytes of buf already known to hold no newline
+        self.max_line = max_line
+        self.encoding = encoding
+
+    def feed(self, data):
+        """Add data and return the complete lines it finished, without newlines.
+
+        Lines are str, or bytes when the decoder was made with encoding=None.
+        """
+        buf = self.buf
+        buf += data
+        last = buf.rfind(b'\n', self.scanned)
+        if last == -1:
+            self.scanned = len(buf)
+            if self.scanned > self.max_line:
+                raise LineTooLong(f"Line of over {self.max_line} bytes without a newline")
+            return []
+
+        # Everything up to the last newline is whole lines, so one decode
+        # cannot cut a multi-byte character in half
+        if self.encoding:
+            lines = buf[:last].decode(self.encoding).split('\n')
+        else:
+            lines = bytes(buf[:last]).split(b'\n')
+        if last > self.max_line and max(map(len, lines)) > self.max_line:
+            raise LineTooLong(f"Line exceeds {self.max_line} characters")
+
+        del buf[:last + 1]
+        self.scanned = len(buf)
+        if self.scanned > self.max_line:
+            raise LineTooLong(f"Line of over {self.max_line} bytes without a newline")
+        return lines
+
+    def pending(self):
+        """Bytes received after the last complete line"""
+        return bytes(self.buf)
@@ -0,0 +1,378 @@
+"""Headless load generator for server.py, chatroom_server.py and dm_server.py.
+
+Connects --bots simulated users at --connect-rate per second, lets each one
+send group messages and DMs with exponential think time for --duration
+seconds, then reports throughput, end-to-end delivery latency and server
+memory as JSON. Every message carries its send time, so latency is measured
+from the sender's write to the receiver's read; run on the same host as the
+server so both use the same clock.
+
+    python dm_server.py --mode async --port 5050 &
+    python loadgen.py dm --port 5050 --bots 2000 --duration 30 --server-pid $! --json dm.json
+
+One event loop drives every bot. For more load than one core can generate,
+run several loadgens with different --prefix values.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import socket
+import sys
+import time
+
+from dm_async import raise_file_limit
+from framing import LENGTH, PROTOCOL_V2
+from jsonlines import LineDecoder
+
+DEFAULT_PORTS = {'dm': 5050, 'server': 5050, 'chatroom': 5052}
+MARKER = re.compile(rb'@lg (\d+\.\d+)@')
+TOKEN_REPLY = re.compile(rb'^TOKEN\|[^|]+(?:\|proto=\d+)?(?:\|compress=\w+)?\|expires_in=\d+\n')
+
+
+def stamp(size):
+    """Message text carrying the send time, padded to size characters"""
+    marker = f"@lg {time.time():.6f}@"
+    return marker + 'x' * max(0, size - len(marker))
+
+
+class Stats:
+    def __init__(self):
+        self.connected = 0
+        self.failed = 0
+        self.connect_times = []
+        self.sent = {'group': 0, 'dm': 0}
+        self.latencies = []
+        self.recording = False
+
+    def delivered(self, data):
+        """Record the latency of every stamped message found in data"""
+        if not self.recording:
+            return
+        now = time.time()
+        for match in MARKER.finditer(data):
+            self.latencies.append(now - float(match.group(1)))
+
+
+class Bot:
+    """One simulated user, subclasses speak a server's protocol"""
+
+    def __init__(self, name, args, stats, online):
+        self.name = name
+        self.args = args
+        self.stats = stats
+        self.online = online
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.login(), self.args.connect_timeout)
+        except (OSError, asyncio.TimeoutError, ValueError) as e:
+            self.stats.failed += 1
+            if self.stats.failed <= 5:
+                print(f"[LOADGEN] {self.name} failed to connect: {e!r}", file=sys.stderr)
+            if self.writer is not None:
+                self.writer.close()
+            return False
+        self.stats.connect_times.append(time.perf_counter() - start)
+        self.stats.connected += 1
+        self.online.append(self.name)
+        return True
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.args.host, self.args.port)
+
+    async def talk(self, until):
+        """Send messages with think time until the deadline"""
+        args = self.args
+        while time.monotonic() < until:
+            if args.think > 0:
+                await asyncio.sleep(random.expovariate(1 / args.think))
+                if time.monotonic() >= until:
+                    break
+            if random.random() < args.dm_ratio and self.supports_dm and len(self.online) > 1:
+                peer = random.choice(self.online)
+                if peer == self.name:
+                    continue
+                self.send_dm(peer, stamp(args.size))
+                self.stats.sent['dm'] += 1
+            else:
+                self.send_group(stamp(args.size))
+                self.stats.sent['group'] += 1
+            await self.writer.drain()
+
+    async def listen(self):
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                self.received(data)
+        except OSError:
+            pass
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class DMBot(Bot):
+    """dm_server.py: JSON lines"""
+    supports_dm = True
+
+    async def login(self):
+        await self.open()
+        self.decoder = LineDecoder(encoding=None)
+        await self.reader.readline()  # request_username
+        self.writer.write((json.dumps({'username': self.name, 'presence': 'delta'}) + '\n').encode())
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionError("closed during login")
+            message = json.loads(line)
+            if message.get('type') == 'error':
+                raise ValueError(message.get('message'))
+            if message.get('type') == 'system':
+                return
+
+    def send_group(self, text):
+        self.writer.write((json.dumps({'type': 'group', 'message': text}) + '\n').encode())
+
+    def send_dm(self, peer, text):
+        self.writer.write((json.dumps({'type': 'dm', 'to': peer, 'message': text}) + '\n').encode())
+
+    def received(self, data):
+        for line in self.decoder.feed(data):
+            if line == b'{"type": "ping"}':
+                self.writer.write(b'{"type": "pong"}\n')
+            # Our own DM confirmations echo the stamp back, skip them
+            elif b'"sent": true' not in line and b'"queued": true' not in line:
+                self.stats.delivered(line)
+
+
+class FramedBot(Bot):
+    """server.py: register or log in, then length-prefixed frames"""
+    supports_dm = False
+
+    async def login(self):
+        for action in ('REGISTER', 'LOGIN'):
+            while True:
+                await self.open()
+                self.writer.write(f"{action}|{self.name}|{self.args.password}|proto={PROTOCOL_V2}".encode())
+                try:
+                    # The reply ends in a newline, frames after it stay in the reader
+                    reply = await self.reader.readuntil(b'\n')
+                except asyncio.IncompleteReadError as e:
+                    reply = e.partial
+                if TOKEN_REPLY.match(reply):
+                    self.buf = bytearray()
+                    return
+                self.writer.close()
+                busy = re.search(rb'retry_after=(\d+)', reply)
+                if not busy:
+                    break
+                await asyncio.sleep(int(busy.group(1)))
+            if b'already exists' not in reply:
+                raise ValueError(reply.decode(errors='replace'))
+        raise ValueError("could not register or log in")
+
+    def send_group(self, text):
+        payload = text.encode()
+        self.writer.write(LENGTH.pack(len(payload)) + payload)
+
+    def received(self, data):
+        buf = self.buf
+        buf += data
+        start = 0
+        while len(buf) - start >= LENGTH.size:
+            length = LENGTH.unpack_from(buf, start)[0]
+            end = start + LENGTH.size + length
+            if end > len(buf):
+                break
+            self.stats.delivered(bytes(buf[start + LENGTH.size:end]))
+            start = end
+        del buf[:start]
+
+
+class ChatroomBot(Bot):
+    """chatroom_server.py: raw bytes relayed as they arrive"""
+    supports_dm = False
+
+    async def login(self):
+        await self.open()
+        await self.reader.read(1024)  # "Username"
+        self.writer.write(self.name.encode())
+        self.decoder = LineDecoder(encoding=None)
+
+    def send_group(self, text):
+        self.writer.write(f"{self.name}:{text}\n".encode())
+
+    def received(self, data):
+        for line in self.decoder.feed(data):
+            self.stats.delivered(line)
+
+
+BOTS = {'dm': DMBot, 'server': FramedBot, 'chatroom': ChatroomBot}
+
+
+def process_rss(pid):
+    """Resident memory in KiB of pid and all of its descendants, None if unreadable"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name can hold spaces, the parent pid follows its ')'
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+        except OSError:
+            if current == pid:
+                return None
+        pending.extend(children.get(current, ()))
+    return total
+
+
+async def sample_rss(pid, samples):
+    while True:
+        rss = process_rss(pid)
+        if rss is not None:
+            samples.append(rss)
+        await asyncio.sleep(1)
+
+
+def percentiles(values, scale=1e3):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def at(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))] * scale, 3)
+
+    return {
+        'p50': at(0.50),
+        'p99': at(0.99),
+        'p999': at(0.999),
+        'max': round(values[-1] * scale, 3),
+        'mean': round(sum(values) / len(values) * scale, 3),
+    }
+
+
+async def run(args):
+    stats = Stats()
+    online = []
+    bots = [BOTS[args.target](f"{args.prefix}{i}", args, stats, online) for i in range(args.bots)]
+
+    rss = []
+    sampler = asyncio.ensure_future(sample_rss(args.server_pid, rss)) if args.server_pid else None
+
+    # Ramp up at the requested connect rate
+    start = time.perf_counter()
+    connecting = []
+    for i, bot in enumerate(bots):
+        delay = start + i / args.connect_rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        connecting.append(asyncio.ensure_future(bot.connect()))
+    results = await asyncio.gather(*connecting)
+    ramp = time.perf_counter() - start
+    rss_start = rss[-1] if rss else None
+
+    live = [bot for bot, ok in zip(bots, results) if ok]
+    listeners = [asyncio.ensure_future(bot.listen()) for bot in live]
+    print(f"[LOADGEN] {len(live)}/{len(bots)} bots connected in {ramp:.1f}s, sending for {args.duration}s",
+          file=sys.stderr)
+
+    stats.recording = True
+    began = time.perf_counter()
+    until = time.monotonic() + args.duration
+    talkers = [asyncio.ensure_future(bot.talk(until)) for bot in live]
+    await asyncio.gather(*talkers, return_exceptions=True)
+    sending = time.perf_counter() - began
+
+    # Let messages still in flight arrive before counting
+    await asyncio.sleep(args.drain)
+    stats.recording = False
+    elapsed = time.perf_counter() - began
+
+    for bot in live:
+        bot.close()
+    for listener in listeners:
+        listener.cancel()
+    if sampler is not None:
+        sampler.cancel()
+
+    sent = sum(stats.sent.values())
+    return {
+        'target': args.target,
+        'host': args.host,
+        'port': args.port,
+        'bots': args.bots,
+        'connected': stats.connected,
+        'failed': stats.failed,
+        'connect_rate': args.connect_rate,
+        'ramp_seconds': round(ramp, 3),
+        'duration': args.duration,
+        'think': args.think,
+        'dm_ratio': args.dm_ratio if args.target == 'dm' else 0,
+        'size': args.size,
+        'sent': dict(stats.sent, total=sent),
+        'delivered': len(stats.latencies),
+        'sent_per_second': round(sent / sending, 1),
+        'delivered_per_second': round(len(stats.latencies) / elapsed, 1),
+        'latency_ms': percentiles(stats.latencies),
+        'connect_ms': percentiles(stats.connect_times),
+        'server_rss_kib': {'start': rss_start, 'peak': max(rss), 'end': rss[-1]} if rss else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('target', choices=sorted(BOTS), help="which server protocol to speak")
+    parser.add_argument('--host', default=socket.gethostbyname(socket.gethostname()))
+    parser.add_argument('--port', type=int, help="defaults to the target's usual port")
+    parser.add_argument('--bots', type=int, default=100)
+    parser.add_argument('--connect-rate', type=float, default=200, help="new connections per second")
+    parser.add_argument('--connect-timeout', type=float, default=30)
+    parser.add_argument('--duration', type=float, default=10, help="seconds of sending after the ramp")
+    parser.add_argument('--drain', type=float, default=2, help="seconds to wait for in-flight messages")
+    parser.add_argument('--think', type=float, default=1.0, help="mean seconds between a bot's messages")
+    parser.add_argument('--dm-ratio', type=float, default=0.5, help="share of messages sent as DMs (dm only)")
+    parser.add_argument('--size', type=int, default=100, help="characters per message")
+    parser.add_argument('--prefix', default='lg', help="bot usernames are prefix + number")
+    parser.add_argument('--password', default='loadgen-password', help="server.py bots register with this")
+    parser.add_argument('--server-pid', type=int, help="sample this process tree's RSS once a second")
+    parser.add_argument('--json', help="write the report here instead of stdout")
+    args = parser.parse_args()
+    if args.port is None:
+        args.port = DEFAULT_PORTS[args.target]
+
+    raise_file_limit()
+    report = asyncio.run(run(args))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"[LOADGEN] Report written to {args.json}", file=sys.stderr)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+import json
+import queue
+from concurrent.futures import Future
+import sqlite3
+import threading
+import time
+
+from chatlog import log
+from config import MESSAGE_DB_NAME
+from database import init_message_db, BUSY_TIMEOUT
+
+GROUP = 'group'
+MAX_PAGE = 200
+MAX_ID = (1 << 63) - 1  # largest id SQLite stores
+ID_BLOCK = 10000  # message ids reserved in the database at a time
+MAILBOX_LIMIT = 1000  # DMs kept per offline user, the oldest go first
+MAILBOX_TTL = 7 * 24 * 3600  # seconds a DM waits for an offline user
+PURGE_INTERVAL = 60.0  # seconds between sweeps for expired mailbox rows
+
+# Work items for the writer thread
+MESSAGE = 0
+MAIL = 1
+TAKE = 2
+SYNC = 3
+READ = 4
+
+
+def dm_conversation(user_a, user_b):
+    """Conversation key shared by both directions of a DM"""
+    return 'dm:' + json.dumps(sorted([user_a, user_b]))
+
+
+class MessageStore:
+    """Write-behind chat history in SQLite.
+
+    append() hands out the message id straight away and queues the row. A
+    background thread writes queued rows with executemany() and commits
+    every `batch_size` rows or every `flush_interval` seconds, whichever
+    comes first, so senders never wait for the disk. history() pages are
+    read on the same thread, after the rows queued ahead of them, so
+    nobody's event loop waits on SQLite either.
+
+    Ids come from blocks of id_block reserved in the message_ids table,
+    so any number of processes sharing the database, or a server and the
+    one taking over from it, never hand out the same id. The writer
+    reserves the next block while the current one is in use. A batch
+    that fails is written again row by row, so one bad row costs only
+    itself.
+
+    The same thread keeps the offline mailboxes: DMs for users who are not
+    logged in, at most mailbox_limit per user and for mailbox_ttl seconds.
+    take_mail() runs on the writer after everything queued before it, so a
+    DM queued just before its recipient logs in is never missed.
+
+    After close() nothing more is written: take_mail() answers [] and
+    leaves the mailbox for the next run, appends and mail are dropped.
+    """
+
+    def __init__(self, path=MESSAGE_DB_NAME, batch_size=500, flush_interval=0.05, id_block=ID_BLOCK,
+                 mailbox_limit=MAILBOX_LIMIT, mailbox_ttl=MAILBOX_TTL):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.id_block = id_block
+        self.mailbox_limit = mailbox_limit
+        self.mailbox_ttl = mailbox_ttl
+        self.next_purge = 0
+        self.conn = init_message_db(path)
+        self.next_id, self.end_id = self._reserve(self.conn)
+        self.spare = None  # (first, end) of the block after this one, once the writer reserved it
+        self.id_lock = threading.Lock()
+        self.pending = queue.Queue()
+        self.closed = False
+        self.close_lock = threading.Lock()  # orders puts against close()
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def append(self, conversation, sender, body, recipient=None):
+        """Queue a message for storage and return its id, None if no id could be reserved"""
+        with self.id_lock:
+            if self.next_id == self.end_id:
+                if not self._next_block():
+                    return None
+            message_id = self.next_id
+            self.next_id += 1
+        self._put((MESSAGE, (message_id, conversation, sender, recipient, body, time.time())))
+        return message_id
+
+    def _next_block(self):
+        """Move on to the spare block, or reserve one here if the writer hasn't yet. Caller holds id_lock."""
+        block, self.spare = self.spare, None
+        if block is None:
+            try:
+                conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT)
+                try:
+                    block = self._reserve(conn)
+                finally:
+                    conn.close()
+            except sqlite3.Error as e:
+                log.error('STORE', "Failed to reserve message ids: %s", e)
+                return False
+        self.next_id, self.end_id = block
+        return True
+
+    def _reserve(self, conn):
+        """Claim the next id_block ids for this process, (first, end)"""
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT next FROM message_ids").fetchone()
+            # Rows written before message_ids existed count too
+            last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+            first = max(row[0] if row else 1, last_id + 1)
+            if row:
+                conn.execute("UPDATE message_ids SET next = ?", (first + self.id_block,))
+            else:
+                conn.execute("INSERT INTO message_ids (next) VALUES (?)", (first + self.id_block,))
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        return first, first + self.id_block
+
+    def _refill(self):
+        """Reserve the next block ahead of time, on the writer thread"""
+        if self.spare is not None:
+            return
+        try:
+            block = self._reserve(self.conn)
+        except sqlite3.Error as e:
+            log.error('STORE', "Failed to reserve message ids: %s", e)
+            return
+        with self.id_lock:
+            if self.spare is None:
+                self.spare = block
+
+    def queue_mail(self, recipient, frame):
+        """Keep an encoded DM frame until recipient logs in"""
+        self._put((MAIL, (recipient, frame, time.time())))
+
+    def take_mail(self, recipient):
+        """Future for every frame waiting for recipient, oldest first, removing them"""
+        future = Future()
+        self._put((TAKE, (recipient, future)))
+        return future
+
+    def synced(self):
+        """Future that resolves once everything queued so far is committed"""
+        future = Future()
+        self._put((SYNC, future))
+        return future
+
+    def _put(self, item):
+        with self.close_lock:
+            if not self.closed:
+                self.pending.put(item)
+                return
+        self._drop(item)
+
+    def _drop(self, item):
+        """Answer whoever waits on an item that will never be written"""
+        if item[0] == TAKE:
+            item[1][1].set_result([])
+        elif item[0] == READ:
+            item[1][-1].set_result([])
+        elif item[0] == SYNC:
+            item[1].set_result(None)
+        else:
+            log.warning('STORE', "Store is closed, dropped a %s", 'message' if item[0] == MESSAGE else 'offline DM')
+
+    def _write_loop(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            take = None
+            while len(batch) < self.batch_size and item[0] < TAKE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.pending.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            if batch[-1][0] >= TAKE:
+                # Answer a login, a history page or a sync only after the writes queued ahead of it
+                take = batch.pop()
+            self._write(batch)
+            self._refill()
+            if take is not None:
+                self._answer(*take)
+            if stop:
+                break
+
+    def _answer(self, kind, payload):
+        if kind == TAKE:
+            self._take(*payload)
+        elif kind == READ:
+            self._read(*payload)
+        else:
+            payload.set_result(None)
+
+    def _write(self, batch):
+        messages = [row for kind, row in batch if kind == MESSAGE]
+        mail = [row for kind, row in batch if kind == MAIL]
+        if not messages and not mail:
+            return
+        try:
+            self._insert(messages, mail)
+        except sqlite3.Error as e:
+            if len(messages) + len(mail) == 1:
+                log.error('STORE', "Failed to write %s: %s", 'a message' if messages else 'an offline DM', e)
+                return
+            # Find the rows at fault, the rest still go in
+            log.warning('STORE', "Failed to write %d messages and %d offline DMs together, one by one now: %s",
+                        len(messages), len(mail), e)
+            for row in messages:
+                self._write([(MESSAGE, row)])
+            for row in mail:
+                self._write([(MAIL, row)])
+
+    def _insert(self, messages, mail):
+        """Write rows in one transaction, all of them or none"""
+        with self.conn:
+            if messages:
+                self.conn.executemany(
+                    "INSERT INTO messages (id, conversation, sender, recipient, body, created) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    messages
+                )
+            if mail:
+                self.conn.executemany(
+                    "INSERT INTO mailbox (recipient, frame, created) VALUES (?, ?, ?)",
+                    mail
+                )
+                self._evict({recipient for recipient, _, _ in mail})
+
+    def _evict(self, recipients):
+        """Drop the oldest mail past the limit and, now and then, everything expired"""
+        for recipient in recipients:
+            self.conn.execute(
+                "DELETE FROM mailbox WHERE recipient = ? AND id <= ("
+                "SELECT id FROM mailbox WHERE recipient = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                (recipient, recipient, self.mailbox_limit)
+            )
+
+        now = time.time()
+        if now >= self.next_purge:
+            self.next_purge = now + PURGE_INTERVAL
+            self.conn.execute("DELETE FROM mailbox WHERE created < ?", (now - self.mailbox_ttl,))
+
+    def _take(self, recipient, future):
+        try:
+            with self.conn:
+                rows = self.conn.execute(
+                    "SELECT id, frame FROM mailbox WHERE recipient = ? AND created >= ? ORDER BY id",
+                    (recipient, time.time() - self.mailbox_ttl)
+                ).fetchall()
+                if rows:
+                    # Only what was read, another process may be adding more
+                    self.conn.execute("DELETE FROM mailbox WHERE recipient = ? AND id <= ?",
+                                      (recipient, rows[-1][0]))
+        except sqlite3.Error as e:
+            log.error('STORE', "Failed to read offline DMs for %s: %s", recipient, e)
+            rows = []
+        future.set_result([bytes(frame) for _, frame in rows])
+
+    def history(self, conversation, before=None, limit=50):
+        """Future for one page of a conversation, oldest first, with ids below `before`.
+
+        Bad arguments raise TypeError or ValueError here, before anything is queued.
+        """
+        limit = max(1, min(int(limit), MAX_PAGE))
+        if before is not None:
+            # Past either end every id is above or below it, and SQLite can't bind it
+            before = max(0, min(int(before), MAX_ID))
+        future = Future()
+        self._put((READ, (conversation, before, limit, future)))
+        return future
+
+    def _read(self, conversation, before, limit, future):
+        try:
+            if before is None:
+                rows = self.conn.execute(
+                    "SELECT id, sender, recipient, body, created FROM messages "
+                    "WHERE conversation = ? ORDER BY id DESC LIMIT ?",
+                    (conversation, limit)
+                ).fetchall()
+            else:
+                rows = self.conn.execute(
+                    "SELECT id, sender, recipient, body, created FROM messages "
+                    "WHERE conversation = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                    (conversation, before, limit)
+                ).fetchall()
+        except sqlite3.Error as e:
+            log.error('STORE', "Failed to read history of %s: %s", conversation, e)
+            rows = []
+        rows.reverse()
+        future.set_result(rows)
+
+    def close(self):
+        """Write everything still queued and stop the writer"""
+        with self.close_lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.pending.put(None)
+        self.writer.join()
+        self.conn.close()
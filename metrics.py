@@ -0,0 +1,260 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds, from 10 microseconds to 10 seconds
+DEFAULT_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class Shards:
+    """One private dict per thread, merged only when somebody reads.
+
+    Recording touches nothing another thread writes to, so it takes no lock.
+    Shards of threads that have exited are folded into `retired` at read
+    time, so one thread per client doesn't grow the list forever.
+    """
+
+    def __init__(self, merge):
+        self.merge = merge
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []  # (thread, shard)
+        self.retired = {}
+
+    def mine(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append((threading.current_thread(), shard))
+            return shard
+
+    def collect(self):
+        """Merged {labels: value} over every thread that ever recorded"""
+        with self.lock:
+            alive = []
+            for thread, shard in self.shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    self._fold(self.retired, shard.copy())
+            self.shards = alive
+            total = {}
+            self._fold(total, self.retired)
+            for _, shard in alive:
+                self._fold(total, shard.copy())
+        return total
+
+    def _fold(self, into, shard):
+        for labels, value in shard.items():
+            into[labels] = self.merge(into[labels], value) if labels in into else self.merge(None, value)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.shards = Shards(lambda a, b: b if a is None else a + b)
+
+    def inc(self, amount=1, labels=()):
+        shard = self.shards.mine()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def collect(self):
+        return self.shards.collect()
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = ()
+        self.buckets = buckets
+        self.shards = Shards(self._merge)
+
+    @staticmethod
+    def _merge(a, b):
+        if a is None:
+            return [list(b[0]), b[1]]
+        return [[x + y for x, y in zip(a[0], b[0])], a[1] + b[1]]
+
+    def observe(self, value):
+        shard = self.shards.mine()
+        entry = shard.get(())
+        if entry is None:
+            # Per-bucket counts, the last one is +Inf, then the running sum
+            entry = shard[()] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def time(self):
+        return Timer(self)
+
+    def collect(self):
+        return self.shards.collect()
+
+
+class Timer:
+    """Context manager that observes how long its block took"""
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Gauge:
+    """Value read from a callback at scrape time, a number or {label value: number}"""
+
+    def __init__(self, name, help, read, label=None):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.labels = (label,) if label else ()
+
+    def collect(self):
+        value = self.read()
+        if isinstance(value, dict):
+            return {(key,): v for key, v in value.items()}
+        return {(): value}
+
+
+class TimedLock:
+    """threading.Lock that records how long each holder kept it, and waited for it if wait is given"""
+
+    def __init__(self, histogram, wait=None):
+        self.lock = threading.Lock()
+        self.histogram = histogram
+        self.wait = wait
+        self.acquired = 0.0
+
+    def __enter__(self):
+        if self.wait is None:
+            self.lock.acquire()
+            self.acquired = time.perf_counter()
+        else:
+            start = time.perf_counter()
+            self.lock.acquire()
+            self.acquired = time.perf_counter()
+            self.wait.observe(self.acquired - start)
+        return self
+
+    def __exit__(self, *exc):
+        held = time.perf_counter() - self.acquired
+        self.lock.release()
+        self.histogram.observe(held)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.by_name = {}
+
+    def register(self, metric):
+        """Add metric, replacing one registered earlier under the same name"""
+        old = self.by_name.get(metric.name)
+        if old is not None:
+            # A module executed twice, as __main__ and on import, registers
+            # everything twice and only the second copy is the live one
+            self.metrics[self.metrics.index(old)] = metric
+        else:
+            self.metrics.append(metric)
+        self.by_name[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def gauge(self, name, help, read, label=None):
+        return self.register(Gauge(name, help, read, label))
+
+    def snapshot(self):
+        """Plain dict of every metric, for JSON replies"""
+        result = {}
+        for metric in self.metrics:
+            values = metric.collect()
+            if isinstance(metric, Histogram):
+                counts, total = values.get((), [[0] * (len(metric.buckets) + 1), 0.0])
+                result[metric.name] = {'count': sum(counts), 'sum': total}
+            elif metric.labels:
+                result[metric.name] = {labels[0]: value for labels, value in values.items()}
+            else:
+                result[metric.name] = values.get((), 0)
+        return result
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            kind = {Counter: 'counter', Histogram: 'histogram', Gauge: 'gauge'}[type(metric)]
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {kind}")
+            values = metric.collect()
+
+            if isinstance(metric, Histogram):
+                counts, total = values.get((), [[0] * (len(metric.buckets) + 1), 0.0])
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{metric.name}_bucket{{le="{le}"}} {cumulative}')
+                lines.append(f"{metric.name}_sum {total}")
+                lines.append(f"{metric.name}_count {cumulative}")
+                continue
+
+            for labels, value in sorted(values.items()):
+                lines.append(f"{metric.name}{format_labels(metric.labels, labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{escape(str(value))}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = Registry()
+
+
+def serve(host, port, registry=registry):
+    """Serve GET /metrics from a daemon thread, returns the HTTP server"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,176 @@
+import collections
+import socket
+import threading
+
+from chatlog import log
+
+# What to do when a client's outbound queue is full
+DROP_OLDEST = 'drop_oldest'   # discard the oldest queued frame to make room
+DISCONNECT = 'disconnect'     # drop the connection
+BLOCK = 'block'               # make the sender wait, disconnect after a timeout
+POLICIES = (DROP_OLDEST, DISCONNECT, BLOCK)
+
+
+class SlowConsumer(OSError):
+    """Raised by send() when the connection was dropped for not reading"""
+
+
+class OutboundQueue:
+    """Bounded queue of outgoing frames for one connection, with counters.
+
+    Bulk frames (file chunks) wait in a second lane. Each write takes every
+    queued chat frame but only one bulk frame, so chat is never stuck
+    behind a file.
+    """
+
+    def __init__(self, name=None, max_frames=1024, policy=DROP_OLDEST, block_timeout=5.0):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow-consumer policy: {policy}")
+        self.name = name
+        self.frames = collections.deque()
+        self.bulk = collections.deque()
+        self.max_frames = max_frames
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.closed = False
+        self.render = None  # turns queued objects into bytes as they are written, see binproto.Renderer
+        self.enqueued = 0
+        self.dropped = 0
+        self.high_water = 0
+
+    def push(self, frame):
+        """Queue frame, applying the slow-consumer policy when full. Caller holds any lock."""
+        if self.closed:
+            raise SlowConsumer(f"Connection to {self.name} is closed")
+
+        if len(self.frames) >= self.max_frames:
+            if self.policy == DROP_OLDEST:
+                self.frames.popleft()
+                self.dropped += 1
+            elif self.policy == BLOCK and self.wait_for_room():
+                pass
+            else:
+                log.warning('SLOW', "%s queue full (%d frames), disconnecting", self.name, len(self.frames))
+                self.abort()
+                raise SlowConsumer(f"{self.name} is not reading")
+
+        self.frames.append(frame)
+        self.enqueued += 1
+        if len(self.frames) > self.high_water:
+            self.high_water = len(self.frames)
+
+    def push_bulk(self, frame):
+        """Queue a bulk frame. Senders are flow controlled, a full lane means one ignored that and the frame is dropped."""
+        if self.closed:
+            raise SlowConsumer(f"Connection to {self.name} is closed")
+        if len(self.bulk) >= self.max_frames:
+            self.dropped += 1
+            return
+        self.bulk.append(frame)
+        self.enqueued += 1
+
+    def take_batch(self):
+        """Everything to write next: all chat frames and at most one bulk frame. Caller holds any lock."""
+        if self.render is None:
+            batch = b''.join(self.frames)
+            if self.bulk:
+                batch += self.bulk.popleft()
+        else:
+            batch = b''.join(map(self.render, self.frames))
+            if self.bulk:
+                batch += self.render(self.bulk.popleft())
+        self.frames.clear()
+        return batch
+
+    def wait_for_room(self):
+        """Block until the queue has room, False on timeout. Only threaded queues can block."""
+        return False
+
+    def abort(self):
+        self.closed = True
+        self.frames.clear()
+        self.bulk.clear()
+
+    def stats(self):
+        return {
+            'depth': len(self.frames),
+            'bulk': len(self.bulk),
+            'high_water': self.high_water,
+            'enqueued': self.enqueued,
+            'dropped': self.dropped,
+            'policy': self.policy,
+        }
+
+
+class Connection(OutboundQueue):
+    """Client socket whose writes are queued and drained by a dedicated writer thread"""
+
+    def __init__(self, sock, name=None, **queue_options):
+        super().__init__(name, **queue_options)
+        self.sock = sock
+        self.cond = threading.Condition()
+        self.writer = threading.Thread(target=self._drain, daemon=True)
+        self.writer.start()
+
+    def send(self, data):
+        with self.cond:
+            self.push(data)
+            self.cond.notify_all()
+
+    def send_bulk(self, data):
+        with self.cond:
+            self.push_bulk(data)
+            self.cond.notify_all()
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def wait_for_room(self):
+        return self.cond.wait_for(
+            lambda: self.closed or len(self.frames) < self.max_frames,
+            self.block_timeout
+        ) and not self.closed
+
+    def abort(self):
+        """Drop queued frames and shut the socket so the reader notices"""
+        with self.cond:  # reentrant, senders call this with it held
+            super().abort()
+            self.cond.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self, drain_timeout=1.0):
+        """Flush what is queued for up to drain_timeout seconds, then close the socket"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if self.writer is not threading.current_thread():
+            self.writer.join(drain_timeout)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def _drain(self):
+        while True:
+            with self.cond:
+                while not self.frames and not self.bulk and not self.closed:
+                    self.cond.wait()
+                if not self.frames and not self.bulk:
+                    return
+                # Coalesce everything queued so far into one write
+                batch = self.take_batch()
+                self.cond.notify_all()
+
+            try:
+                self.sock.sendall(batch)
+            except OSError:
+                with self.cond:
+                    self.abort()
+                return
@@ -0,0 +1,99 @@
+import threading
+
+
+class Presence:
+    """Versioned set of online users that publishes coalesced join/leave deltas.
+
+    Every change bumps the version. Changes made within `window` seconds are
+    folded into one delta, {'type': 'presence', 'base': b, 'version': v,
+    'user_joined': [...], 'user_left': [...]}, which publish() receives along
+    with the matching full snapshot for clients that only understand user_list.
+    A delta lists every user that changed since base by where they are now,
+    also those whose changes cancelled out, so applying it is idempotent. A
+    client at version c can apply it when base <= c, whatever it saw in
+    between, otherwise it has missed one and should ask for a fresh snapshot.
+    """
+
+    def __init__(self, publish, window=0.05, schedule=None):
+        self.publish = publish
+        self.window = window
+        self.schedule = schedule or self._start_timer
+        self.lock = threading.Lock()
+        self.publish_lock = threading.Lock()
+        self.online = set()
+        self.version = 0
+        self.base_version = 0
+        self.pending = set()  # usernames changed since base_version
+        self.flush_scheduled = False
+
+    @staticmethod
+    def _start_timer(delay, callback):
+        timer = threading.Timer(delay, callback)
+        timer.daemon = True
+        timer.start()
+
+    def joined(self, username):
+        self._change(username, True)
+
+    def left(self, username):
+        self._change(username, False)
+
+    def _change(self, username, online):
+        with self.lock:
+            was_online = username in self.online
+            if was_online == online:
+                return
+            if online:
+                self.online.add(username)
+            else:
+                self.online.discard(username)
+            self.version += 1
+            self.pending.add(username)
+
+            if self.flush_scheduled:
+                return
+            self.flush_scheduled = True
+
+        if self.window > 0:
+            self.schedule(self.window, self.flush)
+        else:
+            self.flush()
+
+    def restore(self, online, version):
+        """Carry on from another process's state, which its clients already have"""
+        with self.lock:
+            self.online = set(online)
+            self.version = self.base_version = version
+            self.pending.clear()
+
+    def snapshot(self):
+        with self.lock:
+            return self._snapshot()
+
+    def _snapshot(self):
+        return {'type': 'user_list', 'users': sorted(self.online), 'version': self.version}
+
+    def flush(self):
+        """Publish everything that changed since the last flush as one delta"""
+        with self.publish_lock:
+            with self.lock:
+                self.flush_scheduled = False
+                if not self.pending:
+                    return
+                # Net no-ops too: a client that took a snapshot halfway through
+                # the window saw the change that was later undone
+                joined = sorted(u for u in self.pending if u in self.online)
+                left = sorted(u for u in self.pending if u not in self.online)
+                self.pending.clear()
+
+                delta = {
+                    'type': 'presence',
+                    'base': self.base_version,
+                    'version': self.version,
+                    'user_joined': joined,
+                    'user_left': left,
+                }
+                snapshot = self._snapshot()
+                self.base_version = self.version
+
+            self.publish(delta, snapshot)
@@ -0,0 +1,145 @@
+import math
+import threading
+import time
+
+import metrics
+
+SCOPES = ('user', 'ip')
+KINDS = ('group', 'dm', 'file', 'other')
+BURST_SECONDS = 2  # a bucket holds this many seconds of its rate
+
+# (scope, kind) -> (messages per second, bytes per second), 0 for no limit.
+# Per-IP limits are off by default, NAT and loadgen put many users on one address.
+DEFAULT_LIMITS = {
+    ('user', 'group'): (20, 64 * 1024),
+    ('user', 'dm'): (50, 256 * 1024),
+    ('user', 'file'): (200, 2 * 1024 * 1024),
+    ('user', 'other'): (10, 64 * 1024),
+}
+
+throttled_messages = metrics.registry.counter('sajilo_throttled_total',
+                                              "Messages that went over a flood limit", ('scope', 'kind'))
+throttle_seconds = metrics.registry.histogram('sajilo_throttle_seconds',
+                                              "Time reads were paused for a client over its limit")
+
+
+class TokenBucket:
+    """Refills at `rate` tokens per second up to `capacity`.
+
+    take() always succeeds and may leave the bucket in debt; the debt is
+    how long the caller has to wait. The message is already read by then,
+    so the caller pays by not reading the next one until it is repaid.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate * BURST_SECONDS
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, amount=1):
+        """Spend amount tokens, returns the seconds until the bucket is out of debt"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class FloodControl:
+    """Token buckets per user and per IP address, shared by their connections.
+
+    Buckets live as long as some connection holds a Throttle for them, so a
+    user who reconnects right away keeps the debt they ran up.
+    """
+
+    def __init__(self, limits=DEFAULT_LIMITS):
+        self.limits = dict(limits)
+        self.lock = threading.Lock()
+        self.owners = {}  # (scope, key) -> [connections holding it, {kind: (message bucket, byte bucket)}]
+
+    def configure(self, limits):
+        self.limits.update(limits)
+
+    def attach(self, username, address):
+        """Throttle for one connection, release() it when the connection ends"""
+        keys = [key for key in (('user', username), ('ip', address)) if key[1] is not None]
+        with self.lock:
+            for key in keys:
+                self.owners.setdefault(key, [0, {}])[0] += 1
+        return Throttle(self, keys)
+
+    def release(self, keys):
+        with self.lock:
+            for key in keys:
+                entry = self.owners[key]
+                entry[0] -= 1
+                if not entry[0]:
+                    del self.owners[key]
+
+    def buckets(self, key, kind):
+        """(message bucket, byte bucket) limiting key's messages of kind, None where unlimited"""
+        entry = self.owners[key]
+        buckets = entry[1].get(kind)
+        if buckets is None:
+            messages, size = self.limits.get((key[0], kind), (0, 0))
+            buckets = (TokenBucket(messages) if messages else None, TokenBucket(size) if size else None)
+            with self.lock:
+                buckets = entry[1].setdefault(kind, buckets)
+        return buckets
+
+
+class Throttle:
+    """One connection's view of its user and address buckets"""
+
+    def __init__(self, flood, keys):
+        self.flood = flood
+        self.keys = keys
+
+    def charge(self, kind, size, count=1):
+        """Account count messages of size bytes in all, returns seconds to stop reading from the client"""
+        delay = 0.0
+        for key in self.keys:
+            messages, data = self.flood.buckets(key, kind)
+            wait = max(messages.take(count) if messages else 0.0, data.take(size) if data else 0.0)
+            if wait > 0:
+                throttled_messages.inc(count, (key[0], kind))
+                delay = max(delay, wait)
+        if delay:
+            throttle_seconds.observe(delay)
+        return delay
+
+    def release(self):
+        if self.keys:
+            self.flood.release(self.keys)
+            self.keys = []
+
+
+def parse_rate(text, name):
+    """A positive rate from the command line, 0 for 'none' or nothing"""
+    text = text.strip()
+    if text in ('', 'none'):
+        return 0
+    try:
+        rate = float(text)
+    except ValueError:
+        rate = None
+    # A bucket with a rate of 0 or less would never refill
+    if rate is None or not math.isfinite(rate) or rate <= 0:
+        raise ValueError(f"Bad rate {text!r} in limit {name!r}, expected a number above 0 or 'none'")
+    return rate
+
+
+def parse_limits(values):
+    """['user.group=20/65536', ...] from the command line into DEFAULT_LIMITS form"""
+    limits = {}
+    for value in values:
+        name, _, rates = value.partition('=')
+        scope, _, kind = name.strip().partition('.')
+        messages, _, size = rates.partition('/')
+        if scope not in SCOPES or kind not in KINDS:
+            raise ValueError(f"Unknown limit {name!r}, expected SCOPE.KIND with SCOPE in {SCOPES} and KIND in {KINDS}")
+        limits[(scope, kind)] = (parse_rate(messages, name), parse_rate(size, name))
+    return limits
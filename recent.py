@@ -0,0 +1,78 @@
+"""Bounded in-memory backlog of a room's last messages, replayed to whoever joins.
+
+Nothing is read from or written to disk. Frames are kept exactly as they
+were sent, so replaying them costs one join of bytes and one write.
+"""
+import collections
+import threading
+
+MAX_MESSAGES = 50
+MAX_BYTES = 64 * 1024
+
+
+class Record:
+    """One remembered frame and the message type it carries"""
+
+    __slots__ = ('frame', 'kind')
+
+    def __init__(self, frame, kind):
+        self.frame = frame
+        self.kind = kind
+
+
+class RecentMessages:
+    """The last max_messages frames and at most max_bytes of them, oldest dropped first. 0 turns either off.
+
+    An append costs a deque append. backlog() joins the frames once and
+    keeps the result until the next append, so everyone joining in between
+    shares one copy. `lock` is reentrant: holding it around append() and
+    around backlog() makes them atomic with whatever else the caller does.
+    """
+
+    def __init__(self, max_messages=MAX_MESSAGES, max_bytes=MAX_BYTES):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.records = collections.deque()
+        self.size = 0  # bytes in records
+        self.joined = None  # (frames as one write, records) until the next change
+        self.lock = threading.RLock()
+
+    def configure(self, max_messages, max_bytes):
+        with self.lock:
+            self.max_messages = max_messages
+            self.max_bytes = max_bytes
+            self._trim()
+
+    def __len__(self):
+        return len(self.records)
+
+    def append(self, frame, kind=None):
+        if not self.max_messages or not self.max_bytes or len(frame) > self.max_bytes:
+            return
+        with self.lock:
+            self.records.append(Record(frame, kind))
+            self.size += len(frame)
+            self._trim()
+
+    def _trim(self):
+        records = self.records
+        while records and (len(records) > self.max_messages or self.size > self.max_bytes):
+            self.size -= len(records.popleft().frame)
+        self.joined = None
+
+    def backlog(self):
+        """(every frame as one bytes, the records it holds), oldest first"""
+        joined = self.joined
+        if joined is None:
+            with self.lock:
+                records = tuple(self.records)
+                joined = self.joined = (b''.join(record.frame for record in records), records)
+        return joined
+
+    def export(self):
+        """[(frame, kind), ...] of JSON-safe text frames, for a handoff"""
+        return [(record.frame.decode('utf-8'), record.kind) for record in self.backlog()[1]]
+
+    def restore(self, frames):
+        for frame, kind in frames:
+            self.append(frame.encode('utf-8'), kind)
@@ -0,0 +1,48 @@
+class ClientRegistry:
+    """Username -> client map that readers use without taking a lock.
+
+    The dict behind it is never changed once published. Joins and leaves
+    copy it, change the copy and swap it in, while holding the writers'
+    lock. A DM lookup or a broadcast reads whichever dict is current, so
+    it never waits on a login or on another sender; a broadcast that
+    started just before someone joined simply doesn't include them.
+    Writers pay one copy of the map per change, and there are far fewer
+    of those than messages.
+    """
+
+    def __init__(self, clients=()):
+        self.current = dict(clients)
+
+    def get(self, username):
+        return self.current.get(username)
+
+    def __contains__(self, username):
+        return username in self.current
+
+    def __len__(self):
+        return len(self.current)
+
+    def snapshot(self):
+        """The current map, as of now. Nobody changes it, iterate it freely."""
+        return self.current
+
+    def items(self):
+        return self.current.items()
+
+    def values(self):
+        return self.current.values()
+
+    def add(self, username, client):
+        """Map username to client. Caller holds the writers' lock."""
+        current = self.current.copy()
+        current[username] = client
+        self.current = current
+
+    def remove(self, username, client):
+        """Drop username if it still maps to client, returns whether it did. Caller holds the writers' lock."""
+        if self.current.get(username) is not client:
+            return False
+        current = self.current.copy()
+        del current[username]
+        self.current = current
+        return True
@@ -1,71 +1,108 @@
 import socket
 import threading
+import time
 from config import *
-from auth import authenticate
+from auth import authenticate, resume, refresh, start_pool
 from database import init_db
+from message_store import MessageStore
+from ratelimit import FloodControl
+from framing import FrameReader, FrameError, encode_frame, send_frame, parse_auth, token_reply, PROTOCOL_V1
 
 SERVER = socket.gethostbyname(socket.gethostname())
 ADDR = (SERVER, PORT)
 
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server.bind(ADDR)
+clients = []  # (conn, username, framing version, compression agreed)
+store = None
+flood = FloodControl()
+flood.configure(FLOOD_LIMITS)
+ROOM = "lobby"  # conversation key for this server's single room
 
-clients = []
+def encode_message(msg, version=PROTOCOL_V1, compress=False):
+    return encode_frame(msg.encode(FORMAT), version, compress)
 
-def send_message(conn, msg):
-    message = msg.encode(FORMAT)
-    length = len(message)
-    header = str(length).encode(FORMAT)
-    header += b' ' * (HEADER - len(header))
-    conn.send(header)
-    conn.send(message)
+def send_message(conn, msg, version=PROTOCOL_V1, compress=False):
+    send_frame(conn, msg.encode(FORMAT), version, compress)
 
 def broadcast(msg, sender=None):
-    for client, _ in clients:
+    # Encode once per framing, recipients share the same bytes
+    frames = {}
+    for client, _, version, compress in clients:
         if client != sender:
-            send_message(client, msg)
+            framing = (version, compress)
+            if framing not in frames:
+                frames[framing] = encode_message(msg, version, compress)
+            client.sendall(frames[framing])
 
 def handle_client(conn, addr):
     print(f"[NEW CONNECTION] {addr}")
     username = None
+    throttle = None
 
     try:
         # ---- AUTH ----
         auth_data = conn.recv(1024).decode(FORMAT)
 
-        parts = auth_data.split("|")
-        if len(parts) != 3:
-            conn.send("ERROR|Invalid auth format".encode(FORMAT))
+        # Optional key=value fields follow, e.g. proto=2. Checked before
+        # authenticating, a REGISTER must not create the account first.
+        try:
+            credentials, version, compress = parse_auth(auth_data)
+        except FrameError as e:
+            conn.send(f"ERROR|{e}\n".encode(FORMAT))
             conn.close()
             return
 
-        action, username, password = parts
-
-
-        token, error = authenticate(action, username, password)
+        if credentials[0] == "RESUME":
+            # Reconnect with a session token, skips bcrypt entirely
+            username, token, expires_in, error = resume(credentials[1])
+        else:
+            action, username, password = credentials
+            token, error = authenticate(action, username, password)
+            expires_in = TOKEN_TTL
 
         if error:
-            conn.send(f"ERROR|{error}".encode())
+            conn.send(f"ERROR|{error}\n".encode())
             conn.close()
             return
 
-        conn.send(f"TOKEN|{token}".encode())
+        conn.send(token_reply(token, expires_in, version, compress).encode())
 
-        clients.append((conn, username))
+        clients.append((conn, username, version, compress))
+        throttle = flood.attach(username, addr[0])
         broadcast(f"[SERVER] {username} joined the chat")
 
+        reader = FrameReader(conn, version, compressed=compress)
         while True:
-            header = conn.recv(HEADER).decode(FORMAT)
-            if not header:
+            frame = reader.read_frame()
+            if frame is None:
                 break
 
-            msg_length = int(header)
-            msg = conn.recv(msg_length).decode(FORMAT)
+            msg = str(frame, FORMAT)
 
             if msg == DISCONNECT_MESSAGE:
                 break
 
-            broadcast(f"{username}: {msg}", conn)
+            if msg == REFRESH_MESSAGE:
+                # New token before the old one expires, no password needed
+                delay = throttle.charge('other', len(frame))
+                token, expires_in = refresh(token)
+                if token:
+                    send_message(conn, f"TOKEN|{token}|expires_in={expires_in}", version, compress)
+                else:
+                    send_message(conn, "ERROR|Token expired, log in again", version, compress)
+            else:
+                delay = throttle.charge('group', len(frame))
+                store.append(ROOM, username, msg)
+                broadcast(f"{username}: {msg}", conn)
+
+            if delay:
+                # Over the flood limit, stop reading and let TCP push back on the client
+                time.sleep(delay)
+
+    except (FrameError, UnicodeDecodeError) as e:
+        print(f"[PROTOCOL ERROR] {username}: {e}")
+    except OSError as e:
+        # Reset or broken connection, ours or a client we broadcast to
+        print(f"[CONNECTION ERROR] {username or addr}: {e}")
 
     finally:
         print(f"[DISCONNECTED] {username}")
@@ -73,11 +110,19 @@ def handle_client(conn, addr):
             if c[0] == conn:
                 clients.remove(c)
                 break
+        if throttle is not None:
+            throttle.release()
         broadcast(f"[SERVER] {username} left the chat")
         conn.close()
 
 def start():
+    global store
     init_db()
+    store = MessageStore()
+    start_pool()
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(ADDR)
     server.listen()
     print(f"[LISTENING] {SERVER}")
 
@@ -86,5 +131,8 @@ def start():
         thread = threading.Thread(target=handle_client, args=(conn, addr))
         thread.start()
 
-print("[STARTING] Server starting...")
-start()
+# Guarded so the bcrypt worker processes can import this module safely
+if __name__ == "__main__":
+    print("[STARTING] Server starting...")
+    start()
+